@@ -39,6 +39,11 @@ flags.DEFINE_string("requestor", "__builtin:__operator",
                     "The service id of a requestor.")
 flags.DEFINE_string("service_name", "base:roscore",
                     "Service name to request.")
+flags.DEFINE_bool("return_operation", False,
+                  "Run the request in the background on the server, then wait "
+                  "for its operation.")
+flags.DEFINE_float("wait_operation_timeout", 60,
+                   "Time (in seconds) to wait for the operation.")
 
 
 def main(argv):
@@ -57,11 +62,20 @@ def main(argv):
     request_request.request.request_id.request_uuid = FLAGS.service_name
     request_request.request.requested_services.extend([srv_id_pb])
 
+    request_request.return_operation = FLAGS.return_operation
+
     logging.info("Request to send: \n%s", str(request_request))
 
     request_response = stub.RequestService(request_request)
     logging.info("Response: \n%s", str(request_response))
 
+    if request_response.operation_id:
+      wait_request = service_manager_rpc_pb2.WaitOperationRequest()
+      wait_request.operation_id = request_response.operation_id
+      wait_request.timeout_secs = FLAGS.wait_operation_timeout
+      wait_response = stub.WaitOperation(wait_request)
+      logging.info("Operation: \n%s", str(wait_response))
+
 
 if __name__ == "__main__":
   main(sys.argv)
@@ -0,0 +1,200 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+# Mixed read/write load against one or more service manager servers, to
+# compare the threaded server (service_manager_server_main) with the grpc.aio
+# one (service_manager_aio_server_main). Start both on different addresses
+# and storage paths, then e.g.:
+#   server_load_benchmark --servers=threaded=localhost:7016,aio=localhost:7017
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import result_code_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
+from cogrob.service_manager.proto import service_options_pb2
+import collections
+import grpc
+import random
+import sys
+import threading
+import time
+import uuid
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list("servers", ["threaded=localhost:7016"],
+                  "Servers to benchmark, as name=address, one after another.")
+flags.DEFINE_float("duration_secs", 10, "How long to load each server.")
+flags.DEFINE_integer("num_readers", 16,
+                     "Threads calling QueryService and ListServices.")
+flags.DEFINE_integer("num_writers", 4,
+                     "Threads calling RequestService and ReleaseService.")
+flags.DEFINE_integer("num_watchers", 0,
+                     "WatchServices streams kept open during the load.")
+flags.DEFINE_integer("num_services", 8,
+                     "Number of simulated services to request and query.")
+
+_NAMESPACE = ["load_benchmark"]
+_OPERATOR_ID = service_id.ServiceId(["__builtin"], "__operator")
+
+
+def _CreateServices(stub):
+  srv_ids = []
+  for i in range(FLAGS.num_services):
+    options = service_options_pb2.ServiceOptions()
+    options.id.namespace.extend(_NAMESPACE)
+    options.id.name = "service_{}".format(i)
+    options.type = service_options_pb2.SERVICE_TYPE_DOCKER
+    options.run_mode = service_options_pb2.RUN_MODE_SIMULATION
+    options.docker_service_options.container_options.image = "ubuntu"
+    response = stub.CreateService(
+        service_manager_rpc_pb2.CreateServiceRequest(options=options))
+    if response.result not in (result_code_pb2.RESULT_OK,
+                               result_code_pb2.RESULT_SERVICE_ALREADY_EXIST):
+      raise RuntimeError("Cannot create service: " + response.error_message)
+    srv_ids.append(service_id.ServiceId.FromProto(options.id))
+  return srv_ids
+
+
+class _LatencyRecorder(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._latencies = collections.defaultdict(list)
+    self._errors = collections.defaultdict(int)
+
+
+  def Call(self, rpc_name, function, request):
+    start_time = time.time()
+    try:
+      response = function(request)
+      failed = getattr(response, "result", result_code_pb2.RESULT_OK) != (
+          result_code_pb2.RESULT_OK)
+    except grpc.RpcError:
+      failed = True
+    latency = time.time() - start_time
+    with self._lock:
+      self._latencies[rpc_name].append(latency)
+      if failed:
+        self._errors[rpc_name] += 1
+
+
+  def Summarize(self, duration_secs):
+    """Returns a list of (rpc name, count, qps, p50 ms, p99 ms, errors)."""
+    result = []
+    for rpc_name in sorted(self._latencies.keys()):
+      latencies = sorted(self._latencies[rpc_name])
+      result.append((
+          rpc_name, len(latencies), len(latencies) / duration_secs,
+          latencies[len(latencies) // 2] * 1000,
+          latencies[min(len(latencies) - 1,
+                        int(len(latencies) * 0.99))] * 1000,
+          self._errors[rpc_name]))
+    return result
+
+
+def _Reader(stub, srv_ids, recorder, deadline):
+  while time.time() < deadline:
+    if random.random() < 0.8:
+      recorder.Call("QueryService", stub.QueryService,
+                    service_manager_rpc_pb2.QueryServiceRequest(
+                        id=random.choice(srv_ids).ToProto()))
+    else:
+      recorder.Call("ListServices", stub.ListServices,
+                    service_manager_rpc_pb2.ListServicesRequest())
+
+
+def _Writer(stub, srv_ids, recorder, deadline):
+  while time.time() < deadline:
+    request = service_manager_rpc_pb2.RequestServiceRequest()
+    request.request.request_id.service_id.CopyFrom(_OPERATOR_ID.ToProto())
+    request.request.request_id.request_uuid = uuid.uuid4().hex
+    request.request.requested_services.extend(
+        [random.choice(srv_ids).ToProto()])
+    recorder.Call("RequestService", stub.RequestService, request)
+    recorder.Call("ReleaseService", stub.ReleaseService,
+                  service_manager_rpc_pb2.ReleaseServiceRequest(
+                      request_id=request.request.request_id))
+
+
+def _DrainWatcher(watcher):
+  try:
+    for _ in watcher:
+      pass
+  except grpc.RpcError:
+    # Cancelled once the load is done.
+    pass
+
+
+def _RunLoad(address):
+  with grpc.insecure_channel(address) as channel:
+    stub = service_manager_rpc_pb2_grpc.ServiceManagerStub(channel)
+    srv_ids = _CreateServices(stub)
+
+    watch_request = service_manager_rpc_pb2.WatchServicesRequest()
+    watch_request.namespaces.add().namespace.extend(_NAMESPACE)
+    watchers = [stub.WatchServices(watch_request)
+                for _ in range(FLAGS.num_watchers)]
+    for watcher in watchers:
+      threading.Thread(target=_DrainWatcher, args=(watcher,)).start()
+
+    recorder = _LatencyRecorder()
+    deadline = time.time() + FLAGS.duration_secs
+    threads = (
+        [threading.Thread(target=_Reader,
+                          args=(stub, srv_ids, recorder, deadline))
+         for _ in range(FLAGS.num_readers)] +
+        [threading.Thread(target=_Writer,
+                          args=(stub, srv_ids, recorder, deadline))
+         for _ in range(FLAGS.num_writers)])
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    for watcher in watchers:
+      watcher.cancel()
+    return recorder.Summarize(FLAGS.duration_secs)
+
+
+def main(argv):
+  FLAGS.verbosity = logging.INFO
+  FLAGS(argv)
+
+  lines = ["{:<10} {:<16} {:>8} {:>10} {:>10} {:>10} {:>7}".format(
+      "server", "rpc", "count", "qps", "p50 ms", "p99 ms", "errors")]
+  for server in FLAGS.servers:
+    name, address = server.split("=", 1)
+    logging.info("Loading %s (%s) for %.1fs.", name, address,
+                 FLAGS.duration_secs)
+    for rpc_name, count, qps, p50, p99, num_errors in _RunLoad(address):
+      lines.append("{:<10} {:<16} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>7}"
+                   .format(name, rpc_name, count, qps, p50, p99, num_errors))
+  logging.info("Results:\n%s", "\n".join(lines))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -31,7 +31,6 @@ from cogrob.service_manager.proto import service_manager_rpc_pb2
 from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
 from cogrob.service_manager.proto import service_options_pb2
 from cogrob.service_manager.proto import sync_helper_config_pb2
-import checksumdir
 import google.protobuf.text_format
 import grpc
 import sys
@@ -48,6 +47,13 @@ flags.DEFINE_string(
     "Configuration file for this script.")
 
 
+def _DirHash(dir_path):
+  # Only imported when a managed service has additional configuration
+  # directories, it is slow to import.
+  import checksumdir
+  return checksumdir.dirhash(dir_path)
+
+
 class RorgSyncScriptHelper(object):
 
   def __init__(self):
@@ -107,7 +113,9 @@ class RorgSyncScriptHelper(object):
     all_existing_services = set([service_id.ServiceId.FromProto(x)
                                  for x in list_response.services])
 
-    need_write_back_helper_config = False
+    # All new services are created with one batch, in dependency order.
+    batch_request = service_manager_rpc_pb2.BatchCreateServicesRequest()
+    new_managed_services = []
     for managed_service in self._sync_helper_config.managed_services:
       pb = self._ParseServiceOptionsPb(managed_service.configuration_file)
 
@@ -117,23 +125,25 @@ class RorgSyncScriptHelper(object):
 
         logging.info("Will new service for %s",
                      managed_service.configuration_file)
-        create_request = service_manager_rpc_pb2.CreateServiceRequest()
-        create_request.options.CopyFrom(pb)
-        create_response = self._rorg_stub.CreateService(create_request)
-        logging.info("Created new service with response: %s",
-                     str(create_response))
+        batch_request.items.add().options.CopyFrom(pb)
+        new_managed_services.append(managed_service)
 
-        managed_service.ClearField("additional_configuration_hashes")
-        for i in range(
-            len(managed_service.additional_configuration_directories)):
-          config_dir = managed_service.additional_configuration_directories[i]
-          checksum_dir = checksumdir.dirhash(config_dir)
-          managed_service.additional_configuration_hashes.extend([checksum_dir])
+    if not new_managed_services:
+      return
 
-        need_write_back_helper_config = True
+    batch_response = self._rorg_stub.BatchCreateServices(batch_request)
+    logging.info("Created new services with response: %s",
+                 str(batch_response))
 
-    if need_write_back_helper_config:
-      self._WriteBackHelperConfig()
+    for managed_service in new_managed_services:
+      managed_service.ClearField("additional_configuration_hashes")
+      for i in range(
+          len(managed_service.additional_configuration_directories)):
+        config_dir = managed_service.additional_configuration_directories[i]
+        checksum_dir = _DirHash(config_dir)
+        managed_service.additional_configuration_hashes.extend([checksum_dir])
+
+    self._WriteBackHelperConfig()
 
 
   def _RemoveRemovedServices(self):
@@ -191,7 +201,7 @@ class RorgSyncScriptHelper(object):
           for i in range(
               len(managed_service.additional_configuration_directories)):
             config_dir = managed_service.additional_configuration_directories[i]
-            checksum_dir = checksumdir.dirhash(config_dir)
+            checksum_dir = _DirHash(config_dir)
             if (checksum_dir !=
                   managed_service.additional_configuration_hashes[i]):
               need_update = True
@@ -216,7 +226,7 @@ class RorgSyncScriptHelper(object):
         for i in range(
             len(managed_service.additional_configuration_directories)):
           config_dir = managed_service.additional_configuration_directories[i]
-          checksum_dir = checksumdir.dirhash(config_dir)
+          checksum_dir = _DirHash(config_dir)
           managed_service.additional_configuration_hashes.extend([checksum_dir])
 
         need_write_back_helper_config = True
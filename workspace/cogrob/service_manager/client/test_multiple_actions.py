@@ -30,7 +30,6 @@ from cogrob.service_manager.model import service_id
 from cogrob.service_manager.proto import service_manager_rpc_pb2
 from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
 from cogrob.service_manager.proto import service_options_pb2
-import docker
 import google.protobuf.text_format
 import grpc
 import sys
@@ -71,6 +70,8 @@ def RemoveExistingDockerContainerById(srv_id):
   assert isinstance(srv_id, service_options_pb2.ServiceId)
   container_name = ServiceIdToContainerName(srv_id)
 
+  # Only imported when --docker_rm_before_start is set, it is slow to import.
+  import docker
   docker_py_client = docker.from_env()
   try:
     container = docker_py_client.containers.get(container_name)
@@ -0,0 +1,193 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.util import errors
+import concurrent.futures
+import functools
+import threading
+
+flags.DEFINE_integer(
+    "activation_num_threads", 8,
+    "Number of containers the activation executor starts at the same time.")
+FLAGS = flags.FLAGS
+
+
+class ActivationCancelledError(errors.InternalError):
+  def __init__(self, message="Deactivated before its container started."):
+    super(ActivationCancelledError, self).__init__(message)
+
+
+class _ContainerStart(object):
+  # One container to start. start_fn starts it and returns the list of
+  # DelayedAction for the service to be ready. action is met once they are.
+
+  def __init__(self, srv_id, start_fn):
+    self.service_id = srv_id
+    self.start_fn = start_fn
+    self.action = delayed_action.WaitForActivation(srv_id)
+    # Set under the lock of the executor.
+    self.running = False
+    self.cancelled = False
+    self.finished = threading.Event()
+
+
+class ActivationPlan(object):
+  # The containers to start for one operation, collected while the services
+  # are activated (see ServiceManager.PlanActivation), and started by
+  # ActivationExecutor.Run once the operation is done.
+
+  def __init__(self, executor, dependency_graph):
+    self._executor = executor
+    self._dependency_graph = dependency_graph
+    self._starts = {}
+
+
+  def AddStart(self, srv_id, start_fn):
+    """Plan to start the container of srv_id by calling start_fn. Returns a
+    DelayedAction met once it is started and ready."""
+    start = _ContainerStart(srv_id, start_fn)
+    self._executor.Register(start)
+    self._starts[srv_id] = start
+    return start.action
+
+
+  def GetWaves(self):
+    """Returns the planned starts as a list of waves, each a list of
+    _ContainerStart, see DependencyGraph.GetWaves."""
+    return [[self._starts[x] for x in wave]
+            for wave in self._dependency_graph.GetWaves(self._starts)]
+
+
+class ActivationExecutor(object):
+  # Starts the containers of an ActivationPlan in waves on a bounded pool: all
+  # the containers of a wave start at the same time, once the services of the
+  # previous wave are ready. Bringing a service up then takes about the
+  # latency of its longest dependency chain instead of the sum of all of them.
+
+  def __init__(self, num_threads=None, on_start_failed=None):
+    self._pool = concurrent.futures.ThreadPoolExecutor(
+        num_threads or FLAGS.activation_num_threads)
+    # Protects _starts, _latest_starts and the running and cancelled fields of
+    # the starts.
+    self._lock = threading.Lock()
+    # ServiceId to the _ContainerStart not finished yet.
+    self._starts = {}
+    # ServiceId to its last registered _ContainerStart, see IsLatestStart.
+    self._latest_starts = {}
+
+    # Called with the _ContainerStart of a container that could not be
+    # started (not for a cancelled one), so that its service is rolled back.
+    # It runs on a thread of its own, as it waits for the service locks.
+    self._on_start_failed = on_start_failed
+    self._failure_pool = concurrent.futures.ThreadPoolExecutor(1)
+
+
+  def Register(self, start):
+    with self._lock:
+      self._starts[start.service_id] = start
+      self._latest_starts[start.service_id] = start
+
+
+  def IsLatestStart(self, start):
+    """Whether no container start was planned for the same service since
+    start."""
+    with self._lock:
+      return self._latest_starts.get(start.service_id) is start
+
+
+  def Run(self, plan):
+    """Start the containers of the plan, without waiting for them."""
+    previous_future = concurrent.futures.Future()
+    previous_future.set_result(True)
+    for wave in plan.GetWaves():
+      previous_future.add_done_callback(
+          functools.partial(self._StartWave, wave))
+      previous_future = delayed_action.AllOf(
+          [x.action for x in wave]).GetFuture()
+
+
+  def _StartWave(self, wave, previous_future):
+    error = previous_future.exception()
+    for start in wave:
+      if error is None:
+        self._pool.submit(self._RunStart, start)
+      else:
+        self._Finish(start, errors.InternalError(
+            "Not starting {}, a dependency failed: {}".format(
+                start.service_id, error)))
+
+
+  def _RunStart(self, start):
+    with self._lock:
+      if start.cancelled:
+        return
+      start.running = True
+    try:
+      logging.info("Starting container of %s", str(start.service_id))
+      ready_actions = start.start_fn()
+    except Exception as e:
+      logging.error("Cannot start container of %s: %s",
+                    str(start.service_id), str(e))
+      if not isinstance(e, errors.ServiceManagerError):
+        e = errors.InternalError(
+            "Cannot start container of {}: {}".format(start.service_id, e))
+      self._Finish(start, e)
+      return
+    self._Finish(start)
+    delayed_action.AllOf(ready_actions).GetFuture().add_done_callback(
+        lambda future: start.action.Resolve(future.exception() or True))
+
+
+  def _Finish(self, start, error=None):
+    with self._lock:
+      start.running = False
+      if self._starts.get(start.service_id) is start:
+        del self._starts[start.service_id]
+    start.finished.set()
+    if error is not None:
+      start.action.Resolve(error)
+      if self._on_start_failed is not None:
+        self._failure_pool.submit(self._on_start_failed, start)
+
+
+  def Cancel(self, srv_id):
+    """Called before the container of srv_id is stopped. Drops its planned
+    start, or waits for it if it is already starting."""
+    with self._lock:
+      start = self._starts.pop(srv_id, None)
+      if start is None:
+        return
+      if not start.running:
+        start.cancelled = True
+    if start.cancelled:
+      start.finished.set()
+      start.action.Resolve(ActivationCancelledError(
+          "{} was deactivated before its container started.".format(srv_id)))
+    else:
+      start.finished.wait()
@@ -0,0 +1,123 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import activation_executor
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import dependency_graph
+from cogrob.service_manager.model import service_id
+import threading
+
+ServiceId = service_id.ServiceId
+
+
+def _Id(name):
+  return ServiceId(["robot"], name)
+
+
+class ActivationExecutorTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ActivationExecutorTest, self).setUp()
+    self._failed = []
+    self._failed_event = threading.Event()
+    self._executor = activation_executor.ActivationExecutor(
+        num_threads=2, on_start_failed=self._OnStartFailed)
+    self._graph = dependency_graph.DependencyGraph()
+    self._graph.SetDependencies(_Id("a"), [])
+    self._graph.SetDependencies(_Id("b"), [_Id("a")])
+    self._started = []
+
+
+  def _OnStartFailed(self, start):
+    self._failed.append(start.service_id)
+    self._failed_event.set()
+
+
+  def _StartFn(self, name, error=None):
+    def _Start():
+      self._started.append(name)
+      if error is not None:
+        raise error
+      return []
+    return _Start
+
+
+  def testStartsDependenciesFirst(self):
+    plan = activation_executor.ActivationPlan(self._executor, self._graph)
+    action_b = plan.AddStart(_Id("b"), self._StartFn("b"))
+    action_a = plan.AddStart(_Id("a"), self._StartFn("a"))
+    self._executor.Run(plan)
+    self.assertTrue(delayed_action.AllOf([action_a, action_b]).Wait(10))
+    self.assertEqual(["a", "b"], self._started)
+    self.assertEqual([], self._failed)
+
+
+  def testFailureIsReportedToDependents(self):
+    plan = activation_executor.ActivationPlan(self._executor, self._graph)
+    action_a = plan.AddStart(_Id("a"), self._StartFn("a", RuntimeError("x")))
+    action_b = plan.AddStart(_Id("b"), self._StartFn("b"))
+    self._executor.Run(plan)
+    with self.assertRaises(activation_executor.errors.InternalError):
+      action_a.Wait(10)
+    with self.assertRaises(activation_executor.errors.InternalError):
+      action_b.Wait(10)
+    self.assertEqual(["a"], self._started)
+
+
+  def testFailedStartIsRolledBack(self):
+    plan = activation_executor.ActivationPlan(self._executor, self._graph)
+    plan.AddStart(_Id("a"), self._StartFn("a", RuntimeError("x")))
+    self._executor.Run(plan)
+    self.assertTrue(self._failed_event.wait(10))
+    self.assertEqual([_Id("a")], self._failed)
+
+
+  def testCancelDropsPlannedStart(self):
+    plan = activation_executor.ActivationPlan(self._executor, self._graph)
+    action = plan.AddStart(_Id("a"), self._StartFn("a"))
+    self._executor.Cancel(_Id("a"))
+    self._executor.Run(plan)
+    with self.assertRaises(activation_executor.ActivationCancelledError):
+      action.Wait(10)
+    self.assertEqual([], self._started)
+    # A cancelled start is not a failure to roll back.
+    self.assertFalse(self._failed_event.wait(0.1))
+
+
+  def testIsLatestStart(self):
+    first = activation_executor.ActivationPlan(self._executor, self._graph)
+    first.AddStart(_Id("a"), self._StartFn("a"))
+    second = activation_executor.ActivationPlan(self._executor, self._graph)
+    second.AddStart(_Id("a"), self._StartFn("a"))
+    first_start, = first.GetWaves()[0]
+    second_start, = second.GetWaves()[0]
+    self.assertFalse(self._executor.IsLatestStart(first_start))
+    self.assertTrue(self._executor.IsLatestStart(second_start))
+
+
+if __name__ == "__main__":
+  absltest.main()
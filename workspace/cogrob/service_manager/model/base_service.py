@@ -29,6 +29,7 @@ from cogrob.service_manager.model import service_request
 from cogrob.service_manager.proto import service_state_pb2
 from cogrob.service_manager.proto import service_options_pb2
 from cogrob.service_manager.util import errors
+import collections
 
 ServiceId = service_id.ServiceId
 ServiceOptions = service_options_pb2.ServiceOptions
@@ -64,6 +65,15 @@ class BaseService(object):
     # alone is sufficient to construct self.
     self._service_state = None
 
+    # The requests_by_self and requested_by_others of _service_state, which
+    # are kept empty in it and only filled in by ToProto. A request or release
+    # is then a lookup instead of rebuilding the repeated fields, even for a
+    # service with hundreds of requesters. ServiceRequestId to the
+    # ServiceRequest sent by this service, and ServiceRequestId of the
+    # requests of this service (to None), in the order they were sent.
+    self._requests_by_self = collections.OrderedDict()
+    self._requested_by_others = collections.OrderedDict()
+
 
   @staticmethod
   def RestoreFromProto(service_state_pb, manager):
@@ -151,6 +161,10 @@ class BaseService(object):
     """Convert self to service_state_pb2.ServiceState"""
     result = service_state_pb2.ServiceState()
     result.CopyFrom(self._service_state)
+    result.requests_by_self.extend(
+        [x.ToProto() for x in self._requests_by_self.values()])
+    result.requested_by_others.extend(
+        [x.ToProto() for x in self._requested_by_others])
     return result
 
 
@@ -160,13 +174,41 @@ class BaseService(object):
 
 
   def GetStateProto(self):
-    """For derived classes, get self._service_state"""
+    """For derived classes, get self._service_state. Its requests_by_self and
+    requested_by_others are always empty, see GetRequestsBySelf and
+    GetRequestedByOthers."""
     return self._service_state
 
 
   def SetStateProto(self, pb):
     """For derived classes, set self._service_state"""
+    self._requests_by_self = collections.OrderedDict(
+        (ServiceRequestId.FromProto(x.request_id), ServiceRequest.FromProto(x))
+        for x in pb.requests_by_self)
+    if self._manager is not None:
+      if self._service_state is not None:
+        self._manager.UnindexRequester(self.GetServiceId())
+      for request in self._requests_by_self.values():
+        self._manager.IndexRequest(request)
+    self._requested_by_others = collections.OrderedDict(
+        (ServiceRequestId.FromProto(x), None) for x in pb.requested_by_others)
+    pb.ClearField("requests_by_self")
+    pb.ClearField("requested_by_others")
     self._service_state = pb
+    self.MarkStateChanged()
+
+
+  def SetStatus(self, status):
+    """For derived classes, set the status field of self._service_state"""
+    self.GetStateProto().status = status
+    self.MarkStateChanged()
+
+
+  def MarkStateChanged(self):
+    """Let the manager know self._service_state needs to be written to disk.
+    Must be called by anything that mutates self._service_state."""
+    if self._manager is not None and self._service_state is not None:
+      self._manager.MarkServiceChanged(self.GetServiceId())
 
 
   def ActRequestServiceBasic(self, request):
@@ -175,12 +217,7 @@ class BaseService(object):
       raise errors.ServiceNotActiveError(
           "Service {} is not active.".format(self.GetServiceId()))
 
-    filtered_requests_by_self = [
-        x for x in self.GetStateProto().requests_by_self if
-        ServiceRequestId.FromProto(x.request_id) != request.request_id]
-    self.GetStateProto().ClearField("requests_by_self")
-    self.GetStateProto().requests_by_self.extend(filtered_requests_by_self)
-    self.GetStateProto().requests_by_self.extend([request.ToProto()])
+    self._AddRequestBySelf(request)
 
     # The HandleRequestService will return a list of DelayedAction. They are
     # non-blocking. The call handler will either wait for these actions to
@@ -199,20 +236,12 @@ class BaseService(object):
       raise errors.ServiceNotActiveError(
           "Service {} is not active.".format(self.GetServiceId()))
 
-    filtered_requests_by_self = [
-        x for x in self.GetStateProto().requests_by_self
-        if ServiceRequestId.FromProto(x.request_id) != service_request_id]
-    if (len(filtered_requests_by_self)
-        == len(self.GetStateProto().requests_by_self)):
+    service_request = self._requests_by_self.pop(service_request_id, None)
+    if service_request is None:
       raise errors.ServiceRequestNotExistError(
           "Cannot find service request: {}".format(str(service_request_id)))
-
-    service_request = ServiceRequest.FromProto(
-        [x for x in self.GetStateProto().requests_by_self
-         if ServiceRequestId.FromProto(x.request_id) == service_request_id][0])
-
-    self.GetStateProto().ClearField("requests_by_self")
-    self.GetStateProto().requests_by_self.extend(filtered_requests_by_self)
+    self._manager.UnindexRequest(service_request_id)
+    self.MarkStateChanged()
 
     all_delayed_actions = []
     for requested_service in service_request.requested_services:
@@ -225,36 +254,73 @@ class BaseService(object):
   def HandleRequestServiceBasic(self, request):
     # TODO(shengye): We should check if self.GetServiceId() is in request.
     # First, record the request, but not to duplicate the request.
-    filtered_service_req_id = [
-        x for x in self.GetStateProto().requested_by_others
-        if ServiceRequestId.FromProto(x) != request.request_id]
-    self.GetStateProto().ClearField("requested_by_others")
-    self.GetStateProto().requested_by_others.extend(filtered_service_req_id)
-    self.GetStateProto().requested_by_others.extend([
-        request.request_id.ToProto()])
+    self.MarkStateChanged()
+    self._requested_by_others.pop(request.request_id, None)
+    self._requested_by_others[request.request_id] = None
     return self.ActivateSelf()
 
 
   def HandleReleaseServiceBasic(self, service_request_id):
     # First, remove service_request_id from requested_by_others.
-    filtered_service_req_id = [
-        x for x in self.GetStateProto().requested_by_others
-        if ServiceRequestId.FromProto(x) != service_request_id]
-    if (len(filtered_service_req_id) >=
-        len(self.GetStateProto().requested_by_others)):
+    if service_request_id not in self._requested_by_others:
       raise errors.ServiceRequestNotExistError(
           "{} does not exist in {}.".format(service_request_id,
                                             self.GetServiceId()))
-    self.GetStateProto().ClearField("requested_by_others")
-    self.GetStateProto().requested_by_others.extend(filtered_service_req_id)
+    self.MarkStateChanged()
+    del self._requested_by_others[service_request_id]
 
-    if not self.GetStateProto().requested_by_others:
+    if not self._requested_by_others:
       # We can now turn from active to inactive and cancel our request.
       return self.DeactivateSelf()
     else:
       return []
 
 
+  def _AddRequestBySelf(self, request):
+    """For derived classes, record a ServiceRequest sent by this service,
+    replacing the one with the same id."""
+    self._requests_by_self.pop(request.request_id, None)
+    self._requests_by_self[request.request_id] = request
+    if self._manager is not None:
+      self._manager.IndexRequest(request)
+    self.MarkStateChanged()
+
+
+  def _ClearRequestsBySelf(self):
+    """For derived classes, forget all the requests sent by this service."""
+    self._requests_by_self.clear()
+    if self._manager is not None:
+      self._manager.UnindexRequester(self.GetServiceId())
+    self.MarkStateChanged()
+
+
+  def GetRequestBySelf(self, service_request_id):
+    """Returns the ServiceRequest sent by this service with that id, or
+    None."""
+    return self._requests_by_self.get(service_request_id)
+
+
+  def GetRequestsBySelf(self):
+    """Returns the list of ServiceRequest sent by this service."""
+    return list(self._requests_by_self.values())
+
+
+  def GetRequestedByOthers(self):
+    """Returns the list of ServiceRequestId of the requests of this
+    service."""
+    return list(self._requested_by_others)
+
+
+  def GetRequestedServiceIds(self):
+    """Ids of the services this service requests, or would request once
+    activated."""
+    result = [ServiceId.FromProto(x) for x
+              in self.GetStateProto().options.implied_dependencies]
+    for request in self._requests_by_self.values():
+      result.extend(request.requested_services)
+    return result
+
+
   def GetImpliedServiceRequest(self):
     implied_service_ids = [
         ServiceId.FromProto(x) for x
@@ -264,6 +330,12 @@ class BaseService(object):
         implied_service_ids)
 
 
+  def GetSelfMaintainedRequestIds(self):
+    """Returns the ServiceRequestIds of the requests this service sends on its
+    own while it is active, and releases once deactivated."""
+    return [self.GetImpliedServiceRequest().request_id]
+
+
   def IsInSimulation(self):
     if (self.GetStateProto().options.run_mode
         == service_options_pb2.RUN_MODE_SIMULATION):
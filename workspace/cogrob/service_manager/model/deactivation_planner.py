@@ -0,0 +1,122 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.util import errors
+import concurrent.futures
+import math
+import time
+
+flags.DEFINE_integer(
+    "deactivation_num_threads", 16,
+    "Number of containers the deactivation planner stops at the same time.")
+flags.DEFINE_integer(
+    "deactivation_stop_timeout_secs", 10,
+    "Seconds a container has to stop before it is killed.")
+flags.DEFINE_float(
+    "deactivation_deadline_secs", 60,
+    "Seconds all the containers of one deactivation have to stop. Once it "
+    "passes, the remaining containers are killed right away.")
+FLAGS = flags.FLAGS
+
+# docker stop returns a bit after its timeout, once the container is killed.
+_KILL_GRACE_SECS = 5
+
+
+class DeactivationPlan(object):
+  # The containers to stop for one operation, collected while the services
+  # are deactivated (see ServiceManager.DeferContainerStops), and stopped by
+  # DeactivationPlanner.Run once the operation is done.
+
+  def __init__(self, dependency_graph, stop_timeout=None, deadline=None):
+    self._dependency_graph = dependency_graph
+    self._stop_timeout = stop_timeout
+    self._deadline = deadline
+    # ServiceId to the function stopping its container, taking the timeout in
+    # seconds.
+    self._stops = {}
+
+
+  def AddStop(self, srv_id, stop_fn):
+    self._stops[srv_id] = stop_fn
+
+
+  def RemoveStop(self, srv_id):
+    self._stops.pop(srv_id, None)
+
+
+  def GetStopTimeout(self):
+    return self._stop_timeout or FLAGS.deactivation_stop_timeout_secs
+
+
+  def GetDeadline(self):
+    return self._deadline or FLAGS.deactivation_deadline_secs
+
+
+  def GetLevels(self):
+    """Returns the planned stops as a list of levels, each a list of
+    (ServiceId, stop_fn). A service is in a level after those of its
+    dependents."""
+    return [[(x, self._stops[x]) for x in wave] for wave
+            in self._dependency_graph.GetWaves(
+                self._stops, dependents_first=True)]
+
+
+class DeactivationPlanner(object):
+  # Stops the containers of a DeactivationPlan level by level on a bounded
+  # pool, all the containers of a level at the same time. A full shutdown
+  # then takes about the stop latency of the deepest dependency chain
+  # instead of the sum of all of them.
+
+  def __init__(self, num_threads=None):
+    self._pool = concurrent.futures.ThreadPoolExecutor(
+        num_threads or FLAGS.deactivation_num_threads)
+
+
+  def Run(self, plan):
+    """Stop the containers of the plan and wait for them. Returns a list of
+    (ServiceId, error) for those that failed to stop."""
+    deadline = time.time() + plan.GetDeadline()
+    failures = []
+    for level in plan.GetLevels():
+      # docker only takes whole seconds.
+      timeout = min(plan.GetStopTimeout(),
+                    int(math.ceil(max(0, deadline - time.time()))))
+      level_futures = [(srv_id, self._pool.submit(stop_fn, timeout))
+                       for srv_id, stop_fn in level]
+      concurrent.futures.wait(
+          [x for _, x in level_futures],
+          max(0, deadline - time.time()) + _KILL_GRACE_SECS)
+      for srv_id, future in level_futures:
+        if not future.done():
+          failures.append((srv_id, errors.DeadlineExceededError(
+              "{} did not stop before the deadline.".format(srv_id))))
+        elif future.exception() is not None:
+          failures.append((srv_id, future.exception()))
+    for srv_id, error in failures:
+      logging.error("Cannot stop container of %s: %s", str(srv_id), str(error))
+    return failures
@@ -0,0 +1,131 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import deactivation_planner
+from cogrob.service_manager.model import dependency_graph
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.util import errors
+import threading
+import time
+
+ServiceId = service_id.ServiceId
+
+
+def _Id(name):
+  return ServiceId(["robot"], name)
+
+
+class DeactivationPlannerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(DeactivationPlannerTest, self).setUp()
+    # app and tool depend on lib, which depends on base.
+    self._graph = dependency_graph.DependencyGraph()
+    self._graph.SetDependencies(_Id("lib"), [_Id("base")])
+    self._graph.SetDependencies(_Id("app"), [_Id("lib")])
+    self._graph.SetDependencies(_Id("tool"), [_Id("lib")])
+    self._planner = deactivation_planner.DeactivationPlanner(num_threads=4)
+    self._lock = threading.Lock()
+    # (name, timeout) of the stops, in the order they started.
+    self._stops = []
+
+
+  def _MakeStop(self, name, duration=0, error=None, started=None,
+                wait_for=None):
+    """Returns a stop_fn that records its call, then waits for the event
+    wait_for or sleeps duration seconds, and raises error if any."""
+    def _Stop(timeout):
+      with self._lock:
+        self._stops.append((name, timeout))
+      if started is not None:
+        started.set()
+      if wait_for is not None:
+        wait_for.wait(10)
+      time.sleep(duration)
+      if error is not None:
+        raise error
+    return _Stop
+
+
+  def _MakePlan(self, names, **kwargs):
+    plan = deactivation_planner.DeactivationPlan(self._graph, **kwargs)
+    for name in names:
+      plan.AddStop(_Id(name), self._MakeStop(name))
+    return plan
+
+
+  def testStopsDependentsFirst(self):
+    plan = self._MakePlan(["base", "lib", "app"], stop_timeout=3)
+    # tool waits for app, they are stopped at the same time.
+    app_started = threading.Event()
+    plan.AddStop(_Id("app"), self._MakeStop("app", started=app_started))
+    plan.AddStop(_Id("tool"), self._MakeStop("tool", wait_for=app_started))
+    plan.AddStop(_Id("gone"), self._MakeStop("gone"))
+    plan.RemoveStop(_Id("gone"))
+    self.assertEqual(
+        [set(["app", "tool"]), set(["lib"]), set(["base"])],
+        [set(x.name for x, _ in level) for level in plan.GetLevels()])
+
+    self.assertEqual([], self._planner.Run(plan))
+    self.assertEqual(set(["app", "tool"]), set(x for x, _ in self._stops[:2]))
+    self.assertEqual(["lib", "base"], [x for x, _ in self._stops[2:]])
+    self.assertEqual([3] * 4, [x for _, x in self._stops])
+
+
+  def testReportsFailures(self):
+    plan = self._MakePlan(["base", "lib"])
+    error = RuntimeError("Cannot stop.")
+    plan.AddStop(_Id("lib"), self._MakeStop("lib", error=error))
+    self.assertEqual([(_Id("lib"), error)], self._planner.Run(plan))
+    # The dependencies are stopped anyway.
+    self.assertEqual(["lib", "base"], [x for x, _ in self._stops])
+
+
+  def testDeadlineKillsRemaining(self):
+    plan = self._MakePlan(["base", "lib"], stop_timeout=10, deadline=0.5)
+    plan.AddStop(_Id("lib"), self._MakeStop("lib", duration=0.6))
+    self.assertEqual([], self._planner.Run(plan))
+    # lib has what is left of the deadline, base is killed right away.
+    self.assertEqual([("lib", 1), ("base", 0)], self._stops)
+
+
+  def testStopPastDeadline(self):
+    self.addCleanup(setattr, deactivation_planner, "_KILL_GRACE_SECS",
+                    deactivation_planner._KILL_GRACE_SECS)
+    deactivation_planner._KILL_GRACE_SECS = 0.2
+    release = threading.Event()
+    self.addCleanup(release.set)
+    plan = self._MakePlan(["base", "lib"], deadline=0.1)
+    plan.AddStop(_Id("lib"), self._MakeStop("lib", wait_for=release))
+    failures = self._planner.Run(plan)
+    self.assertEqual([_Id("lib")], [x for x, _ in failures])
+    self.assertIsInstance(failures[0][1], errors.DeadlineExceededError)
+    self.assertEqual([("lib", 1), ("base", 0)], self._stops)
+
+
+if __name__ == "__main__":
+  absltest.main()
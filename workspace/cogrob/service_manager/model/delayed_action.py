@@ -26,14 +26,104 @@
 
 from cogrob.service_manager.model import service_id
 from cogrob.service_manager.proto import delayed_action_pb2
+from cogrob.service_manager.util import errors
+import concurrent.futures
+import heapq
+import itertools
 import math
+import threading
 import time
 
+
+class ReadyTimeoutError(errors.InternalError):
+  def __init__(self, message="Timed out waiting for a service to be ready."):
+    super(ReadyTimeoutError, self).__init__(message)
+
+
+class _TimerScheduler(object):
+  # Runs callbacks at given timestamps, all of them from one thread that sleeps
+  # until the earliest one.
+
+  def __init__(self):
+    self._cond = threading.Condition()
+    self._heap = []
+    # Breaks ties in the heap, callbacks are not comparable.
+    self._counter = itertools.count()
+    self._thread = None
+
+
+  def CallAt(self, timestamp, callback):
+    with self._cond:
+      heapq.heappush(self._heap, (timestamp, next(self._counter), callback))
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._SchedulerThread)
+        self._thread.daemon = True
+        self._thread.start()
+      # Only wake the thread up if its next wake-up changed.
+      if self._heap[0][2] is callback:
+        self._cond.notify()
+
+
+  def _SchedulerThread(self):
+    while True:
+      with self._cond:
+        while not self._heap or self._heap[0][0] > time.time():
+          self._cond.wait(self._heap[0][0] - time.time()
+                          if self._heap else None)
+        _, _, callback = heapq.heappop(self._heap)
+      callback()
+
+
+_scheduler = _TimerScheduler()
+
+
 class DelayedAction(object):
+  # A condition to be met before a service is ready, backed by a
+  # concurrent.futures.Future that is resolved once it is met. Waiting on it
+  # does not poll.
+
+  def __init__(self):
+    self._future = concurrent.futures.Future()
+    # Set by the first _Resolve, the future is only resolved once.
+    self._resolved = False
+    self._resolve_lock = threading.Lock()
+
+
+  def _Resolve(self, result=True):
+    # A composite action can be resolved by several of its actions, only the
+    # first one counts. The callbacks of the future (which resolve other
+    # actions) run on this thread, without holding any lock.
+    with self._resolve_lock:
+      if self._resolved:
+        return
+      self._resolved = True
+    if isinstance(result, Exception):
+      self._future.set_exception(result)
+    else:
+      self._future.set_result(result)
+
+
+  def GetFuture(self):
+    return self._future
 
-  def Wait(self):
-    raise NotImplementedError(
-        "Wait in DelayedAction must be override by derived class")
+
+  def IsDone(self):
+    return self._future.done()
+
+
+  def Wait(self, timeout=None):
+    """Wait until the condition is met, at most timeout seconds (forever if
+    None). Returns True if it is met, raises the error of a failed action."""
+    try:
+      self._future.result(timeout)
+    except concurrent.futures.TimeoutError:
+      return False
+    return True
+
+
+  def GetLeafActions(self):
+    """The actions that are not composed of other actions."""
+    return [self]
 
 
   def ToProto(self):
@@ -41,11 +131,22 @@ class DelayedAction(object):
         "ToProto in DelayedAction must be override by derived class")
 
 
+# ServiceId to the list of WaitForServiceHeartbeat waiting for it.
+_heartbeat_actions = {}
+_heartbeat_actions_lock = threading.Lock()
+
+
 class WaitForServiceHeartbeat(DelayedAction):
+  # Met once the service reports a heartbeat (the ServiceHeartbeat RPC), used
+  # by the wait_for_prober ReadyDetectionMethod. Create it before starting the
+  # service, a heartbeat only meets the actions already waiting for it.
 
   def __init__(self, srv_id):
+    super(WaitForServiceHeartbeat, self).__init__()
     assert(isinstance(srv_id, service_id.ServiceId))
     self._service_id = srv_id
+    with _heartbeat_actions_lock:
+      _heartbeat_actions.setdefault(srv_id, []).append(self)
 
 
   def GetServiceId(self):
@@ -54,28 +155,141 @@ class WaitForServiceHeartbeat(DelayedAction):
 
   def ToProto(self):
     result = delayed_action_pb2.DelayedAction()
-    result.service_to_wait.CopyFrom(self._service_id)
+    result.wait_service.service_to_wait.CopyFrom(self._service_id.ToProto())
+    return result
+
+
+def NotifyServiceHeartbeat(srv_id, result=True):
+  """Meet all the WaitForServiceHeartbeat of a service, or fail them if result
+  is an exception. Returns the number of actions resolved."""
+  with _heartbeat_actions_lock:
+    actions = _heartbeat_actions.pop(srv_id, [])
+  for action in actions:
+    action._Resolve(result)
+  return len(actions)
+
+
+class WaitForActivation(DelayedAction):
+  # Met once the activation executor started the container of the service and
+  # the service is ready, see activation_executor.
+
+  def __init__(self, srv_id):
+    super(WaitForActivation, self).__init__()
+    assert(isinstance(srv_id, service_id.ServiceId))
+    self._service_id = srv_id
+
+
+  def GetServiceId(self):
+    return self._service_id
+
+
+  def Resolve(self, result=True):
+    """Meet the action, or fail it if result is an exception."""
+    self._Resolve(result)
+
+
+  def ToProto(self):
+    result = delayed_action_pb2.DelayedAction()
+    result.wait_activation.service_to_wait.CopyFrom(self._service_id.ToProto())
     return result
 
 
 class WaitUntilTimestamp(DelayedAction):
 
   def __init__(self, timestamp):
+    super(WaitUntilTimestamp, self).__init__()
     self._timestamp = timestamp
+    _scheduler.CallAt(timestamp, self._Resolve)
 
 
   def GetTimestamp(self):
     return self._timestamp
 
 
-  def Wait(self):
-    if time.time() < self._timestamp:
-      time.sleep(0.25)
-
-
   def ToProto(self):
     result = delayed_action_pb2.DelayedAction()
     result.wait_timestamp.timestamp.seconds = int(math.floor(self._timestamp))
     result.wait_timestamp.timestamp.nanos = int(
         (self._timestamp - result.wait_timestamp.timestamp.seconds) * 1e9)
     return result
+
+
+class _CompositeAction(DelayedAction):
+
+  def __init__(self, actions):
+    super(_CompositeAction, self).__init__()
+    self._actions = list(actions)
+
+
+  def GetLeafActions(self):
+    result = []
+    for action in self._actions:
+      result += action.GetLeafActions()
+    return result
+
+
+class AllOf(_CompositeAction):
+  # Met once all the actions are met, fails as soon as one of them fails.
+
+  def __init__(self, actions):
+    super(AllOf, self).__init__(actions)
+    self._num_pending = len(self._actions)
+    self._lock = threading.Lock()
+    if not self._actions:
+      self._Resolve()
+    for action in self._actions:
+      action.GetFuture().add_done_callback(self._OnActionDone)
+
+
+  def _OnActionDone(self, future):
+    if future.exception() is not None:
+      self._Resolve(future.exception())
+      return
+    with self._lock:
+      self._num_pending -= 1
+      all_done = self._num_pending == 0
+    if all_done:
+      self._Resolve()
+
+
+class AnyOf(_CompositeAction):
+  # Met as soon as one of the actions is met, fails if all of them fail.
+
+  def __init__(self, actions):
+    super(AnyOf, self).__init__(actions)
+    assert self._actions, "AnyOf needs at least one action."
+    self._num_pending = len(self._actions)
+    self._lock = threading.Lock()
+    for action in self._actions:
+      action.GetFuture().add_done_callback(self._OnActionDone)
+
+
+  def _OnActionDone(self, future):
+    if future.exception() is None:
+      self._Resolve()
+      return
+    with self._lock:
+      self._num_pending -= 1
+      all_failed = self._num_pending == 0
+    if all_failed:
+      self._Resolve(future.exception())
+
+
+class WithTimeout(_CompositeAction):
+  # Met when the action is met, fails with ReadyTimeoutError if that takes more
+  # than timeout seconds.
+
+  def __init__(self, action, timeout):
+    super(WithTimeout, self).__init__([action])
+    self._timeout = timeout
+    action.GetFuture().add_done_callback(self._OnActionDone)
+    _scheduler.CallAt(time.time() + timeout, self._OnTimeout)
+
+
+  def _OnActionDone(self, future):
+    self._Resolve(future.exception() or True)
+
+
+  def _OnTimeout(self):
+    self._Resolve(ReadyTimeoutError(
+        "Not ready after {} seconds.".format(self._timeout)))
@@ -0,0 +1,171 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import service_id
+import time
+
+ServiceId = service_id.ServiceId
+
+
+def _MakeActivation(name):
+  return delayed_action.WaitForActivation(ServiceId(["robot"], name))
+
+
+class DelayedActionTest(absltest.TestCase):
+
+  def testWaitUntilTimestamp(self):
+    action = delayed_action.WaitUntilTimestamp(time.time() + 0.05)
+    self.assertFalse(action.IsDone())
+    self.assertTrue(action.Wait(10))
+    self.assertTrue(delayed_action.WaitUntilTimestamp(time.time()).Wait(10))
+
+
+  def testWaitTimesOut(self):
+    self.assertFalse(_MakeActivation("a").Wait(0.01))
+
+
+  def testOnlyFirstResolveCounts(self):
+    action = _MakeActivation("a")
+    action.Resolve(RuntimeError("Cannot start."))
+    action.Resolve()
+    with self.assertRaises(RuntimeError):
+      action.Wait(0)
+
+
+  def testCallbacksRunWithoutLock(self):
+    action = _MakeActivation("a")
+    other = _MakeActivation("b")
+    # Resolving again from a callback must neither deadlock nor count.
+    action.GetFuture().add_done_callback(lambda _: action.Resolve(False))
+    action.GetFuture().add_done_callback(lambda _: other.Resolve())
+    action.Resolve()
+    self.assertTrue(action.GetFuture().result(0))
+    self.assertTrue(other.Wait(0))
+
+
+  def testAllOf(self):
+    actions = [_MakeActivation("a"), _MakeActivation("b")]
+    all_of = delayed_action.AllOf(actions)
+    actions[0].Resolve()
+    self.assertFalse(all_of.IsDone())
+    actions[1].Resolve()
+    self.assertTrue(all_of.Wait(0))
+    self.assertTrue(delayed_action.AllOf([]).Wait(0))
+
+
+  def testAllOfFailsOnFirstFailure(self):
+    actions = [_MakeActivation("a"), _MakeActivation("b")]
+    all_of = delayed_action.AllOf(actions)
+    actions[1].Resolve(RuntimeError("Cannot start."))
+    with self.assertRaises(RuntimeError):
+      all_of.Wait(0)
+    actions[0].Resolve()
+
+
+  def testAnyOf(self):
+    actions = [_MakeActivation("a"), _MakeActivation("b")]
+    any_of = delayed_action.AnyOf(actions)
+    actions[0].Resolve(RuntimeError("Cannot start."))
+    self.assertFalse(any_of.IsDone())
+    actions[1].Resolve()
+    self.assertTrue(any_of.Wait(0))
+
+
+  def testAnyOfFailsWhenAllFail(self):
+    actions = [_MakeActivation("a"), _MakeActivation("b")]
+    any_of = delayed_action.AnyOf(actions)
+    actions[0].Resolve(RuntimeError("Cannot start."))
+    actions[1].Resolve(ValueError("Cannot start."))
+    with self.assertRaises(ValueError):
+      any_of.Wait(0)
+
+
+  def testWithTimeout(self):
+    action = _MakeActivation("a")
+    with_timeout = delayed_action.WithTimeout(action, 10)
+    action.Resolve()
+    self.assertTrue(with_timeout.Wait(0))
+
+    action = _MakeActivation("b")
+    with_timeout = delayed_action.WithTimeout(action, 0.05)
+    with self.assertRaises(delayed_action.ReadyTimeoutError):
+      with_timeout.Wait(10)
+    # Met too late.
+    action.Resolve()
+    with self.assertRaises(delayed_action.ReadyTimeoutError):
+      with_timeout.Wait(0)
+
+
+  def testWithTimeoutPassesFailure(self):
+    action = _MakeActivation("a")
+    with_timeout = delayed_action.WithTimeout(action, 10)
+    action.Resolve(RuntimeError("Cannot start."))
+    with self.assertRaises(RuntimeError):
+      with_timeout.Wait(0)
+
+
+  def testServiceHeartbeat(self):
+    srv_id = ServiceId(["robot"], "a")
+    actions = [delayed_action.WaitForServiceHeartbeat(srv_id),
+               delayed_action.WaitForServiceHeartbeat(srv_id)]
+    other = delayed_action.WaitForServiceHeartbeat(ServiceId(["robot"], "b"))
+    self.assertFalse(actions[0].IsDone())
+    self.assertEqual(2, delayed_action.NotifyServiceHeartbeat(srv_id))
+    self.assertTrue(actions[0].Wait(0))
+    self.assertTrue(actions[1].Wait(0))
+    self.assertFalse(other.IsDone())
+    # Only the actions already waiting are met.
+    self.assertEqual(0, delayed_action.NotifyServiceHeartbeat(srv_id))
+    self.assertEqual(1, delayed_action.NotifyServiceHeartbeat(
+        other.GetServiceId(), RuntimeError("Deactivated.")))
+    with self.assertRaises(RuntimeError):
+      other.Wait(0)
+
+
+  def testGetLeafActions(self):
+    actions = [_MakeActivation("a"), _MakeActivation("b")]
+    timestamp = delayed_action.WaitUntilTimestamp(time.time())
+    nested = delayed_action.AllOf(
+        [delayed_action.AllOf(actions), timestamp])
+    self.assertEqual(actions + [timestamp], nested.GetLeafActions())
+
+
+  def testToProto(self):
+    pb = _MakeActivation("a").ToProto()
+    self.assertEqual("a", pb.wait_activation.service_to_wait.name)
+    pb = delayed_action.WaitForServiceHeartbeat(
+        ServiceId(["robot"], "a")).ToProto()
+    self.assertEqual("a", pb.wait_service.service_to_wait.name)
+    delayed_action.NotifyServiceHeartbeat(ServiceId(["robot"], "a"))
+    pb = delayed_action.WaitUntilTimestamp(12.5).ToProto()
+    self.assertEqual(12, pb.wait_timestamp.timestamp.seconds)
+    self.assertEqual(500000000, pb.wait_timestamp.timestamp.nanos)
+
+
+if __name__ == "__main__":
+  absltest.main()
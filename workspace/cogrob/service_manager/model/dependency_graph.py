@@ -0,0 +1,267 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import logging
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.util import errors
+import heapq
+import threading
+
+ServiceId = service_id.ServiceId
+
+
+def _SortKey(srv_id):
+  return (srv_id.namespace, srv_id.name)
+
+
+def GetStaticDependencies(options):
+  """Returns the ids of the services a service with these
+  service_options_pb2.ServiceOptions always requests once active: its implied
+  dependencies, and the grouped services of a group."""
+  result = set(ServiceId.FromProto(x) for x in options.implied_dependencies)
+  if options.type == service_options_pb2.SERVICE_TYPE_GROUP:
+    result.update(ServiceId.FromProto(x) for x
+                  in options.group_service_options.grouped_services)
+  return frozenset(result)
+
+
+class DependencyGraph(object):
+  # The static dependencies between the services, updated incrementally as
+  # the services are added, updated and removed. A dependency may be a
+  # service that does not exist (yet). The transitive dependencies and the
+  # topological order of all services are computed on first use and cached
+  # until an edge they depend on changes. Thread-safe.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # ServiceId to the frozenset of ServiceIds it depends on, and the reverse.
+    self._dependencies = {}
+    self._dependents = {}
+
+    # Caches, see _Invalidate.
+    self._transitive_dependencies = {}
+    self._topological_order = None
+
+
+  def _FindPath(self, from_id, to_id):
+    """Returns a list of ServiceIds from from_id to to_id following the
+    dependencies, or None."""
+    parents = {from_id: None}
+    pending = [from_id]
+    while pending:
+      srv_id = pending.pop()
+      if srv_id == to_id:
+        path = []
+        while srv_id is not None:
+          path.append(srv_id)
+          srv_id = parents[srv_id]
+        return list(reversed(path))
+      for dep_id in self._dependencies.get(srv_id, ()):
+        if dep_id not in parents:
+          parents[dep_id] = srv_id
+          pending.append(dep_id)
+    return None
+
+
+  def _CheckNoCycle(self, srv_id, dependencies):
+    for dep_id in sorted(dependencies, key=_SortKey):
+      if (dep_id == srv_id or
+          srv_id in self._GetTransitiveDependencies(dep_id)):
+        path = [srv_id] + self._FindPath(dep_id, srv_id)
+        raise errors.DependencyCycleError(
+            "Dependencies of {} would form a cycle: {}.".format(
+                srv_id, " -> ".join(str(x) for x in path)))
+
+
+  def _Invalidate(self, srv_id):
+    """Drops the cached results that srv_id could be part of: those of itself
+    and of everything that depends on it."""
+    self._topological_order = None
+    pending = [srv_id]
+    visited = set()
+    while pending:
+      node_id = pending.pop()
+      if node_id in visited:
+        continue
+      visited.add(node_id)
+      self._transitive_dependencies.pop(node_id, None)
+      pending.extend(self._dependents.get(node_id, ()))
+
+
+  def _SetDependencies(self, srv_id, dependencies):
+    old_dependencies = self._dependencies.get(srv_id, frozenset())
+    if old_dependencies == dependencies:
+      return
+    self._Invalidate(srv_id)
+    for dep_id in old_dependencies - dependencies:
+      self._dependents[dep_id].discard(srv_id)
+      if not self._dependents[dep_id]:
+        del self._dependents[dep_id]
+    for dep_id in dependencies - old_dependencies:
+      self._dependents.setdefault(dep_id, set()).add(srv_id)
+    if dependencies:
+      self._dependencies[srv_id] = dependencies
+    else:
+      self._dependencies.pop(srv_id, None)
+
+
+  def CheckDependencies(self, srv_id, dependencies):
+    """Raises errors.DependencyCycleError if srv_id depending on dependencies
+    would form a cycle, without changing anything."""
+    with self._lock:
+      self._CheckNoCycle(srv_id, frozenset(dependencies))
+
+
+  def SetDependencies(self, srv_id, dependencies, check=True):
+    """Replaces the dependencies of srv_id. Raises errors.DependencyCycleError
+    (and changes nothing) if that would form a cycle, unless check is False,
+    e.g. to restore what is already on the disk."""
+    dependencies = frozenset(dependencies)
+    with self._lock:
+      if check:
+        self._CheckNoCycle(srv_id, dependencies)
+      self._SetDependencies(srv_id, dependencies)
+
+
+  def RemoveService(self, srv_id):
+    """Drops the dependencies of srv_id. It stays in the graph as long as
+    other services depend on it."""
+    with self._lock:
+      self._SetDependencies(srv_id, frozenset())
+
+
+  def GetDependencies(self, srv_id):
+    """Returns the frozenset of ServiceIds srv_id directly depends on."""
+    with self._lock:
+      return self._dependencies.get(srv_id, frozenset())
+
+
+  def _GetTransitiveDependencies(self, srv_id):
+    result = self._transitive_dependencies.get(srv_id)
+    if result is not None:
+      return result
+    visited = set()
+    pending = list(self._dependencies.get(srv_id, ()))
+    while pending:
+      dep_id = pending.pop()
+      if dep_id in visited:
+        continue
+      cached = self._transitive_dependencies.get(dep_id)
+      if cached is not None:
+        visited.add(dep_id)
+        visited.update(cached)
+      else:
+        visited.add(dep_id)
+        pending.extend(self._dependencies.get(dep_id, ()))
+    result = frozenset(visited)
+    self._transitive_dependencies[srv_id] = result
+    return result
+
+
+  def GetTransitiveDependencies(self, srv_id):
+    """Returns the frozenset of ServiceIds srv_id depends on, directly or
+    not."""
+    with self._lock:
+      return self._GetTransitiveDependencies(srv_id)
+
+
+  def _TopologicalSort(self, nodes):
+    """Returns the ServiceIds of nodes (a set), every one after those of its
+    dependencies that are in nodes. Ties are broken by id, so the order is
+    stable."""
+    num_pending_deps = dict(
+        (x, len(self._dependencies.get(x, frozenset()) & nodes))
+        for x in nodes)
+    ready = [(_SortKey(x), x) for x in nodes if not num_pending_deps[x]]
+    heapq.heapify(ready)
+    result = []
+    while ready:
+      _, srv_id = heapq.heappop(ready)
+      result.append(srv_id)
+      for dependent_id in self._dependents.get(srv_id, ()):
+        if dependent_id not in nodes:
+          continue
+        num_pending_deps[dependent_id] -= 1
+        if not num_pending_deps[dependent_id]:
+          heapq.heappush(ready, (_SortKey(dependent_id), dependent_id))
+    if len(result) < len(nodes):
+      # Only possible with unchecked dependencies (e.g. restored from the
+      # disk), put the cycles last.
+      in_cycles = sorted(nodes - set(result), key=_SortKey)
+      logging.warning("Dependency cycle between: %s",
+                      ", ".join(str(x) for x in in_cycles))
+      result.extend(in_cycles)
+    return tuple(result)
+
+
+  def GetTopologicalOrder(self):
+    """Returns a tuple of all the ServiceIds in the graph, every service after
+    its dependencies."""
+    with self._lock:
+      if self._topological_order is None:
+        self._topological_order = self._TopologicalSort(
+            set(self._dependencies) | set(self._dependents))
+      return self._topological_order
+
+
+  def GetWaves(self, service_ids, dependents_first=False):
+    """Groups service_ids in waves: returns a list of lists of ServiceIds,
+    each service in the wave after the last one containing its dependencies
+    among service_ids, including those it only depends on through services
+    that are not in service_ids. Activating the waves in order respects the
+    dependencies. With dependents_first, each service is in the wave after
+    the last one containing its dependents instead, for deactivating."""
+    service_ids = set(service_ids)
+    with self._lock:
+      # ServiceId to the ones among service_ids that must be in earlier waves.
+      predecessors = dict(
+          (x, self._GetTransitiveDependencies(x) & service_ids)
+          for x in service_ids)
+      if dependents_first:
+        dependents = dict((x, set()) for x in service_ids)
+        for srv_id, dep_ids in predecessors.items():
+          for dep_id in dep_ids:
+            dependents[dep_id].add(srv_id)
+        predecessors = dependents
+
+      waves_of = {}
+      def _GetWave(srv_id):
+        if srv_id not in waves_of:
+          # Guards against the cycles restored from the disk.
+          waves_of[srv_id] = 0
+          waves_of[srv_id] = 1 + max(
+              [_GetWave(x) for x in predecessors[srv_id] if x != srv_id]
+              or [-1])
+        return waves_of[srv_id]
+
+      result = []
+      for srv_id in sorted(service_ids, key=_SortKey):
+        wave = _GetWave(srv_id)
+        while len(result) <= wave:
+          result.append([])
+        result[wave].append(srv_id)
+      return result
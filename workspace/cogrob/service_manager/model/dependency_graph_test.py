@@ -0,0 +1,130 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import dependency_graph
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.util import errors
+
+ServiceId = service_id.ServiceId
+
+
+def _Id(name):
+  return ServiceId(["robot"], name)
+
+
+def _Ids(names):
+  return [_Id(x) for x in names]
+
+
+def _Names(srv_ids):
+  return [x.name for x in srv_ids]
+
+
+class DependencyGraphTest(absltest.TestCase):
+
+  def setUp(self):
+    super(DependencyGraphTest, self).setUp()
+    # d -> c -> b -> a, and d -> a.
+    self._graph = dependency_graph.DependencyGraph()
+    self._graph.SetDependencies(_Id("b"), _Ids(["a"]))
+    self._graph.SetDependencies(_Id("c"), _Ids(["b"]))
+    self._graph.SetDependencies(_Id("d"), _Ids(["c", "a"]))
+
+
+  def testRejectsCycles(self):
+    with self.assertRaises(errors.DependencyCycleError):
+      self._graph.SetDependencies(_Id("a"), _Ids(["a"]))
+    with self.assertRaisesRegexp(errors.DependencyCycleError,
+                                 "robot:a -> robot:d -> robot:a"):
+      self._graph.SetDependencies(_Id("a"), _Ids(["d"]))
+    with self.assertRaises(errors.DependencyCycleError):
+      self._graph.CheckDependencies(_Id("a"), _Ids(["b"]))
+    # Nothing changed.
+    self.assertEqual(frozenset(), self._graph.GetDependencies(_Id("a")))
+    self._graph.CheckDependencies(_Id("a"), _Ids(["e"]))
+    self.assertEqual(frozenset(), self._graph.GetDependencies(_Id("a")))
+
+
+  def testTransitiveDependenciesFollowUpdates(self):
+    self.assertEqual(frozenset(_Ids(["a", "b", "c"])),
+                     self._graph.GetTransitiveDependencies(_Id("d")))
+    self._graph.SetDependencies(_Id("b"), _Ids(["e"]))
+    self.assertEqual(frozenset(_Ids(["a", "b", "c", "e"])),
+                     self._graph.GetTransitiveDependencies(_Id("d")))
+    self._graph.RemoveService(_Id("c"))
+    self.assertEqual(frozenset(_Ids(["a", "c"])),
+                     self._graph.GetTransitiveDependencies(_Id("d")))
+
+
+  def testTopologicalOrder(self):
+    self._graph.SetDependencies(_Id("x"), [])
+    self.assertEqual(["a", "b", "c", "d"],
+                     _Names(self._graph.GetTopologicalOrder()))
+    # The cached order follows the changes.
+    self._graph.SetDependencies(_Id("a"), _Ids(["e"]))
+    self.assertEqual(["e", "a", "b", "c", "d"],
+                     _Names(self._graph.GetTopologicalOrder()))
+
+
+  def testCyclesFromDiskAreTolerated(self):
+    self._graph.SetDependencies(_Id("a"), _Ids(["d"]), check=False)
+    self.assertEqual(set(_Ids(["a", "b", "c", "d"])),
+                     set(self._graph.GetTopologicalOrder()))
+    self.assertEqual(["a", "d"],
+                     sorted(_Names(sum(self._graph.GetWaves(_Ids(["a", "d"])),
+                                       []))))
+
+
+  def testWaves(self):
+    self._graph.SetDependencies(_Id("e"), _Ids(["a"]))
+    waves = self._graph.GetWaves(_Ids(["a", "b", "c", "d", "e"]))
+    self.assertEqual([["a"], ["b", "e"], ["c"], ["d"]],
+                     [_Names(x) for x in waves])
+    # d depends on b through c, which is not part of the waves.
+    waves = self._graph.GetWaves(_Ids(["b", "d", "e"]))
+    self.assertEqual([["b", "e"], ["d"]], [_Names(x) for x in waves])
+    waves = self._graph.GetWaves(_Ids(["b", "d", "e"]), dependents_first=True)
+    self.assertEqual([["d", "e"], ["b"]], [_Names(x) for x in waves])
+    self.assertEqual([], self._graph.GetWaves([]))
+
+
+  def testGetStaticDependencies(self):
+    options = service_options_pb2.ServiceOptions()
+    options.type = service_options_pb2.SERVICE_TYPE_GROUP
+    options.implied_dependencies.extend([_Id("a").ToProto()])
+    options.group_service_options.grouped_services.extend(
+        [_Id("b").ToProto()])
+    self.assertEqual(frozenset(_Ids(["a", "b"])),
+                     dependency_graph.GetStaticDependencies(options))
+    options.type = service_options_pb2.SERVICE_TYPE_DOCKER
+    self.assertEqual(frozenset(_Ids(["a"])),
+                     dependency_graph.GetStaticDependencies(options))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -40,9 +40,33 @@ class DockerClientInterface(object):
         str(type(self)))
 
 
+  def ListContainers(self, name_prefix):
+    # Returns all containers (including stopped ones) whose name starts with
+    # name_prefix.
+    raise NotImplementedError(
+        "ListContainers in DockerClientInterface not implemented in {}",
+        str(type(self)))
+
+
 class DockerContainerInterface(object):
   # Can be a real one (backed by docker-py) or a mocked instance.
 
+  def GetId(self):
+    raise NotImplementedError(
+        "GetId in DockerInterface not implemented in {}", str(type(self)))
+
+
+  def GetName(self):
+    raise NotImplementedError(
+        "GetName in DockerInterface not implemented in {}", str(type(self)))
+
+
+  def GetStatus(self):
+    # Returns the docker status string, e.g. "running", "exited", etc.
+    raise NotImplementedError(
+        "GetStatus in DockerInterface not implemented in {}", str(type(self)))
+
+
   def Start(self, *args, **kwargs):
     raise NotImplementedError(
         "Start in DockerInterface not implemented in {}", str(type(self)))
@@ -26,7 +26,9 @@
 
 from absl import logging
 from cogrob.service_manager.model import docker_interface
-import docker
+
+# docker-py is imported lazily: it is slow to import and not needed by
+# simulated services or the CLI tools.
 
 class DockerContainer(docker_interface.DockerContainerInterface):
 
@@ -35,6 +37,18 @@ class DockerContainer(docker_interface.DockerContainerInterface):
     self._docker_py_container = docker_py_container
 
 
+  def GetId(self):
+    return self._docker_py_container.id
+
+
+  def GetName(self):
+    return self._docker_py_container.name
+
+
+  def GetStatus(self):
+    return self._docker_py_container.status
+
+
   def Start(self, *args, **kwargs):
     return self._docker_py_container.start(*args, **kwargs)
 
@@ -59,6 +73,7 @@ class DockerClient(docker_interface.DockerClientInterface):
 
   def __init__(self):
     # TODO(shengye): Accepts a docker-py client as an argument.
+    import docker
     self._docker_py_client = docker.from_env()
 
 
@@ -77,7 +92,15 @@ class DockerClient(docker_interface.DockerClientInterface):
         self._docker_py_client.containers.create(*args, **kwargs))
 
 
+  def ListContainers(self, name_prefix):
+    # The name filter of the docker daemon matches substrings.
+    return [DockerContainer(x) for x in self._docker_py_client.containers.list(
+                all=True, filters={"name": name_prefix})
+            if x.name.startswith(name_prefix)]
+
+
   def TestOrPullImage(self, image_tag, force_pull=True):
+    import docker
     if ":" not in image_tag:
       image_tag += ":latest"
 
@@ -96,6 +119,12 @@ class DockerClient(docker_interface.DockerClientInterface):
       logging.info("Pulled image: %s", image_tag)
 
 
+def IsNotFoundError(e):
+  """Whether e is a docker-py error of a missing container/image."""
+  import docker
+  return isinstance(e, docker.errors.NotFound)
+
+
 def GetGlobalDockerClient():
   if not hasattr(GetGlobalDockerClient, "_inst"):
     GetGlobalDockerClient._inst = DockerClient()
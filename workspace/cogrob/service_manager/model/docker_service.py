@@ -36,9 +36,9 @@ from cogrob.service_manager.proto import service_options_pb2
 from cogrob.service_manager.proto import service_state_pb2
 from cogrob.service_manager.util import docker_options_pb_to_py
 from cogrob.service_manager.util import errors
+import collections
 import datetime
-import dateutil.parser
-import docker
+import functools
 import random
 import threading
 import time
@@ -57,12 +57,19 @@ ServiceStatePb = service_state_pb2.ServiceState
 ServiceRequest = service_request.ServiceRequest
 ServiceRequestId = service_request.ServiceRequestId
 
+# A docker service whose container does not match its status. container_status
+# is the docker status string, or None if the container is missing.
+ContainerDrift = collections.namedtuple(
+    "ContainerDrift", ["service_id", "service_status", "container_status"])
+
+
 class DockerService(base_service.BaseService):
 
   def __init__(self, manager):
     super(DockerService, self).__init__(manager=manager)
     self._docker_py_client = None
     self._docker_py_inst = None
+    self._docker_py_inst_lock = threading.Lock()
     self._docker_stats = None
 
 
@@ -78,11 +85,74 @@ class DockerService(base_service.BaseService):
     else:
       result._docker_py_client = docker_py.GetGlobalDockerClient()
 
-    result._docker_py_inst = result._docker_py_client.GetContainer(
-        result._GetContainerName())
+    # The container is bound on first use (or by ReconcileDockerContainer), so
+    # that restoring does not need a round-trip to the docker daemon.
     return result
 
 
+  def _GetDockerContainer(self):
+    """Returns the DockerContainerInterface of this service, binds it first if
+    needed."""
+    with self._docker_py_inst_lock:
+      if self._docker_py_inst is None:
+        # Prefer the container id, the name is used by states written before
+        # docker_container_id was recorded, or if the container was recreated
+        # outside of the manager.
+        container_id = (
+            self.GetStateProto().docker_service_state.docker_container_id)
+        if container_id:
+          try:
+            self._docker_py_inst = self._docker_py_client.GetContainer(
+                container_id)
+          except Exception as e:
+            if not docker_py.IsNotFoundError(e):
+              raise
+            logging.warn("Container %s of %s not found, looking up by name.",
+                         container_id, str(self.GetServiceId()))
+        if self._docker_py_inst is None:
+          self._docker_py_inst = self._docker_py_client.GetContainer(
+              self._GetContainerName())
+      return self._docker_py_inst
+
+
+  def _SetDockerContainer(self, docker_py_inst):
+    with self._docker_py_inst_lock:
+      self._docker_py_inst = docker_py_inst
+    self.GetStateProto().docker_service_state.docker_container_id = (
+        docker_py_inst.GetId())
+    self.MarkStateChanged()
+
+
+  def ReconcileDockerContainer(self, containers_by_id, containers_by_name):
+    """Bind the underlying docker container from a listing of containers (dicts
+    from id and name to DockerContainerInterface). Returns a ContainerDrift if
+    the container does not match the status of this service, otherwise
+    None."""
+    container = containers_by_id.get(
+        self.GetStateProto().docker_service_state.docker_container_id)
+    if container is None:
+      container = containers_by_name.get(self._GetContainerName())
+
+    if container is None:
+      # Leave it unbound, _GetDockerContainer will report the error on use.
+      return ContainerDrift(self.GetServiceId(), self.GetStateProto().status,
+                            None)
+
+    with self._docker_py_inst_lock:
+      self._docker_py_inst = container
+    if (self.GetStateProto().docker_service_state.docker_container_id
+        != container.GetId()):
+      self.GetStateProto().docker_service_state.docker_container_id = (
+          container.GetId())
+      self.MarkStateChanged()
+
+    is_running = container.GetStatus() == "running"
+    if self.IsActive() != is_running:
+      return ContainerDrift(self.GetServiceId(), self.GetStateProto().status,
+                            container.GetStatus())
+    return None
+
+
   def _GetContainerName(self):
     return (FLAGS.docker_container_name_prefix +
             "__".join(self.GetServiceId().namespace)
@@ -134,8 +204,8 @@ class DockerService(base_service.BaseService):
       result._docker_py_client = docker_py.GetGlobalDockerClient()
 
     # FIXME(shengye): Pull image from registry.
-    result._docker_py_inst = result._docker_py_client.CreateContainer(
-        **docker_py_args)
+    result._SetDockerContainer(
+        result._docker_py_client.CreateContainer(**docker_py_args))
 
     return result
 
@@ -152,6 +222,7 @@ class DockerService(base_service.BaseService):
     self._RemoveContainer()
 
     self.GetStateProto().options.CopyFrom(new_options)
+    self.MarkStateChanged()
 
     docker_py_args = docker_options_pb_to_py.DockerOptionsPbToDict(
         self.GetStateProto().options.docker_service_options.container_options)
@@ -169,8 +240,8 @@ class DockerService(base_service.BaseService):
       self._docker_py_client = docker_py.GetGlobalDockerClient()
 
     # FIXME(shengye): Pull image from registry.
-    self._docker_py_inst = self._docker_py_client.CreateContainer(
-        **docker_py_args)
+    self._SetDockerContainer(
+        self._docker_py_client.CreateContainer(**docker_py_args))
 
     if previous_status == ServiceStatePb.STATUS_ACTIVE:
       self.ActivateSelf()
@@ -192,9 +263,11 @@ class DockerService(base_service.BaseService):
                    str(self.GetServiceId()))
       return []
 
+    ready_detection_method = (
+        self.GetStateProto().options.ready_detection_method)
+
     logging.info("Activating service: %s", str(self.GetServiceId()))
-    self._docker_py_inst.Start()
-    self.GetStateProto().status = ServiceStatePb.STATUS_ACTIVE
+    self.SetStatus(ServiceStatePb.STATUS_ACTIVE)
     self.GetStateProto().docker_service_state.status = (
         service_state_pb2.DockerServiceState.DOCKER_STATUS_ACTIVE)
 
@@ -204,18 +277,39 @@ class DockerService(base_service.BaseService):
     all_delayed_actions += (
         self.ActRequestService(self.GetImpliedServiceRequest()))
 
-    if self.GetStateProto().options.ready_detection_method.HasField(
-        "wait_fixed_time"):
-      all_delayed_actions.append(
-          delayed_action.WaitUntilTimestamp(time.time() +
-          self.GetStateProto().options.ready_detection_method.wait_fixed_time))
-    elif self.GetStateProto().options.ready_detection_method.HasField(
-        "wait_for_prober"):
-      raise errors.ServiceUnsupportedOptionsError(
-          "{} has an unsupported wait_for_prober ReadyDetectionMethod".format(
-          self.GetServiceId()))
+    # Within ServiceManager.PlanActivation, the container starts later, once
+    # the dependencies requested above are ready.
+    all_delayed_actions.append(self._manager.StartContainer(
+        self.GetServiceId(),
+        functools.partial(self._StartContainer,
+                          self._GetDockerContainer(),
+                          self.GetServiceId(),
+                          ready_detection_method.wait_fixed_time,
+                          ready_detection_method.wait_for_prober)))
 
-    return all_delayed_actions
+    # One future for the whole activation, including the dependencies.
+    return [delayed_action.AllOf(all_delayed_actions)]
+
+
+  @staticmethod
+  def _StartContainer(docker_container, srv_id, wait_fixed_time,
+                      wait_for_prober):
+    """Starts the container, returns the DelayedActions for it to be ready.
+    Does not touch the state, it may run on another thread."""
+    if wait_for_prober:
+      # Waits before the start, the heartbeat can come right after it.
+      heartbeat = delayed_action.WaitForServiceHeartbeat(srv_id)
+      try:
+        docker_container.Start()
+      except Exception as e:
+        delayed_action.NotifyServiceHeartbeat(srv_id, e)
+        raise
+      return [heartbeat]
+    docker_container.Start()
+    if wait_fixed_time:
+      return [
+          delayed_action.WaitUntilTimestamp(time.time() + wait_fixed_time)]
+    return []
 
 
   def DeactivateSelf(self, force=False):
@@ -224,23 +318,22 @@ class DockerService(base_service.BaseService):
                    str(self.GetServiceId()))
       return []
 
-    self.GetStateProto().status = ServiceStatePb.STATUS_TO_BE_STOPPED
+    self.SetStatus(ServiceStatePb.STATUS_TO_BE_STOPPED)
 
     if not force and self.GetStateProto().options.disable_deactivate:
       raise errors.InternalError(
           "Cannot deactivate {}, disable_deactivate is true.".format(
               self.GetServiceId()))
 
-    if not force and self.GetStateProto().requested_by_others:
+    if not force and self.GetRequestedByOthers():
       raise errors.InternalError(
           "Cannot deactivate {}, requested by services: {}.".format(
               self.GetServiceId(),
-              ", ".join(map(str, self.GetStateProto().requested_by_others))))
+              ", ".join(map(str, self.GetRequestedByOthers()))))
 
     logging.info("Deactivating service (releasing requests): %s",
                  str(self.GetServiceId()))
-    requests_by_self = [ServiceRequest.FromProto(x) for x
-                        in self.GetStateProto().requests_by_self]
+    requests_by_self = self.GetRequestsBySelf()
 
     all_delayed_actions = []
     for request_by_self in requests_by_self:
@@ -249,19 +342,35 @@ class DockerService(base_service.BaseService):
 
     logging.info("Deactivating service (stopping docker): %s",
                  str(self.GetServiceId()))
-    self._docker_py_inst.Stop()
+    self._manager.CancelContainerStart(self.GetServiceId())
+    delayed_action.NotifyServiceHeartbeat(
+        self.GetServiceId(), errors.InternalError(
+            "{} was deactivated before it was ready.".format(
+                self.GetServiceId())))
+    # Within ServiceManager.DeferContainerStops, the container stops later,
+    # before its dependencies.
+    self._manager.StopContainer(
+        self.GetServiceId(),
+        functools.partial(self._StopContainer, self._GetDockerContainer()))
     self.GetStateProto().docker_service_state.status = (
         service_state_pb2.DockerServiceState.DOCKER_STATUS_STOPPED)
 
     logging.info("Deactivated service: %s", str(self.GetServiceId()))
-    self.GetStateProto().status = ServiceStatePb.STATUS_STOPPED
+    self.SetStatus(ServiceStatePb.STATUS_STOPPED)
 
     # all_delayed_actions will always be [], which is OK for now.
     return all_delayed_actions
 
 
+  @staticmethod
+  def _StopContainer(docker_container, timeout):
+    """Stops the container, killing it after timeout seconds. Does not touch
+    the state, it may run on another thread."""
+    docker_container.Stop(timeout=timeout)
+
+
   def _RemoveContainer(self, force=True):
-    self._docker_py_inst.Remove(force=force)
+    self._GetDockerContainer().Remove(force=force)
 
 
   def HandleRequestService(self, request):
@@ -273,7 +382,7 @@ class DockerService(base_service.BaseService):
 
 
   def ForceRestart(self):
-    self._docker_py_inst.Restart()
+    self._GetDockerContainer().Restart()
 
 
   def ActRequestService(self, service_request):
@@ -287,7 +396,7 @@ class DockerService(base_service.BaseService):
   def RefreshDockerStats(self):
     if self.IsInSimulation():
       return None
-    self._docker_stats = self._docker_py_inst.Stats(stream=False, decode=True)
+    self._docker_stats = self._GetDockerContainer().Stats(stream=False, decode=True)
     return self._docker_stats
 
 
@@ -298,6 +407,7 @@ class DockerService(base_service.BaseService):
     if stats_dict is None:
       need_requery = True
     else:
+      import dateutil.parser
       read_time = dateutil.parser.parse(stats_dict["read"])
       read_timestamp = (read_time - datetime.datetime(
           1970, 1, 1, tzinfo=read_time.tzinfo)).total_seconds()
@@ -313,6 +423,7 @@ class DockerService(base_service.BaseService):
 
   def GetCpuUsage(self):
     if not self.IsInSimulation():
+      import docker
       # Query CPU usage from Docker, CPU usage is counted as number of logical
       # cores. (Number can be greater than 1.)
       # TODO(shengye): This read takes a lot of time, it should be asychronized
@@ -347,6 +458,7 @@ class DockerService(base_service.BaseService):
 
   def GetMemoryUsage(self):
     if not self.IsInSimulation():
+      import docker
       # Query memory usage from Docker, memory usage is counted in bytes.
       # TODO(shengye): This read takes a lot of time, it should be asychronized.
       try:
@@ -29,6 +29,22 @@ from cogrob.service_manager.model import docker_interface
 
 class FakeDockerContainer(docker_interface.DockerContainerInterface):
 
+  def __init__(self, container_id=""):
+    self._container_id = container_id
+
+
+  def GetId(self):
+    return self._container_id
+
+
+  def GetName(self):
+    return self._container_id
+
+
+  def GetStatus(self):
+    return "created"
+
+
   def Start(self, *args, **kwargs):
     logging.info("FakeDockerContainer.Start: args=%s; kwargs=%s",
                  str(args), str(kwargs))
@@ -62,13 +78,19 @@ class FakeDockerClient(docker_interface.DockerClientInterface):
   def GetContainer(self, *args, **kwargs):
     logging.info("FakeDockerClient.GetContainer: args=%s; kwargs=%s",
                  str(args), str(kwargs))
-    return FakeDockerContainer()
+    return FakeDockerContainer(*args[:1])
 
 
   def CreateContainer(self, *args, **kwargs):
     logging.info("FakeDockerClient.CreateContainer: args=%s; kwargs=%s",
                  str(args), str(kwargs))
-    return FakeDockerContainer()
+    return FakeDockerContainer("fake_" + kwargs.get("name", ""))
+
+
+  def ListContainers(self, name_prefix):
+    logging.info("FakeDockerClient.ListContainers: name_prefix=%s",
+                 name_prefix)
+    return []
 
 
 def GetGlobalFakeDockerClient():
@@ -0,0 +1,239 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import state_storage
+from cogrob.service_manager.util import service_state_format
+import concurrent.futures
+import errno
+import functools
+import os
+import os.path
+import threading
+import time
+
+flags.DEFINE_enum(
+    "service_state_file_format", service_state_format.FORMAT_TEXT,
+    service_state_format.ALL_FORMATS,
+    "Format of .service_state files. Files in the other format are converted "
+    "when they are loaded.")
+flags.DEFINE_integer(
+    "load_service_state_num_threads", 8,
+    "Number of worker threads to read and parse .service_state files.")
+flags.DEFINE_float(
+    "removed_service_state_max_age_secs", 7 * 24 * 3600,
+    "Delete .removed files older than this. Negative to keep them forever.")
+flags.DEFINE_integer(
+    "removed_service_state_max_count", 1000,
+    "Keep at most this many .removed files, the oldest ones are deleted "
+    "first. Negative for no limit.")
+flags.DEFINE_float(
+    "removed_service_state_gc_interval_secs", 3600,
+    "Time between two garbage collections of .removed files.")
+FLAGS = flags.FLAGS
+
+
+class FileStateStorage(state_storage.StateStorageInterface):
+  # Stores one .service_state file per service, in directories following the
+  # namespace of the service. See service_state_format for the file formats.
+
+  def __init__(self, base_path, storage_format=None):
+    self._base_path = base_path
+    self._storage_format = (storage_format if storage_format is not None
+                            else FLAGS.service_state_file_format)
+    self._service_state_extension = ".service_state"
+    self._remove_extension = ".removed"
+    self._tmp_extension = ".tmp"
+
+    # Index of the .removed files (path to the time it was removed), so that
+    # garbage collecting them does not need to walk self._base_path.
+    self._removed_files = {}
+    self._removed_files_lock = threading.Lock()
+    self._gc_thread = None
+    self._stop_gc_thread = threading.Event()
+
+
+  def _ServiceIdToFilePath(self, service_id):
+    """Generate a file path from a service id."""
+    filename = service_id.name + self._service_state_extension
+    path = functools.reduce(os.path.join,
+        [self._base_path] + list(service_id.namespace) + [filename])
+    return path
+
+
+  def _GetAllManagedFiles(self):
+    """Walk self._base_path, returns all the .service_state files and indexes
+    the .removed ones."""
+    all_managed_files = []
+    removed_files = {}
+    for dirpath, dirnames, filenames in os.walk(self._base_path):
+      for filename in filenames:
+        full_path = os.path.join(dirpath, filename)
+        if full_path.endswith(self._service_state_extension):
+          all_managed_files.append(full_path)
+        elif full_path.endswith(
+            self._service_state_extension + self._remove_extension):
+          removed_files[full_path] = os.path.getmtime(full_path)
+        else:
+          logging.warn("Not a %s file: %s",
+                       self._service_state_extension, full_path)
+    with self._removed_files_lock:
+      self._removed_files = removed_files
+    return all_managed_files
+
+
+  def LoadAll(self):
+    if not os.path.isdir(self._base_path):
+      logging.error("Cannot load from disk: %s is not valid.",
+                    self._base_path)
+      return []
+
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=FLAGS.load_service_state_num_threads)
+    try:
+      result = list(pool.map(self._LoadServiceStateFile,
+                             self._GetAllManagedFiles()))
+    finally:
+      pool.shutdown()
+    self._StartGcThread()
+    return result
+
+
+  def Adopt(self, service_states):
+    del service_states
+    self._StartGcThread(index_removed_files=True)
+
+
+  def _LoadServiceStateFile(self, file_path):
+    logging.info("Loading %s", file_path)
+    with open(file_path, "rb") as fp:
+      data = fp.read()
+    pb, file_format = service_state_format.ParseServiceState(data)
+    if file_format != self._storage_format:
+      logging.info("Converting %s from %s to %s format.", file_path,
+                   file_format, self._storage_format)
+      self._WriteServiceStateFile(file_path, pb)
+    return pb
+
+
+  def _WriteServiceStateFile(self, file_path, pb):
+    data = service_state_format.SerializeServiceState(pb, self._storage_format)
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+      os.makedirs(os.path.dirname(file_path))
+    # Write to a temporary file then rename, so that a crash never leaves a
+    # partially written .service_state file behind.
+    tmp_file_path = file_path + self._tmp_extension
+    with open(tmp_file_path, "wb") as fp:
+      fp.write(data)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.rename(tmp_file_path, file_path)
+
+
+  def _MarkServiceStateRemoved(self, service_id):
+    # We will append ".removed" to the filename. If ".removed" already exist,
+    # we overwrite that file.
+    file_path = self._ServiceIdToFilePath(service_id)
+    if not os.path.isfile(file_path):
+      return
+    new_file_path = file_path + self._remove_extension
+    if os.path.isfile(new_file_path):
+      os.remove(new_file_path)
+    os.rename(file_path, new_file_path)
+    with self._removed_files_lock:
+      self._removed_files[new_file_path] = time.time()
+
+
+  def Commit(self, changes):
+    for srv_id, pb in changes.items():
+      if pb is None:
+        self._MarkServiceStateRemoved(srv_id)
+      else:
+        self._WriteServiceStateFile(self._ServiceIdToFilePath(srv_id), pb)
+
+
+  def CollectRemovedServiceStates(self):
+    """Delete the .removed files exceeding the retention policy. Returns the
+    number of deleted files."""
+    with self._removed_files_lock:
+      # Oldest first.
+      removed_files = sorted(self._removed_files.items(), key=lambda x: x[1])
+
+    files_to_delete = []
+    if FLAGS.removed_service_state_max_age_secs >= 0:
+      min_time = time.time() - FLAGS.removed_service_state_max_age_secs
+      while removed_files and removed_files[0][1] < min_time:
+        files_to_delete.append(removed_files.pop(0)[0])
+    if FLAGS.removed_service_state_max_count >= 0:
+      num_extra = len(removed_files) - FLAGS.removed_service_state_max_count
+      if num_extra > 0:
+        files_to_delete += [x[0] for x in removed_files[:num_extra]]
+
+    for file_path in files_to_delete:
+      try:
+        os.remove(file_path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          logging.warn("Cannot delete %s: %s", file_path, str(e))
+      with self._removed_files_lock:
+        self._removed_files.pop(file_path, None)
+    if files_to_delete:
+      logging.info("Deleted %d .removed files.", len(files_to_delete))
+    return len(files_to_delete)
+
+
+  def _GcThread(self, index_removed_files):
+    if index_removed_files:
+      try:
+        self._GetAllManagedFiles()
+      except Exception as e:
+        logging.error("Failed to index .removed files: %s", str(e))
+    while True:
+      try:
+        self.CollectRemovedServiceStates()
+      except Exception as e:
+        logging.error("Failed to collect .removed files: %s", str(e))
+      if self._stop_gc_thread.wait(
+          FLAGS.removed_service_state_gc_interval_secs):
+        return
+
+
+  def _StartGcThread(self, index_removed_files=False):
+    if self._gc_thread is None:
+      self._stop_gc_thread.clear()
+      self._gc_thread = threading.Thread(
+          target=self._GcThread, args=(index_removed_files,))
+      self._gc_thread.daemon = True
+      self._gc_thread.start()
+
+
+  def Close(self):
+    if self._gc_thread is not None:
+      self._stop_gc_thread.set()
+      self._gc_thread.join()
+      self._gc_thread = None
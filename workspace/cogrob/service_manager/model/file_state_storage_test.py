@@ -0,0 +1,174 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.model import file_state_storage
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import service_state_pb2
+import os
+import shutil
+import tempfile
+import time
+
+FLAGS = flags.FLAGS
+ServiceId = service_id.ServiceId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+def _Id(name):
+  return ServiceId(["robot"], name)
+
+
+def _MakeServiceState(name):
+  pb = ServiceStatePb()
+  pb.id.CopyFrom(_Id(name).ToProto())
+  pb.status = ServiceStatePb.STATUS_STOPPED
+  return pb
+
+
+class FileStateStorageTest(absltest.TestCase):
+
+  def setUp(self):
+    super(FileStateStorageTest, self).setUp()
+    FLAGS.removed_service_state_max_age_secs = -1
+    FLAGS.removed_service_state_max_count = -1
+    FLAGS.removed_service_state_gc_interval_secs = 3600
+    self._dir = tempfile.mkdtemp()
+    self._storage = file_state_storage.FileStateStorage(self._dir)
+
+
+  def tearDown(self):
+    self._storage.Close()
+    shutil.rmtree(self._dir)
+    super(FileStateStorageTest, self).tearDown()
+
+
+  def _RemovedPath(self, name):
+    return os.path.join(self._dir, "robot", name + ".service_state.removed")
+
+
+  def _AddRemoved(self, name, age_secs):
+    """Creates the .removed file of a service, removed age_secs ago."""
+    self._storage.Commit({_Id(name): _MakeServiceState(name)})
+    self._storage.Commit({_Id(name): None})
+    mtime = time.time() - age_secs
+    os.utime(self._RemovedPath(name), (mtime, mtime))
+
+
+  def _GetRemovedNames(self):
+    suffix = ".service_state.removed"
+    return sorted(x[:-len(suffix)]
+                  for x in os.listdir(os.path.join(self._dir, "robot"))
+                  if x.endswith(suffix))
+
+
+  def _AddRemovedAndIndex(self):
+    for name, age_secs in [("a", 300), ("b", 200), ("c", 100), ("d", 0)]:
+      self._AddRemoved(name, age_secs)
+    # Index the fake mtimes, as loading does.
+    self.assertEqual([], self._storage._GetAllManagedFiles())
+
+
+  def testCollectByAge(self):
+    self._AddRemovedAndIndex()
+    FLAGS.removed_service_state_max_age_secs = 150
+    self.assertEqual(2, self._storage.CollectRemovedServiceStates())
+    self.assertEqual(["c", "d"], self._GetRemovedNames())
+    self.assertEqual(0, self._storage.CollectRemovedServiceStates())
+
+
+  def testCollectByCount(self):
+    self._AddRemovedAndIndex()
+    FLAGS.removed_service_state_max_count = 1
+    self.assertEqual(3, self._storage.CollectRemovedServiceStates())
+    self.assertEqual(["d"], self._GetRemovedNames())
+
+
+  def testCollectByAgeThenCount(self):
+    self._AddRemovedAndIndex()
+    FLAGS.removed_service_state_max_age_secs = 250
+    FLAGS.removed_service_state_max_count = 2
+    self.assertEqual(2, self._storage.CollectRemovedServiceStates())
+    self.assertEqual(["c", "d"], self._GetRemovedNames())
+
+
+  def testNegativeKeepsForever(self):
+    self._AddRemoved("a", 10 * 365 * 24 * 3600)
+    self._AddRemovedAndIndex()
+    self.assertEqual(0, self._storage.CollectRemovedServiceStates())
+    self.assertEqual(["a", "b", "c", "d"], self._GetRemovedNames())
+
+
+  def testRemovedFilesAreIndexedOnCommit(self):
+    self._storage.Commit({_Id("a"): _MakeServiceState("a")})
+    self._storage.Commit({_Id("a"): None})
+    FLAGS.removed_service_state_max_count = 0
+    self.assertEqual(1, self._storage.CollectRemovedServiceStates())
+    self.assertEqual([], self._GetRemovedNames())
+    # A file deleted by someone else is only dropped from the index.
+    self._storage.Commit({_Id("b"): _MakeServiceState("b")})
+    self._storage.Commit({_Id("b"): None})
+    os.remove(self._RemovedPath("b"))
+    self.assertEqual(1, self._storage.CollectRemovedServiceStates())
+    self.assertEqual(0, self._storage.CollectRemovedServiceStates())
+
+
+  def _WaitForRemovedNames(self, names):
+    deadline = time.time() + 10
+    while self._GetRemovedNames() != names and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(names, self._GetRemovedNames())
+
+
+  def testGcThread(self):
+    self._storage.Commit({_Id("live"): _MakeServiceState("live")})
+    self._AddRemoved("a", 300)
+    self._AddRemoved("b", 0)
+    FLAGS.removed_service_state_max_age_secs = 150
+    FLAGS.removed_service_state_gc_interval_secs = 0.01
+    storage = file_state_storage.FileStateStorage(self._dir)
+    self.assertEqual(["live"], [x.id.name for x in storage.LoadAll()])
+    self._WaitForRemovedNames(["b"])
+
+    # It keeps collecting.
+    FLAGS.removed_service_state_max_count = 0
+    self._WaitForRemovedNames([])
+    storage.Close()
+
+
+  def testGcThreadAfterAdopt(self):
+    # Adopting the state of another process indexes the files on the thread.
+    self._AddRemoved("a", 300)
+    FLAGS.removed_service_state_max_age_secs = 150
+    storage = file_state_storage.FileStateStorage(self._dir)
+    storage.Adopt([])
+    self._WaitForRemovedNames([])
+    storage.Close()
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -25,12 +25,15 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from absl import flags
+from absl import logging
 from cogrob.service_manager.model import base_service
+from cogrob.service_manager.model import delayed_action
 from cogrob.service_manager.model import service_id
 from cogrob.service_manager.model import service_request
 from cogrob.service_manager.proto import service_options_pb2
 from cogrob.service_manager.proto import service_state_pb2
 from cogrob.service_manager.util import errors
+import time
 
 FLAGS = flags.FLAGS
 
@@ -60,15 +63,19 @@ class GroupService(base_service.BaseService):
     return service_request.ServiceRequestId(self.GetServiceId(), "")
 
 
+  def GetSelfMaintainedRequestIds(self):
+    # ActivateSelf sends the implied request too.
+    return (super(GroupService, self).GetSelfMaintainedRequestIds()
+            + [self._GetServiceRequestId()])
+
+
   def _GetServiceRequest(self):
-    implied_service_ids = [
-        ServiceId.FromProto(x) for x
-        in self.GetStateProto().options.implied_services]
+    # The implied dependencies are in the implied request.
     grouped_service_ids = [
         ServiceId.FromProto(x) for x
         in self.GetStateProto().options.group_service_options.grouped_services]
     return service_request.ServiceRequest(
-        self._GetServiceRequestId(), implied_service_ids + grouped_service_ids)
+        self._GetServiceRequestId(), grouped_service_ids)
 
 
   @staticmethod
@@ -111,15 +118,10 @@ class GroupService(base_service.BaseService):
 
     all_delayed_actions = []
 
-    self.GetStateProto().requests_by_self.ClearFields()
-    self.GetStateProto().requests_by_self.append(self._GetServiceRequest())
-    self.GetStateProto().status = ServiceStatePb.STATUS_ACTIVE
+    self._ClearRequestsBySelf()
+    self.SetStatus(ServiceStatePb.STATUS_ACTIVE)
 
-    for srv_id in self.GetStateProto().options.grouped_services:
-      grouped_service = self._manager.GetService(
-          ServiceId.FromProto(srv_id))
-      all_delayed_actions += grouped_service.HandleRequestService(
-          self._GetServiceRequest())
+    all_delayed_actions += self.ActRequestService(self._GetServiceRequest())
 
     # Reactivate all implied requests.
     all_delayed_actions += self.ActRequestService(
@@ -138,7 +140,8 @@ class GroupService(base_service.BaseService):
           "{} has an unsupported wait_for_prober ReadyDetectionMethod".format(
           self.GetServiceId()))
 
-    return all_delayed_actions
+    # One future for the whole activation, including the dependencies.
+    return [delayed_action.AllOf(all_delayed_actions)]
 
 
   def DeactivateSelf(self, force=False):
@@ -152,19 +155,16 @@ class GroupService(base_service.BaseService):
           "Cannot deactivate {}, disable_deactivate is true.".format(
               self.GetServiceId()))
 
-    if not force and self.GetStateProto().requested_by_others:
+    if not force and self.GetRequestedByOthers():
       raise errors.InternalError(
           "Cannot deactivate {}, requested by services: {}.".format(
               self.GetServiceId(),
-              ", ".join(map(str, self.GetStateProto().requested_by_others))))
+              ", ".join(map(str, self.GetRequestedByOthers()))))
+    self.SetStatus(ServiceStatePb.STATUS_TO_BE_STOPPED)
     all_delayed_actions = []
-    for srv_id in self.GetStateProto().options.grouped_services:
-      grouped_service = self._manager.GetService(
-          ServiceId.FromProto(srv_id))
-      all_delayed_actions += grouped_service.HandleReleaseService(
-          self._GetServiceRequest())
-    self.GetStateProto().requests_by_self.ClearFields()
-    self.GetStateProto().status = ServiceStatePb.STATUS_STOPPED
+    for request_by_self in self.GetRequestsBySelf():
+      all_delayed_actions += self.ActReleaseService(request_by_self.request_id)
+    self.SetStatus(ServiceStatePb.STATUS_STOPPED)
 
     # all_delayed_actions will always be [], which is OK for now.
     return all_delayed_actions
@@ -0,0 +1,230 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import state_storage
+from cogrob.service_manager.proto import service_state_pb2
+from cogrob.service_manager.proto import state_journal_pb2
+import os
+import os.path
+import struct
+import zlib
+
+flags.DEFINE_integer(
+    "journal_compaction_num_records", 1000,
+    "Fold the state journal into a snapshot after this many records.")
+FLAGS = flags.FLAGS
+
+ServiceId = service_id.ServiceId
+StateJournalRecord = state_journal_pb2.StateJournalRecord
+StateSnapshot = state_journal_pb2.StateSnapshot
+
+# Every record is prefixed by its length and its CRC32, both little-endian
+# uint32, so that a torn write at the end of the journal can be detected.
+_RECORD_HEADER = struct.Struct("<II")
+
+
+def _EncodeRecord(payload):
+  return _RECORD_HEADER.pack(
+      len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def _DecodeRecords(data):
+  """Decode all the complete records in data. Returns a list of payloads and
+  the offset after the last valid record."""
+  payloads = []
+  offset = 0
+  while offset + _RECORD_HEADER.size <= len(data):
+    length, crc = _RECORD_HEADER.unpack_from(data, offset)
+    begin = offset + _RECORD_HEADER.size
+    end = begin + length
+    if end > len(data):
+      break
+    payload = data[begin:end]
+    if zlib.crc32(payload) & 0xffffffff != crc:
+      break
+    payloads.append(payload)
+    offset = end
+  return payloads, offset
+
+
+def _FsyncDirectory(dir_path):
+  dir_fd = os.open(dir_path, os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)
+  finally:
+    os.close(dir_fd)
+
+
+class JournalStateStorage(state_storage.StateStorageInterface):
+  # Stores the state of all services as a snapshot plus an append-only journal
+  # of StateJournalRecord. A commit is one sequential append and one fsync. Once
+  # the journal is long enough, it is folded into a new snapshot.
+
+  def __init__(self, base_path):
+    self._base_path = base_path
+    self._snapshot_path = os.path.join(base_path, "service_state.snapshot")
+    self._journal_path = os.path.join(base_path, "service_state.journal")
+    self._journal_fp = None
+    self._num_journal_records = 0
+
+    # Latest serialized ServiceState of every service, used for compaction.
+    self._serialized_states = {}
+
+
+  def _ApplyRecord(self, record):
+    if record.HasField("service_state"):
+      srv_id = ServiceId.FromProto(record.service_state.id)
+      self._serialized_states[srv_id] = (
+          record.service_state.SerializeToString())
+    elif record.HasField("removed_service"):
+      self._serialized_states.pop(
+          ServiceId.FromProto(record.removed_service), None)
+
+
+  def _LoadSnapshot(self):
+    if not os.path.isfile(self._snapshot_path):
+      return
+    with open(self._snapshot_path, "rb") as fp:
+      payloads, _ = _DecodeRecords(fp.read())
+    if len(payloads) != 1:
+      raise IOError("Corrupted snapshot: {}".format(self._snapshot_path))
+    snapshot = StateSnapshot()
+    snapshot.ParseFromString(payloads[0])
+    for pb in snapshot.services:
+      self._serialized_states[ServiceId.FromProto(pb.id)] = (
+          pb.SerializeToString())
+
+
+  def _ReplayJournal(self):
+    if not os.path.isfile(self._journal_path):
+      return
+    with open(self._journal_path, "rb") as fp:
+      data = fp.read()
+    payloads, valid_length = _DecodeRecords(data)
+    for payload in payloads:
+      record = StateJournalRecord()
+      record.ParseFromString(payload)
+      self._ApplyRecord(record)
+    self._num_journal_records = len(payloads)
+
+    if valid_length != len(data):
+      # The last commit did not finish, drop the partial record so that new
+      # records are appended after a valid one.
+      logging.warn("Dropping %d bytes of incomplete records from %s",
+                   len(data) - valid_length, self._journal_path)
+      with open(self._journal_path, "r+b") as fp:
+        fp.truncate(valid_length)
+
+
+  def _OpenJournal(self):
+    if self._journal_fp is None:
+      if not os.path.isdir(self._base_path):
+        os.makedirs(self._base_path)
+      self._journal_fp = open(self._journal_path, "ab")
+    return self._journal_fp
+
+
+  def LoadAll(self):
+    self._serialized_states = {}
+    self._num_journal_records = 0
+    self._LoadSnapshot()
+    self._ReplayJournal()
+
+    result = []
+    for serialized_state in self._serialized_states.values():
+      pb = service_state_pb2.ServiceState()
+      pb.ParseFromString(serialized_state)
+      result.append(pb)
+    return result
+
+
+  def Adopt(self, service_states):
+    self._serialized_states = dict(
+        (ServiceId.FromProto(pb.id), pb.SerializeToString())
+        for pb in service_states)
+    # The length of the journal is unknown without reading it, it is folded
+    # into a snapshot after at most journal_compaction_num_records commits.
+    self._num_journal_records = 0
+
+
+  def Commit(self, changes):
+    if not changes:
+      return
+
+    records = []
+    for srv_id, pb in changes.items():
+      record = StateJournalRecord()
+      if pb is None:
+        record.removed_service.CopyFrom(srv_id.ToProto())
+      else:
+        record.service_state.CopyFrom(pb)
+      self._ApplyRecord(record)
+      records.append(_EncodeRecord(record.SerializeToString()))
+
+    journal_fp = self._OpenJournal()
+    journal_fp.write(b"".join(records))
+    journal_fp.flush()
+    os.fsync(journal_fp.fileno())
+    self._num_journal_records += len(records)
+
+    if self._num_journal_records >= FLAGS.journal_compaction_num_records:
+      self.Compact()
+
+
+  def Compact(self):
+    """Fold the journal into a new snapshot, then truncate the journal."""
+    snapshot = StateSnapshot()
+    for serialized_state in self._serialized_states.values():
+      snapshot.services.add().MergeFromString(serialized_state)
+
+    if not os.path.isdir(self._base_path):
+      os.makedirs(self._base_path)
+    tmp_path = self._snapshot_path + ".tmp"
+    with open(tmp_path, "wb") as fp:
+      fp.write(_EncodeRecord(snapshot.SerializeToString()))
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.rename(tmp_path, self._snapshot_path)
+    _FsyncDirectory(self._base_path)
+
+    # Records are full states, so replaying a journal that was not truncated
+    # yet on top of the new snapshot is harmless.
+    journal_fp = self._OpenJournal()
+    journal_fp.truncate(0)
+    journal_fp.flush()
+    os.fsync(journal_fp.fileno())
+    self._num_journal_records = 0
+    logging.info("Compacted state journal into %s (%d services).",
+                 self._snapshot_path, len(snapshot.services))
+
+
+  def Close(self):
+    if self._journal_fp is not None:
+      self._journal_fp.close()
+      self._journal_fp = None
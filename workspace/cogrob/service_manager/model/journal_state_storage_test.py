@@ -0,0 +1,147 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.model import journal_state_storage
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import service_state_pb2
+import os
+import shutil
+import tempfile
+
+FLAGS = flags.FLAGS
+ServiceId = service_id.ServiceId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+def _MakeServiceState(name, status=ServiceStatePb.STATUS_STOPPED):
+  pb = ServiceStatePb()
+  pb.id.CopyFrom(ServiceId(["robot"], name).ToProto())
+  pb.status = status
+  return pb
+
+
+def _Statuses(service_states):
+  return dict((pb.id.name, pb.status) for pb in service_states)
+
+
+class RecordEncodingTest(absltest.TestCase):
+
+  def testRoundTrip(self):
+    payloads = [b"", b"\x00\xff", b"state" * 1000]
+    data = b"".join(journal_state_storage._EncodeRecord(x) for x in payloads)
+    self.assertEqual((payloads, len(data)),
+                     journal_state_storage._DecodeRecords(data))
+
+
+  def testStopsAtTornOrCorruptedRecord(self):
+    first = journal_state_storage._EncodeRecord(b"first")
+    second = journal_state_storage._EncodeRecord(b"second")
+    for cut in range(1, len(second)):
+      self.assertEqual(
+          ([b"first"], len(first)),
+          journal_state_storage._DecodeRecords(first + second[:-cut]))
+    corrupted = second[:-1] + b"X"
+    self.assertEqual(
+        ([b"first"], len(first)),
+        journal_state_storage._DecodeRecords(first + corrupted + first))
+
+
+class JournalStateStorageTest(absltest.TestCase):
+
+  def setUp(self):
+    super(JournalStateStorageTest, self).setUp()
+    FLAGS.journal_compaction_num_records = 1000
+    self._dir = tempfile.mkdtemp()
+    self._journal_path = os.path.join(self._dir, "service_state.journal")
+
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+    super(JournalStateStorageTest, self).tearDown()
+
+
+  def _Reload(self):
+    storage = journal_state_storage.JournalStateStorage(self._dir)
+    result = _Statuses(storage.LoadAll())
+    storage.Close()
+    return result
+
+
+  def testCommitAndLoad(self):
+    storage = journal_state_storage.JournalStateStorage(self._dir)
+    self.assertEqual([], storage.LoadAll())
+    a_id = ServiceId(["robot"], "a")
+    storage.Commit({a_id: _MakeServiceState("a"),
+                    ServiceId(["robot"], "b"): _MakeServiceState("b")})
+    storage.Commit({a_id: _MakeServiceState("a", ServiceStatePb.STATUS_ACTIVE),
+                    ServiceId(["robot"], "b"): None})
+    storage.Close()
+    self.assertEqual({"a": ServiceStatePb.STATUS_ACTIVE}, self._Reload())
+
+
+  def testDropsTornTail(self):
+    storage = journal_state_storage.JournalStateStorage(self._dir)
+    storage.LoadAll()
+    storage.Commit({ServiceId(["robot"], "a"): _MakeServiceState("a")})
+    storage.Close()
+    valid_length = os.path.getsize(self._journal_path)
+    record = journal_state_storage._EncodeRecord(
+        _MakeServiceState("b").SerializeToString())
+    with open(self._journal_path, "ab") as fp:
+      fp.write(record[:-3])
+
+    storage = journal_state_storage.JournalStateStorage(self._dir)
+    self.assertEqual({"a": ServiceStatePb.STATUS_STOPPED},
+                     _Statuses(storage.LoadAll()))
+    self.assertEqual(valid_length, os.path.getsize(self._journal_path))
+    # New records follow the last valid one.
+    storage.Commit({ServiceId(["robot"], "c"): _MakeServiceState("c")})
+    storage.Close()
+    self.assertEqual({"a": ServiceStatePb.STATUS_STOPPED,
+                      "c": ServiceStatePb.STATUS_STOPPED}, self._Reload())
+
+
+  def testCompaction(self):
+    FLAGS.journal_compaction_num_records = 3
+    storage = journal_state_storage.JournalStateStorage(self._dir)
+    storage.LoadAll()
+    for name in ["a", "b", "c", "d"]:
+      storage.Commit({ServiceId(["robot"], name): _MakeServiceState(name)})
+    storage.Commit({ServiceId(["robot"], "a"): None})
+    storage.Close()
+    self.assertTrue(
+        os.path.isfile(os.path.join(self._dir, "service_state.snapshot")))
+    # Only the records since the compaction are left in the journal.
+    with open(self._journal_path, "rb") as fp:
+      payloads, _ = journal_state_storage._DecodeRecords(fp.read())
+    self.assertLen(payloads, 2)
+    self.assertEqual(["b", "c", "d"], sorted(self._Reload()))
+
+
+if __name__ == "__main__":
+  absltest.main()
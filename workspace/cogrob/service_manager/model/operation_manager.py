@@ -0,0 +1,222 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.proto import result_code_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.util import errors
+import collections
+import concurrent.futures
+import threading
+import time
+import uuid
+
+flags.DEFINE_integer(
+    "operation_num_threads", 4,
+    "Number of worker threads running the background operations. Pending "
+    "operations beyond this only wait in a queue.")
+flags.DEFINE_float(
+    "operation_ttl_secs", 600,
+    "Forget an operation this long after it is done.")
+FLAGS = flags.FLAGS
+
+OperationPb = service_manager_rpc_pb2.Operation
+
+
+class Operation(object):
+  # A function running in the background. If the caller waits for the
+  # services to be ready, the operation is done once the delayed actions
+  # returned by the function are met, which does not hold a thread.
+
+  def __init__(self, operation_id, wait_for_ready):
+    self._operation_id = operation_id
+    self._wait_for_ready = wait_for_ready
+    self._status = OperationPb.STATUS_PENDING
+    self._result = result_code_pb2.RESULT_UNKNOWN
+    self._error_message = ""
+    self._delayed_actions = []
+    self._finish_time = None
+    self._done_future = concurrent.futures.Future()
+
+
+  def GetOperationId(self):
+    return self._operation_id
+
+
+  def GetFinishTime(self):
+    return self._finish_time
+
+
+  def IsDone(self):
+    return self._status == OperationPb.STATUS_DONE
+
+
+  def GetDoneFuture(self):
+    """Returns a concurrent.futures.Future resolved once the operation is
+    done."""
+    return self._done_future
+
+
+  def SetRunning(self):
+    self._status = OperationPb.STATUS_RUNNING
+
+
+  def SetReturned(self, result, error_message, delayed_actions):
+    """Called once the function returned. Returns a DelayedAction to wait for
+    before calling SetDone, or None if the operation is done already."""
+    self._result = result
+    self._error_message = error_message
+    if self._wait_for_ready and result == result_code_pb2.RESULT_OK:
+      return delayed_action.AllOf(delayed_actions)
+    self._delayed_actions = list(delayed_actions)
+    self.SetDone()
+    return None
+
+
+  def SetDone(self, error=None):
+    if error is not None:
+      self._result = error.GetResultCode()
+      self._error_message = str(error)
+    self._status = OperationPb.STATUS_DONE
+    self._finish_time = time.time()
+    self._done_future.set_result(None)
+
+
+  def ToProto(self):
+    result = OperationPb()
+    result.operation_id = self._operation_id
+    result.status = self._status
+    if self.IsDone():
+      result.result = self._result
+      result.error_message = self._error_message
+      result.delayed_actions.extend([
+          leaf.ToProto() for action in self._delayed_actions
+          for leaf in action.GetLeafActions()])
+    return result
+
+
+class OperationManager(object):
+  # Runs operations on a bounded pool of threads, and keeps their results for
+  # FLAGS.operation_ttl_secs so that clients can poll or wait for them.
+
+  def __init__(self, num_threads=None):
+    self._pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=(num_threads if num_threads is not None
+                     else FLAGS.operation_num_threads))
+    self._cond = threading.Condition()
+    self._operations = {}
+    # Done operations, in the order they finished, for the cleanup.
+    self._finished_operations = collections.deque()
+    self._num_unfinished = 0
+
+
+  def Submit(self, function, wait_for_ready):
+    """Run function in the background and returns an operation id. function
+    returns a list of delayed_action.DelayedAction, or raises an
+    errors.ServiceManagerError."""
+    operation = Operation(uuid.uuid4().hex, wait_for_ready)
+    with self._cond:
+      self._RemoveExpiredOperations()
+      self._operations[operation.GetOperationId()] = operation
+      self._num_unfinished += 1
+    self._pool.submit(self._RunOperation, operation, function)
+    return operation.GetOperationId()
+
+
+  def _RunOperation(self, operation, function):
+    with self._cond:
+      operation.SetRunning()
+    result = result_code_pb2.RESULT_OK
+    error_message = ""
+    delayed_actions = []
+    try:
+      delayed_actions = function()
+    except errors.ServiceManagerError as e:
+      result = e.GetResultCode()
+      error_message = str(e)
+    except Exception as e:
+      logging.error("Operation %s failed: %s", operation.GetOperationId(),
+                    str(e))
+      result = result_code_pb2.RESULT_INTERNAL
+      error_message = str(e)
+    with self._cond:
+      readiness = operation.SetReturned(result, error_message, delayed_actions)
+      if readiness is None:
+        self._finished_operations.append(operation)
+      self._num_unfinished -= 1
+      self._cond.notify_all()
+    if readiness is not None:
+      readiness.GetFuture().add_done_callback(
+          lambda future: self._OnOperationReady(operation, future))
+
+
+  def _OnOperationReady(self, operation, future):
+    with self._cond:
+      operation.SetDone(future.exception())
+      self._finished_operations.append(operation)
+      self._cond.notify_all()
+
+
+  def _RemoveExpiredOperations(self):
+    # Must hold self._cond.
+    min_finish_time = time.time() - FLAGS.operation_ttl_secs
+    while (self._finished_operations and
+           self._finished_operations[0].GetFinishTime() < min_finish_time):
+      self._operations.pop(
+          self._finished_operations.popleft().GetOperationId(), None)
+
+
+  def _GetOperation(self, operation_id):
+    # Must hold self._cond.
+    self._RemoveExpiredOperations()
+    operation = self._operations.get(operation_id)
+    if operation is None:
+      raise errors.OperationNotFoundError(
+          "Operation {} not found.".format(operation_id))
+    return operation
+
+
+  def GetOperation(self, operation_id):
+    """Returns the service_manager_rpc_pb2.Operation of an operation."""
+    with self._cond:
+      return self._GetOperation(operation_id).ToProto()
+
+
+  def GetDoneFuture(self, operation_id):
+    """Returns a concurrent.futures.Future resolved once the operation is
+    done, to wait for it without holding a thread."""
+    with self._cond:
+      return self._GetOperation(operation_id).GetDoneFuture()
+
+
+  def WaitForUnfinishedOperations(self):
+    """Wait until all the submitted functions returned. Does not wait for the
+    services to be ready."""
+    with self._cond:
+      while self._num_unfinished:
+        self._cond.wait()
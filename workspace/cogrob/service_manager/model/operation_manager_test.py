@@ -0,0 +1,126 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import operation_manager
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import result_code_pb2
+from cogrob.service_manager.util import errors
+import threading
+import time
+
+FLAGS = flags.FLAGS
+OperationPb = operation_manager.OperationPb
+
+
+def _MakeActivation(name):
+  return delayed_action.WaitForActivation(service_id.ServiceId(["robot"], name))
+
+
+class OperationManagerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(OperationManagerTest, self).setUp()
+    FLAGS.operation_ttl_secs = 600
+    self._manager = operation_manager.OperationManager(num_threads=2)
+
+
+  def _Wait(self, operation_id):
+    self._manager.GetDoneFuture(operation_id).result(10)
+    return self._manager.GetOperation(operation_id)
+
+
+  def testReturnsDelayedActions(self):
+    action = _MakeActivation("a")
+    operation_id = self._manager.Submit(lambda: [action], False)
+    pb = self._Wait(operation_id)
+    self.assertEqual(operation_id, pb.operation_id)
+    self.assertEqual(OperationPb.STATUS_DONE, pb.status)
+    self.assertEqual(result_code_pb2.RESULT_OK, pb.result)
+    self.assertLen(pb.delayed_actions, 1)
+    self.assertEqual(
+        "a", pb.delayed_actions[0].wait_activation.service_to_wait.name)
+
+
+  def testErrors(self):
+    def _Raise(error):
+      raise error
+    operation_id = self._manager.Submit(
+        lambda: _Raise(errors.ServiceNotFoundError()), True)
+    pb = self._Wait(operation_id)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_NOT_FOUND, pb.result)
+    self.assertEqual("Service not found.", pb.error_message)
+    operation_id = self._manager.Submit(
+        lambda: _Raise(RuntimeError("Oops.")), False)
+    self.assertEqual(result_code_pb2.RESULT_INTERNAL,
+                     self._Wait(operation_id).result)
+
+
+  def testWaitsForReady(self):
+    actions = [_MakeActivation("a"), _MakeActivation("b")]
+    operation_id = self._manager.Submit(lambda: actions, True)
+    self._manager.WaitForUnfinishedOperations()
+    pb = self._manager.GetOperation(operation_id)
+    self.assertEqual(OperationPb.STATUS_RUNNING, pb.status)
+    actions[0].Resolve()
+    self.assertFalse(self._manager.GetDoneFuture(operation_id).done())
+    actions[1].Resolve(errors.InternalError("Cannot start b."))
+    pb = self._Wait(operation_id)
+    self.assertEqual(OperationPb.STATUS_DONE, pb.status)
+    self.assertEqual(result_code_pb2.RESULT_INTERNAL, pb.result)
+    self.assertEqual("Cannot start b.", pb.error_message)
+    self.assertEmpty(pb.delayed_actions)
+
+
+  def testPendingBehindBusyWorkers(self):
+    release = threading.Event()
+    busy_ids = [self._manager.Submit(lambda: release.wait(10) and [], False)
+                for _ in range(2)]
+    operation_id = self._manager.Submit(lambda: [], False)
+    self.assertEqual(OperationPb.STATUS_PENDING,
+                     self._manager.GetOperation(operation_id).status)
+    release.set()
+    self.assertEqual(result_code_pb2.RESULT_OK,
+                     self._Wait(operation_id).result)
+    for busy_id in busy_ids:
+      self.assertEqual(result_code_pb2.RESULT_OK, self._Wait(busy_id).result)
+
+
+  def testExpires(self):
+    with self.assertRaises(errors.OperationNotFoundError):
+      self._manager.GetOperation("unknown")
+    FLAGS.operation_ttl_secs = 0.01
+    operation_id = self._manager.Submit(lambda: [], False)
+    self._Wait(operation_id)
+    time.sleep(0.05)
+    with self.assertRaises(errors.OperationNotFoundError):
+      self._manager.GetOperation(operation_id)
+
+
+if __name__ == "__main__":
+  absltest.main()
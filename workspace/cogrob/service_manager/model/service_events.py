@@ -0,0 +1,320 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.proto import service_event_pb2
+import collections
+import math
+import threading
+import time
+
+flags.DEFINE_integer(
+    "watch_history_size", 1000,
+    "Number of recent service events kept, so that watchers can resume from "
+    "a revision.")
+flags.DEFINE_integer(
+    "watch_queue_size", 256,
+    "Maximal number of events queued for one watcher. A watcher that falls "
+    "behind more than this gets EVENT_RESYNC instead of the events it missed.")
+flags.DEFINE_integer(
+    "watch_max_watchers", 4,
+    "Maximal number of concurrent WatchServices streams, each of them holds "
+    "one RPC thread.")
+flags.DEFINE_float(
+    "watch_cpu_threshold", 0,
+    "Send an event when the CPU usage (in number of logical cores) of a "
+    "service crosses this value, 0 to disable.")
+flags.DEFINE_integer(
+    "watch_memory_threshold_mb", 0,
+    "Send an event when the memory usage of a service crosses this value, 0 "
+    "to disable.")
+FLAGS = flags.FLAGS
+
+ServiceEventPb = service_event_pb2.ServiceEvent
+ServiceId = service_id.ServiceId
+
+
+def _DiffServices(old, new):
+  """Returns the events (without revision) between two
+  state_snapshot.ServiceSnapshot of a service, either can be None."""
+  if old is None and new is None:
+    return []
+  srv_id_pb = (new or old).service_id.ToProto()
+  if old is None:
+    events = [ServiceEventPb(type=ServiceEventPb.EVENT_SERVICE_CREATED,
+                             new_status=new.status)]
+    events += [ServiceEventPb(type=ServiceEventPb.EVENT_REQUEST_ADDED,
+                              request_id=x.ToProto())
+               for x in new.requested_by_others]
+  elif new is None:
+    events = [ServiceEventPb(type=ServiceEventPb.EVENT_SERVICE_REMOVED,
+                             old_status=old.status)]
+  else:
+    events = []
+    if old.options != new.options:
+      events.append(ServiceEventPb(type=ServiceEventPb.EVENT_OPTIONS_UPDATED))
+    events += [ServiceEventPb(type=ServiceEventPb.EVENT_REQUEST_ADDED,
+                              request_id=x.ToProto())
+               for x in new.requested_by_others - old.requested_by_others]
+    events += [ServiceEventPb(type=ServiceEventPb.EVENT_REQUEST_REMOVED,
+                              request_id=x.ToProto())
+               for x in old.requested_by_others - new.requested_by_others]
+    if old.status != new.status:
+      events.append(ServiceEventPb(type=ServiceEventPb.EVENT_STATUS_CHANGED,
+                                   old_status=old.status,
+                                   new_status=new.status))
+  for event in events:
+    event.id.CopyFrom(srv_id_pb)
+  return events
+
+
+class EventFilter(object):
+  # Which events a watcher gets, see WatchServicesRequest.
+
+  def __init__(self, service_ids=(), namespaces=(), event_types=()):
+    self._service_ids = set(service_ids)
+    self._namespaces = [tuple(x) for x in namespaces]
+    self._event_types = set(event_types)
+
+
+  @staticmethod
+  def FromProto(watch_request_pb):
+    return EventFilter(
+        [ServiceId.FromProto(x) for x in watch_request_pb.ids],
+        [x.namespace for x in watch_request_pb.namespaces],
+        watch_request_pb.types)
+
+
+  def Matches(self, event):
+    if event.type == ServiceEventPb.EVENT_RESYNC:
+      return True
+    if self._event_types and event.type not in self._event_types:
+      return False
+    if not self._service_ids and not self._namespaces:
+      return True
+    namespace = tuple(event.id.namespace)
+    if any(namespace[:len(x)] == x for x in self._namespaces):
+      return True
+    return ServiceId.FromProto(event.id) in self._service_ids
+
+
+class Subscription(object):
+  # The events for one watcher, queued by the ServiceEventHub. Only _Put and
+  # _Resync are called with the lock of the hub held.
+
+  def __init__(self, hub, event_filter, max_queue_size):
+    self._hub = hub
+    self._event_filter = event_filter
+    self._max_queue_size = max_queue_size
+    self._cv = threading.Condition()
+    self._queue = collections.deque()
+    self._closed = False
+    self._wakeup = None
+
+
+  def SetWakeup(self, wakeup):
+    """wakeup is called, from the publishing thread, whenever an event is
+    queued or the subscription is closed. Lets the grpc.aio server wait for
+    events on its event loop instead of in Get."""
+    self._wakeup = wakeup
+
+
+  def _Notify(self):
+    # Must hold self._cv.
+    self._cv.notify_all()
+    if self._wakeup is not None:
+      self._wakeup()
+
+
+  def _Put(self, event):
+    if not self._event_filter.Matches(event):
+      return
+    with self._cv:
+      if len(self._queue) >= self._max_queue_size:
+        # Too slow: drop what is queued, the watcher has to read the state
+        # again anyway.
+        self._queue.clear()
+        self._queue.append(self._hub._CreateResyncEvent(event.revision - 1))
+      self._queue.append(event)
+      self._Notify()
+
+
+  def _Resync(self, revision):
+    with self._cv:
+      self._queue.clear()
+      self._queue.append(self._hub._CreateResyncEvent(revision))
+      self._Notify()
+
+
+  def Get(self, timeout=None):
+    """Returns the next event, or None if timed out or closed. A timeout of 0
+    does not wait."""
+    with self._cv:
+      deadline = None if timeout is None else time.time() + timeout
+      while not self._queue and not self._closed:
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return None
+        self._cv.wait(remaining)
+      if self._closed:
+        return None
+      return self._queue.popleft()
+
+
+  def IsClosed(self):
+    return self._closed
+
+
+  def Close(self):
+    self._hub._Unsubscribe(self)
+    with self._cv:
+      self._closed = True
+      self._Notify()
+
+
+class ServiceEventHub(object):
+  # Turns the changes of the services into ServiceEvent, and fans them out to
+  # the watchers. Publishing never blocks on a watcher.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._revision = 0
+    self._history = collections.deque(maxlen=FLAGS.watch_history_size)
+    self._subscriptions = set()
+    # (ServiceId, event type) of the resource thresholds a service is above.
+    self._above_thresholds = set()
+
+
+  def GetRevision(self):
+    return self._revision
+
+
+  def SetRevision(self, revision):
+    """Continue from the revision of a previous server process."""
+    with self._lock:
+      self._revision = revision
+      self._history.clear()
+
+
+  def _CreateResyncEvent(self, revision):
+    result = ServiceEventPb(type=ServiceEventPb.EVENT_RESYNC, revision=revision)
+    self._SetTimestamp(result)
+    return result
+
+
+  @staticmethod
+  def _SetTimestamp(event):
+    now = time.time()
+    event.timestamp.seconds = int(math.floor(now))
+    event.timestamp.nanos = int((now - event.timestamp.seconds) * 1e9)
+
+
+  def _Publish(self, events):
+    if not events:
+      return
+    with self._lock:
+      for event in events:
+        self._revision += 1
+        event.revision = self._revision
+        self._SetTimestamp(event)
+        self._history.append(event)
+        for subscription in self._subscriptions:
+          subscription._Put(event)
+
+
+  def PublishChanges(self, old_snapshot, new_snapshot, service_ids):
+    """Publish the events of service_ids between two
+    state_snapshot.StateSnapshot. Must be called in the order of the
+    snapshots."""
+    events = []
+    for srv_id in service_ids:
+      events += _DiffServices(old_snapshot.GetService(srv_id),
+                              new_snapshot.GetService(srv_id))
+    self._Publish(events)
+
+
+  def HasResourceThresholds(self):
+    return bool(FLAGS.watch_cpu_threshold or FLAGS.watch_memory_threshold_mb)
+
+
+  def PublishResourceUsage(self, service_id, cpu_usage, memory_usage):
+    """Called with the latest resource usage of a service (None if not
+    available), publishes the threshold crossings."""
+    events = []
+    thresholds = [
+        (ServiceEventPb.EVENT_CPU_THRESHOLD_CROSSED, FLAGS.watch_cpu_threshold,
+         cpu_usage),
+        (ServiceEventPb.EVENT_MEMORY_THRESHOLD_CROSSED,
+         FLAGS.watch_memory_threshold_mb * 1024 * 1024, memory_usage)]
+    for event_type, threshold, usage in thresholds:
+      if not threshold or usage is None:
+        continue
+      above = usage > threshold
+      key = (service_id, event_type)
+      if above == (key in self._above_thresholds):
+        continue
+      if above:
+        self._above_thresholds.add(key)
+      else:
+        self._above_thresholds.discard(key)
+      events.append(ServiceEventPb(
+          type=event_type, id=service_id.ToProto(), above_threshold=above,
+          cpu_usage=cpu_usage or 0, memory_usage=memory_usage or 0))
+    self._Publish(events)
+
+
+  def Subscribe(self, event_filter, from_revision=0):
+    """Returns a Subscription getting the events after from_revision (0 for
+    only the new events), or None if there are too many watchers already."""
+    subscription = Subscription(self, event_filter, FLAGS.watch_queue_size)
+    with self._lock:
+      if len(self._subscriptions) >= FLAGS.watch_max_watchers:
+        return None
+      self._subscriptions.add(subscription)
+      if from_revision and from_revision != self._revision:
+        oldest = (self._history[0].revision if self._history
+                  else self._revision + 1)
+        if from_revision < oldest - 1 or from_revision > self._revision:
+          subscription._Resync(self._revision)
+        else:
+          for event in self._history:
+            if event.revision > from_revision:
+              subscription._Put(event)
+    return subscription
+
+
+  def _Unsubscribe(self, subscription):
+    with self._lock:
+      self._subscriptions.discard(subscription)
+
+
+  def CloseAll(self):
+    """End all the subscriptions, e.g. before the server stops."""
+    with self._lock:
+      subscriptions = list(self._subscriptions)
+    for subscription in subscriptions:
+      subscription.Close()
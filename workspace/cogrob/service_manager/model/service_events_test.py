@@ -0,0 +1,287 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.model import service_events
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.model import state_snapshot
+from cogrob.service_manager.proto import service_event_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.proto import service_state_pb2
+
+FLAGS = flags.FLAGS
+ServiceEventPb = service_event_pb2.ServiceEvent
+ServiceId = service_id.ServiceId
+ServiceRequestId = service_request.ServiceRequestId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+def _Id(name, namespace=("robot",)):
+  return ServiceId(list(namespace), name)
+
+
+def _MakeServiceState(srv_id, status=ServiceStatePb.STATUS_STOPPED,
+                      requester_names=(), image="ubuntu"):
+  pb = ServiceStatePb()
+  pb.id.CopyFrom(srv_id.ToProto())
+  pb.status = status
+  pb.options.docker_service_options.container_options.image = image
+  for name in requester_names:
+    pb.requested_by_others.add().CopyFrom(
+        ServiceRequestId(_Id(name), "uuid").ToProto())
+  return pb
+
+
+def _MakeSnapshot(srv_id, status=ServiceStatePb.STATUS_STOPPED,
+                  requester_names=(), image="ubuntu"):
+  return state_snapshot.CreateServiceSnapshot(
+      _MakeServiceState(srv_id, status, requester_names, image), None)
+
+
+def _Types(events):
+  return [x.type for x in events]
+
+
+class DiffServicesTest(absltest.TestCase):
+
+  def testCreateAndRemove(self):
+    new = _MakeSnapshot(_Id("a"), ServiceStatePb.STATUS_ACTIVE, ["b"])
+    events = service_events._DiffServices(None, new)
+    self.assertEqual([ServiceEventPb.EVENT_SERVICE_CREATED,
+                      ServiceEventPb.EVENT_REQUEST_ADDED], _Types(events))
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, events[0].new_status)
+    self.assertEqual("b", events[1].request_id.service_id.name)
+    for event in events:
+      self.assertEqual(_Id("a"), ServiceId.FromProto(event.id))
+
+    events = service_events._DiffServices(new, None)
+    self.assertEqual([ServiceEventPb.EVENT_SERVICE_REMOVED], _Types(events))
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, events[0].old_status)
+    self.assertEqual([], service_events._DiffServices(None, None))
+
+
+  def testStatusRequestsAndOptions(self):
+    old = _MakeSnapshot(_Id("a"), ServiceStatePb.STATUS_ACTIVE, ["b"])
+    self.assertEqual([], service_events._DiffServices(old, old))
+
+    new = _MakeSnapshot(_Id("a"), ServiceStatePb.STATUS_STOPPED, ["c"],
+                        image="debian")
+    events = service_events._DiffServices(old, new)
+    self.assertEqual([ServiceEventPb.EVENT_OPTIONS_UPDATED,
+                      ServiceEventPb.EVENT_REQUEST_ADDED,
+                      ServiceEventPb.EVENT_REQUEST_REMOVED,
+                      ServiceEventPb.EVENT_STATUS_CHANGED], _Types(events))
+    self.assertEqual("c", events[1].request_id.service_id.name)
+    self.assertEqual("b", events[2].request_id.service_id.name)
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, events[3].old_status)
+    self.assertEqual(ServiceStatePb.STATUS_STOPPED, events[3].new_status)
+
+
+class EventFilterTest(absltest.TestCase):
+
+  def _MakeEvent(self, srv_id, event_type=ServiceEventPb.EVENT_STATUS_CHANGED):
+    return ServiceEventPb(type=event_type, id=srv_id.ToProto())
+
+
+  def testMatches(self):
+    self.assertTrue(service_events.EventFilter().Matches(
+        self._MakeEvent(_Id("a"))))
+
+    event_filter = service_events.EventFilter(
+        service_ids=[_Id("a", ["other"])], namespaces=[["robot", "arm"]],
+        event_types=[ServiceEventPb.EVENT_STATUS_CHANGED])
+    self.assertTrue(event_filter.Matches(self._MakeEvent(_Id("a", ["other"]))))
+    self.assertTrue(event_filter.Matches(
+        self._MakeEvent(_Id("b", ["robot", "arm", "left"]))))
+    self.assertFalse(event_filter.Matches(self._MakeEvent(_Id("b"))))
+    self.assertFalse(event_filter.Matches(self._MakeEvent(
+        _Id("a", ["other"]), ServiceEventPb.EVENT_SERVICE_CREATED)))
+    # Resyncs always go through.
+    self.assertTrue(event_filter.Matches(
+        ServiceEventPb(type=ServiceEventPb.EVENT_RESYNC)))
+
+
+  def testFromProto(self):
+    request = service_manager_rpc_pb2.WatchServicesRequest()
+    request.ids.extend([_Id("a").ToProto()])
+    request.types.append(ServiceEventPb.EVENT_SERVICE_REMOVED)
+    event_filter = service_events.EventFilter.FromProto(request)
+    self.assertTrue(event_filter.Matches(
+        self._MakeEvent(_Id("a"), ServiceEventPb.EVENT_SERVICE_REMOVED)))
+    self.assertFalse(event_filter.Matches(
+        self._MakeEvent(_Id("b"), ServiceEventPb.EVENT_SERVICE_REMOVED)))
+
+
+class ServiceEventHubTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ServiceEventHubTest, self).setUp()
+    FLAGS.watch_history_size = 3
+    FLAGS.watch_queue_size = 2
+    FLAGS.watch_max_watchers = 2
+    FLAGS.watch_cpu_threshold = 0
+    FLAGS.watch_memory_threshold_mb = 0
+    self._hub = service_events.ServiceEventHub()
+    self._snapshot = state_snapshot.StateSnapshot()
+
+
+  def _SetStatus(self, name, status):
+    """Publishes the change of the status of a service."""
+    new_snapshot = self._snapshot.Update(
+        {_Id(name): _MakeServiceState(_Id(name), status)}, {_Id(name): None})
+    self._hub.PublishChanges(self._snapshot, new_snapshot, [_Id(name)])
+    self._snapshot = new_snapshot
+
+
+  def _GetAll(self, subscription):
+    result = []
+    while True:
+      event = subscription.Get(0)
+      if event is None:
+        return result
+      result.append(event)
+
+
+  def testPublishesInOrder(self):
+    subscription = self._hub.Subscribe(service_events.EventFilter())
+    self._SetStatus("a", ServiceStatePb.STATUS_STOPPED)
+    events = self._GetAll(subscription)
+    self.assertEqual([ServiceEventPb.EVENT_SERVICE_CREATED], _Types(events))
+    self.assertEqual(1, events[0].revision)
+    self.assertGreater(events[0].timestamp.seconds, 0)
+    self.assertEqual(1, self._hub.GetRevision())
+
+
+  def testResumeFromRevision(self):
+    self._SetStatus("a", ServiceStatePb.STATUS_STOPPED)
+    self._SetStatus("a", ServiceStatePb.STATUS_ACTIVE)
+    self._SetStatus("a", ServiceStatePb.STATUS_STOPPED)
+    subscription = self._hub.Subscribe(
+        service_events.EventFilter(), from_revision=1)
+    self.assertEqual([2, 3], [x.revision for x in self._GetAll(subscription)])
+    subscription.Close()
+    # Already up to date.
+    subscription = self._hub.Subscribe(
+        service_events.EventFilter(), from_revision=3)
+    self.assertEqual([], self._GetAll(subscription))
+
+
+  def testResyncWhenHistoryIsGone(self):
+    FLAGS.watch_queue_size = 10
+    for status in [ServiceStatePb.STATUS_STOPPED, ServiceStatePb.STATUS_ACTIVE,
+                   ServiceStatePb.STATUS_STOPPED, ServiceStatePb.STATUS_ACTIVE]:
+      self._SetStatus("a", status)
+    # Only the revisions 2 to 4 are kept.
+    subscription = self._hub.Subscribe(
+        service_events.EventFilter(), from_revision=1)
+    self.assertEqual([2, 3, 4],
+                     [x.revision for x in self._GetAll(subscription)])
+    subscription.Close()
+    for from_revision in [0.5, 5]:
+      subscription = self._hub.Subscribe(
+          service_events.EventFilter(), from_revision=from_revision)
+      events = self._GetAll(subscription)
+      self.assertEqual([ServiceEventPb.EVENT_RESYNC], _Types(events))
+      self.assertEqual(4, events[0].revision)
+      subscription.Close()
+
+    # A restarted server continues from its revision, without history.
+    self._hub.SetRevision(10)
+    subscription = self._hub.Subscribe(
+        service_events.EventFilter(), from_revision=4)
+    self.assertEqual([ServiceEventPb.EVENT_RESYNC],
+                     _Types(self._GetAll(subscription)))
+
+
+  def testQueueOverflow(self):
+    subscription = self._hub.Subscribe(service_events.EventFilter())
+    self._SetStatus("a", ServiceStatePb.STATUS_STOPPED)
+    self._SetStatus("a", ServiceStatePb.STATUS_ACTIVE)
+    self._SetStatus("a", ServiceStatePb.STATUS_STOPPED)
+    # The watcher missed the events up to revision 2.
+    events = self._GetAll(subscription)
+    self.assertEqual([ServiceEventPb.EVENT_RESYNC,
+                      ServiceEventPb.EVENT_STATUS_CHANGED], _Types(events))
+    self.assertEqual([2, 3], [x.revision for x in events])
+
+
+  def testFilteredEventsDoNotFillTheQueue(self):
+    subscription = self._hub.Subscribe(
+        service_events.EventFilter(service_ids=[_Id("b")]))
+    for status in [ServiceStatePb.STATUS_STOPPED, ServiceStatePb.STATUS_ACTIVE,
+                   ServiceStatePb.STATUS_STOPPED]:
+      self._SetStatus("a", status)
+    self._SetStatus("b", ServiceStatePb.STATUS_STOPPED)
+    self.assertEqual([ServiceEventPb.EVENT_SERVICE_CREATED],
+                     _Types(self._GetAll(subscription)))
+
+
+  def testMaxWatchersAndClose(self):
+    subscriptions = [self._hub.Subscribe(service_events.EventFilter())
+                     for _ in range(2)]
+    self.assertIsNone(self._hub.Subscribe(service_events.EventFilter()))
+    wakeups = []
+    subscriptions[0].SetWakeup(lambda: wakeups.append(True))
+    subscriptions[0].Close()
+    self.assertTrue(subscriptions[0].IsClosed())
+    self.assertIsNone(subscriptions[0].Get())
+    self.assertEqual([True], wakeups)
+    self.assertIsNotNone(self._hub.Subscribe(service_events.EventFilter()))
+    self._hub.CloseAll()
+    self.assertTrue(subscriptions[1].IsClosed())
+
+
+  def testResourceThresholds(self):
+    FLAGS.watch_cpu_threshold = 1.0
+    FLAGS.watch_memory_threshold_mb = 100
+    self.assertTrue(self._hub.HasResourceThresholds())
+    subscription = self._hub.Subscribe(service_events.EventFilter())
+    memory = 50 * 1024 * 1024
+    self._hub.PublishResourceUsage(_Id("a"), 0.5, memory)
+    self.assertEqual([], self._GetAll(subscription))
+
+    self._hub.PublishResourceUsage(_Id("a"), 1.5, memory)
+    events = self._GetAll(subscription)
+    self.assertEqual([ServiceEventPb.EVENT_CPU_THRESHOLD_CROSSED],
+                     _Types(events))
+    self.assertTrue(events[0].above_threshold)
+    self.assertEqual(1.5, events[0].cpu_usage)
+    # Only the crossings are published.
+    self._hub.PublishResourceUsage(_Id("a"), 2.0, None)
+    self.assertEqual([], self._GetAll(subscription))
+
+    self._hub.PublishResourceUsage(_Id("a"), 0.5, 200 * 1024 * 1024)
+    events = self._GetAll(subscription)
+    self.assertEqual([ServiceEventPb.EVENT_CPU_THRESHOLD_CROSSED,
+                      ServiceEventPb.EVENT_MEMORY_THRESHOLD_CROSSED],
+                     _Types(events))
+    self.assertEqual([False, True], [x.above_threshold for x in events])
+
+
+if __name__ == "__main__":
+  absltest.main()
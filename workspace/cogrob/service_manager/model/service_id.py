@@ -26,11 +26,18 @@
 
 from cogrob.service_manager.proto import service_options_pb2
 from cogrob.service_manager.util import errors
-import collections
 import re
 
 ServiceIdPb = service_options_pb2.ServiceId
 
+try:
+  _STRING_TYPES = (basestring,)
+  from collections import Iterable as _Iterable
+except NameError:
+  # Python 3, used by the grpc.aio server.
+  _STRING_TYPES = (str,)
+  from collections.abc import Iterable as _Iterable
+
 
 class ServiceId(object):
 
@@ -52,15 +59,15 @@ class ServiceId(object):
 
   def __init__(self, namespace, name):
     """Construct from namespace (iterable of string) and a name (string)."""
-    assert isinstance(namespace, collections.Iterable), (
+    assert isinstance(namespace, _Iterable), (
         "Namespace must be iterable.")
-    assert not isinstance(namespace, basestring), (
+    assert not isinstance(namespace, _STRING_TYPES), (
         "Namespace cannot be a string, did you forget []?")
     for ns_component in namespace:
-      assert isinstance(ns_component, basestring), (
+      assert isinstance(ns_component, _STRING_TYPES), (
           "Namespace can only contain string: {}".format(str(namespace)))
       # TODO(shengye): we should check namespace is only [a-zA-Z_-]
-    assert isinstance(name, basestring), "Name must be a string."
+    assert isinstance(name, _STRING_TYPES), "Name must be a string."
 
     self._namespace = tuple(namespace)
     self._name = name
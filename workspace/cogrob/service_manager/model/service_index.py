@@ -0,0 +1,169 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from cogrob.service_manager.model import service_id
+
+ServiceId = service_id.ServiceId
+
+
+class _NamespaceNode(object):
+  # A node of the namespace trie: the services directly in this namespace,
+  # the sub-namespaces, and the number of services under this node.
+
+  def __init__(self):
+    self.children = {}
+    self.service_ids = set()
+    self.num_services = 0
+
+
+  def IterServiceIds(self):
+    pending = [self]
+    while pending:
+      node = pending.pop()
+      for srv_id in node.service_ids:
+        yield srv_id
+      pending.extend(node.children.values())
+
+
+class ServiceIndex(object):
+  # Indexes the services of a StateSnapshot by namespace (a trie), status,
+  # type, run mode and whether they are requested, so that a filtered query
+  # costs about the number of services matching its most selective filter,
+  # not the number of all services. Not thread-safe, the ServiceManager
+  # updates it together with its snapshot.
+
+  def __init__(self):
+    self._root = _NamespaceNode()
+    # ServiceId to the (status, type, run_mode, has_requesters) it is indexed
+    # under.
+    self._attributes = {}
+    self._by_status = {}
+    self._by_type = {}
+    self._by_run_mode = {}
+    self._by_has_requesters = {True: set(), False: set()}
+
+
+  @staticmethod
+  def _Attributes(service_snapshot):
+    return (service_snapshot.status, service_snapshot.options.type,
+            service_snapshot.options.run_mode,
+            bool(service_snapshot.requested_by_others))
+
+
+  def _Add(self, srv_id, attributes):
+    self._attributes[srv_id] = attributes
+    node = self._root
+    node.num_services += 1
+    for part in srv_id.namespace:
+      node = node.children.setdefault(part, _NamespaceNode())
+      node.num_services += 1
+    node.service_ids.add(srv_id)
+    status, srv_type, run_mode, has_requesters = attributes
+    self._by_status.setdefault(status, set()).add(srv_id)
+    self._by_type.setdefault(srv_type, set()).add(srv_id)
+    self._by_run_mode.setdefault(run_mode, set()).add(srv_id)
+    self._by_has_requesters[has_requesters].add(srv_id)
+
+
+  def _Remove(self, srv_id):
+    attributes = self._attributes.pop(srv_id, None)
+    if attributes is None:
+      return
+    path = [self._root]
+    for part in srv_id.namespace:
+      path.append(path[-1].children[part])
+    path[-1].service_ids.discard(srv_id)
+    for node in path:
+      node.num_services -= 1
+    # Drop the namespaces left empty.
+    for depth in range(len(srv_id.namespace), 0, -1):
+      node = path[depth]
+      if node.num_services:
+        break
+      del path[depth - 1].children[srv_id.namespace[depth - 1]]
+    status, srv_type, run_mode, has_requesters = attributes
+    self._by_status[status].discard(srv_id)
+    self._by_type[srv_type].discard(srv_id)
+    self._by_run_mode[run_mode].discard(srv_id)
+    self._by_has_requesters[has_requesters].discard(srv_id)
+
+
+  def Update(self, snapshot, service_ids):
+    """Re-index service_ids from a state_snapshot.StateSnapshot, removing the
+    ones it does not have."""
+    for srv_id in service_ids:
+      service_snapshot = snapshot.GetService(srv_id)
+      attributes = (self._Attributes(service_snapshot)
+                    if service_snapshot is not None else None)
+      if attributes == self._attributes.get(srv_id):
+        continue
+      self._Remove(srv_id)
+      if attributes is not None:
+        self._Add(srv_id, attributes)
+
+
+  def _GetNamespaceNode(self, namespace_prefix):
+    node = self._root
+    for part in namespace_prefix:
+      node = node.children.get(part)
+      if node is None:
+        return _NamespaceNode()
+    return node
+
+
+  def Query(self, namespace_prefix=(), statuses=(), types=(), run_modes=(),
+            has_requesters=None):
+    """Returns the ids of the services matching all the given filters, empty
+    filters match everything. has_requesters is None, True or False."""
+    # Each filter gives candidates. Only the smallest of them are iterated,
+    # the other filters are checked on the attributes of each candidate.
+    candidate_sources = []
+    for values, index in [(statuses, self._by_status),
+                          (types, self._by_type),
+                          (run_modes, self._by_run_mode)]:
+      if values:
+        sets = [index.get(x, frozenset()) for x in set(values)]
+        candidate_sources.append((sum(len(x) for x in sets), sets))
+    if has_requesters is not None:
+      candidate_sets = [self._by_has_requesters[has_requesters]]
+      candidate_sources.append((len(candidate_sets[0]), candidate_sets))
+    if namespace_prefix or not candidate_sources:
+      node = self._GetNamespaceNode(namespace_prefix)
+      candidate_sources.append((node.num_services, [node.IterServiceIds()]))
+    candidates = min(candidate_sources, key=lambda x: x[0])[1]
+
+    namespace_prefix = tuple(namespace_prefix)
+    result = []
+    for candidate_set in candidates:
+      for srv_id in candidate_set:
+        status, srv_type, run_mode, requested = self._attributes[srv_id]
+        if ((not statuses or status in statuses) and
+            (not types or srv_type in types) and
+            (not run_modes or run_mode in run_modes) and
+            (has_requesters is None or requested == has_requesters) and
+            srv_id.namespace[:len(namespace_prefix)] == namespace_prefix):
+          result.append(srv_id)
+    return result
@@ -0,0 +1,132 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_index
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.model import state_snapshot
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.proto import service_state_pb2
+
+ServiceId = service_id.ServiceId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+class _FakeSnapshot(object):
+  # Stands for a state_snapshot.StateSnapshot.
+
+  def __init__(self):
+    self.services = {}
+
+
+  def Set(self, srv_id, status=ServiceStatePb.STATUS_STOPPED,
+          srv_type=service_options_pb2.SERVICE_TYPE_DOCKER,
+          requested=False):
+    pb = ServiceStatePb()
+    pb.id.CopyFrom(srv_id.ToProto())
+    pb.status = status
+    pb.options.type = srv_type
+    if requested:
+      pb.requested_by_others.add().CopyFrom(service_request.ServiceRequestId(
+          ServiceId(["robot"], "requester"), "uuid").ToProto())
+    self.services[srv_id] = state_snapshot.CreateServiceSnapshot(pb, None)
+
+
+  def GetService(self, srv_id):
+    return self.services.get(srv_id)
+
+
+def _Names(srv_ids):
+  return sorted("/".join(x.namespace + (x.name,)) for x in srv_ids)
+
+
+class ServiceIndexTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ServiceIndexTest, self).setUp()
+    self._snapshot = _FakeSnapshot()
+    self._snapshot.Set(ServiceId(["robot", "arm"], "driver"),
+                       status=ServiceStatePb.STATUS_ACTIVE, requested=True)
+    self._snapshot.Set(ServiceId(["robot", "arm"], "planner"))
+    self._snapshot.Set(ServiceId(["robot"], "base"),
+                       status=ServiceStatePb.STATUS_ACTIVE)
+    self._snapshot.Set(ServiceId(["robot"], "all"),
+                       srv_type=service_options_pb2.SERVICE_TYPE_GROUP)
+    self._snapshot.Set(ServiceId(["sim"], "world"))
+    self._index = service_index.ServiceIndex()
+    self._index.Update(self._snapshot, list(self._snapshot.services))
+
+
+  def testQueryByNamespace(self):
+    self.assertEqual(5, len(self._index.Query()))
+    self.assertEqual(["robot/all", "robot/arm/driver", "robot/arm/planner",
+                      "robot/base"],
+                     _Names(self._index.Query(["robot"])))
+    self.assertEqual(["robot/arm/driver", "robot/arm/planner"],
+                     _Names(self._index.Query(["robot", "arm"])))
+    self.assertEqual([], self._index.Query(["robot", "leg"]))
+    # A prefix is made of whole namespace parts.
+    self.assertEqual([], self._index.Query(["rob"]))
+
+
+  def testQueryCombinesFilters(self):
+    self.assertEqual(
+        ["robot/arm/driver", "robot/base"],
+        _Names(self._index.Query(statuses=[ServiceStatePb.STATUS_ACTIVE])))
+    self.assertEqual(
+        ["robot/base"],
+        _Names(self._index.Query(statuses=[ServiceStatePb.STATUS_ACTIVE],
+                                 has_requesters=False)))
+    self.assertEqual(
+        ["robot/all"],
+        _Names(self._index.Query(
+            ["robot"], types=[service_options_pb2.SERVICE_TYPE_GROUP])))
+    self.assertEqual(
+        ["robot/arm/driver"],
+        _Names(self._index.Query(["robot", "arm"], has_requesters=True)))
+    self.assertEqual(
+        [], self._index.Query(["sim"], statuses=[ServiceStatePb.STATUS_ACTIVE]))
+
+
+  def testUpdate(self):
+    planner_id = ServiceId(["robot", "arm"], "planner")
+    self._snapshot.Set(planner_id, status=ServiceStatePb.STATUS_ACTIVE)
+    del self._snapshot.services[ServiceId(["robot", "arm"], "driver")]
+    del self._snapshot.services[ServiceId(["sim"], "world")]
+    self._index.Update(self._snapshot, [
+        planner_id, ServiceId(["robot", "arm"], "driver"),
+        ServiceId(["sim"], "world"), ServiceId(["sim"], "unknown")])
+    self.assertEqual(
+        ["robot/arm/planner", "robot/base"],
+        _Names(self._index.Query(statuses=[ServiceStatePb.STATUS_ACTIVE])))
+    self.assertEqual([], self._index.Query(has_requesters=True))
+    self.assertEqual([], self._index.Query(["sim"]))
+    self.assertEqual(3, len(self._index.Query()))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -26,52 +26,133 @@
 
 from absl import flags
 from absl import logging
+from cogrob.service_manager.model import activation_executor
+from cogrob.service_manager.model import deactivation_planner
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import dependency_graph
 from cogrob.service_manager.model import meta_service
+from cogrob.service_manager.model import docker_py
 from cogrob.service_manager.model import docker_service
+from cogrob.service_manager.model import file_state_storage
 from cogrob.service_manager.model import group_service
+from cogrob.service_manager.model import journal_state_storage
+from cogrob.service_manager.model import service_events
 from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_index
+from cogrob.service_manager.model import sqlite_state_storage
+from cogrob.service_manager.model import state_committer
+from cogrob.service_manager.model import state_snapshot
 from cogrob.service_manager.proto import service_options_pb2
 from cogrob.service_manager.proto import service_state_pb2
+from cogrob.service_manager.proto import state_journal_pb2
 from cogrob.service_manager.util import errors
+from cogrob.service_manager.util import rpc_deadline
+from cogrob.service_manager.util import timed_lock
+import collections
 import concurrent.futures
-import google.protobuf.text_format
+import contextlib
+import functools
 import os.path
 import threading
 import time
 
 flags.DEFINE_string(
     "service_manager_storage_base_path", "/tmp/RorgStorage",
-    "Base path to store .service_state files.")
+    "Base path to store the service states.")
 flags.DEFINE_integer(
     "refresh_stats_num_threads", 40,
     "Number of worker threads to refresh stats.")
 flags.DEFINE_integer(
     "minimal_time_secs_between_refresh_stats", 1,
     "Minimal time gap between full refresh of stats.")
+flags.DEFINE_enum(
+    "service_manager_storage_backend", "file", ["file", "journal", "sqlite"],
+    "How to store the service states: file (one .service_state file per "
+    "service), journal (a snapshot and an append-only journal) or sqlite (one "
+    "SQLite database).")
 FLAGS = flags.FLAGS
 ServiceId = service_id.ServiceId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+def _CreateStateStorage():
+  base_path = FLAGS.service_manager_storage_base_path
+  if FLAGS.service_manager_storage_backend == "journal":
+    return journal_state_storage.JournalStateStorage(base_path)
+  elif FLAGS.service_manager_storage_backend == "sqlite":
+    return sqlite_state_storage.SqliteStateStorage(
+        os.path.join(base_path, "service_state.db"))
+  return file_state_storage.FileStateStorage(base_path)
+
+
+class _SnapshotChange(object):
+  # A new snapshot, whose events wait for the commit of its changes.
+
+  def __init__(self, old_snapshot, new_snapshot, service_ids):
+    self.old_snapshot = old_snapshot
+    self.new_snapshot = new_snapshot
+    self.service_ids = service_ids
+    self.committed = False
 
 
 class ServiceManager(object):
 
   def __init__(self):
-    # TODO(shengye): We need to add mutex to the manager.
+    # _lock protects _managed_services, _service_locks and the change sets
+    # below. It is only held for short bookkeeping, never while calling into a
+    # service.
+    self._lock = threading.Lock()
     self._managed_services = {}
 
-    self._base_path = FLAGS.service_manager_storage_base_path
-    self._service_state_extension = ".service_state"
-    self._remove_extension = ".removed"
+    # One lock per service, see LockServices.
+    self._service_locks = {}
+
+    # Requester ServiceId to {ServiceRequestId: tuple of the requested
+    # ServiceIds} of every request it sent and did not release yet, in the
+    # order they were sent. Kept up to date by the services, under _lock.
+    self._requests_by_requester = {}
+
+    # The static dependencies of the managed services. Cycles are rejected
+    # when a service is added or its dependencies are updated.
+    self._dependency_graph = dependency_graph.DependencyGraph()
+
+    # Start the containers activated within PlanActivation, and stop those
+    # deactivated within DeferContainerStops, in parallel. The plans of the
+    # current thread, if any, are _thread_plans.activation and
+    # _thread_plans.deactivation.
+    self._activation_executor = activation_executor.ActivationExecutor(
+        on_start_failed=self._RollBackActivation)
+    self._deactivation_planner = deactivation_planner.DeactivationPlanner()
+    self._thread_plans = threading.local()
+
+    # The state of every service as of its last WriteToDisk. Readers use it
+    # without any lock, writers replace it under _snapshot_lock.
+    self._snapshot = state_snapshot.StateSnapshot()
+    self._snapshot_lock = threading.Lock()
+    # Indexes the services of _snapshot, for QueryServices. Only used under
+    # _snapshot_lock.
+    self._index = service_index.ServiceIndex()
+
+    # Publishes the difference of every new snapshot to the watchers, once its
+    # changes are committed.
+    self._event_hub = service_events.ServiceEventHub()
+    # The _SnapshotChange not published yet, in the order of the snapshots.
+    # Protected by _publish_lock.
+    self._unpublished_changes = collections.deque()
+    self._publish_lock = threading.Lock()
+
+    self._storage = _CreateStateStorage()
+    self._state_committer = state_committer.StateCommitter(self._storage)
 
     self._docker_refresh_thread = None
     self._quit_docker_refresh_thread = False
+    self._docker_bind_thread = None
 
-
-  def _ServiceIdToFilePath(self, service_id):
-    """Generate a file path from a service id."""
-    filename = service_id.name + self._service_state_extension
-    path = reduce(os.path.join,
-        [self._base_path] + list(service_id.namespace) + [filename])
-    return path
+    # Services that need to be written to or removed from the storage on the
+    # next WriteToDisk call. Only these are committed, so the cost of
+    # WriteToDisk follows the number of changes, not the number of services.
+    self._changed_service_ids = set()
+    self._removed_service_ids = set()
 
 
   def _ServiceFromPb(self, pb):
@@ -87,7 +168,8 @@ class ServiceManager(object):
 
   def CreateMetaOperatorService(self):
     """Returns true if created, otherwise (already exits) returns false"""
-    if not ServiceId(["__builtin"], "__operator") in self._managed_services:
+    if self.GetService(ServiceId(["__builtin"], "__operator"),
+                       no_raise=True) is None:
       options = service_options_pb2.ServiceOptions()
       options.id.namespace.extend(["__builtin"])
       options.id.name = "__operator"
@@ -102,96 +184,521 @@ class ServiceManager(object):
       return False
 
 
-  def _GetAllManagedFiles(self):
-    all_managed_files = []
-    for dirpath, dirnames, filenames in os.walk(self._base_path):
-      for filename in filenames:
-        full_path = os.path.join(dirpath, filename)
-        if full_path.endswith(self._service_state_extension):
-          all_managed_files.append(full_path)
-        else:
-          logging.warn("Not a %s file: %s",
-                       self._service_state_extension, full_path)
-    return all_managed_files
-
   def LoadFromDisk(self):
-    if not os.path.isdir(self._base_path):
-      logging.error("Cannot load from disk: %s is not valid.",
-                    self._base_path)
+    self._RestoreServices(self._storage.LoadAll())
+
+
+  def _RestoreServices(self, service_states):
+    services = dict((ServiceId.FromProto(pb.id), self._ServiceFromPb(pb))
+                    for pb in service_states)
+    for pb in service_states:
+      # Already on the disk, keep it even if it has a cycle.
+      self._dependency_graph.SetDependencies(
+          ServiceId.FromProto(pb.id),
+          dependency_graph.GetStaticDependencies(pb.options), check=False)
+    with self._lock:
+      self._managed_services.update(services)
+      # Everything we just loaded is identical to what is on the disk.
+      self._changed_service_ids.clear()
+      self._removed_service_ids.clear()
+    with self._snapshot_lock:
+      self._snapshot = self._snapshot.Update(
+          dict((ServiceId.FromProto(pb.id), pb) for pb in service_states),
+          services)
+      self._index.Update(self._snapshot, services.keys())
+
+
+  def ExportSnapshot(self):
+    """Returns the state of all services as a StateSnapshot, used to hand the
+    state off to a new server process."""
+    snapshot = state_journal_pb2.StateSnapshot()
+    snapshot.event_revision = self._event_hub.GetRevision()
+    for service in self.GetAllServices():
+      snapshot.services.add().CopyFrom(service.ToProto())
+    return snapshot
+
+
+  def RestoreFromSnapshot(self, snapshot):
+    """Load the services from a StateSnapshot instead of the disk. The storage
+    takes the states over without reading them again."""
+    self._RestoreServices(snapshot.services)
+    self._event_hub.SetRevision(snapshot.event_revision)
+    self._storage.Adopt(snapshot.services)
+
+
+  def MarkServiceChanged(self, service_id):
+    """Called by services whenever their state is mutated."""
+    with self._lock:
+      self._changed_service_ids.add(service_id)
+
+
+  def _GetServiceLock(self, service_id):
+    with self._lock:
+      lock = self._service_locks.get(service_id)
+      if lock is None:
+        lock = timed_lock.TimedLock()
+        self._service_locks[service_id] = lock
+      return lock
+
+
+  def GetAffectedServiceIds(self, service_ids):
+    """Returns service_ids and every service that requesting, releasing,
+    updating or removing them can reach: the services they request and their
+    implied dependencies, transitively."""
+    result = set()
+    pending = list(service_ids)
+    while pending:
+      srv_id = pending.pop()
+      if srv_id in result:
+        continue
+      # The static dependencies are one lookup in the graph, only the requests
+      # sent at runtime need to be followed.
+      new_ids = set(self._dependency_graph.GetTransitiveDependencies(srv_id))
+      new_ids.add(srv_id)
+      new_ids -= result
+      result.update(new_ids)
+      for new_id in new_ids:
+        service = self.GetService(new_id, no_raise=True)
+        if service is not None:
+          pending.extend(x for x in service.GetRequestedServiceIds()
+                         if x not in result)
+    return result
+
+
+  @contextlib.contextmanager
+  def LockServices(self, service_ids, timeout=None):
+    """Locks service_ids and all the services an operation on them can reach,
+    and yields the set of locked ids. Operations on unrelated services run
+    concurrently. Locks are acquired in a global order so that two operations
+    cannot deadlock. Raises errors.DeadlineExceededError if the locks are not
+    acquired in timeout seconds (waits forever if None)."""
+    timeout = rpc_deadline.NormalizeTimeout(timeout)
+    deadline = None if timeout is None else time.time() + timeout
+    locked_ids = set()
+    locks = []
+    try:
+      wanted_ids = self.GetAffectedServiceIds(service_ids)
+      while True:
+        for srv_id in sorted(wanted_ids, key=lambda x: (x.namespace, x.name)):
+          lock = self._GetServiceLock(srv_id)
+          if not lock.Acquire(None if deadline is None
+                              else max(0, deadline - time.time())):
+            raise errors.DeadlineExceededError(
+                "Timed out waiting for service {}.".format(srv_id))
+          locks.append(lock)
+        locked_ids = wanted_ids
+        # The services could have changed while we were waiting for the locks.
+        affected_ids = self.GetAffectedServiceIds(service_ids)
+        if affected_ids <= locked_ids:
+          break
+        for lock in reversed(locks):
+          lock.Release()
+        locks = []
+        wanted_ids = locked_ids | affected_ids
+      yield locked_ids
+    finally:
+      for lock in reversed(locks):
+        lock.Release()
+
+
+  @contextlib.contextmanager
+  def PlanActivation(self):
+    """The containers activated on this thread within this context are not
+    started right away, but all together by the activation executor when the
+    context exits, in waves following their dependencies. Nested contexts
+    share the outermost plan."""
+    if getattr(self._thread_plans, "activation", None) is not None:
+      yield
       return
+    plan = activation_executor.ActivationPlan(
+        self._activation_executor, self._dependency_graph)
+    self._thread_plans.activation = plan
+    try:
+      yield
+    finally:
+      self._thread_plans.activation = None
+      # Even after an error, what was activated is in the state already.
+      self._activation_executor.Run(plan)
+
+
+  def StartContainer(self, service_id, start_fn):
+    """Called by a service to start its container by calling start_fn, which
+    returns the list of DelayedAction for it to be ready. Within
+    PlanActivation, this is only planned. Returns a DelayedAction met once the
+    service is started and ready."""
+    stop_plan = getattr(self._thread_plans, "deactivation", None)
+    if stop_plan is not None:
+      # Deactivated and activated again by the same operation.
+      stop_plan.RemoveStop(service_id)
+    plan = getattr(self._thread_plans, "activation", None)
+    if plan is not None:
+      return plan.AddStart(service_id, start_fn)
+    return delayed_action.AllOf(start_fn())
+
+
+  def _RollBackActivation(self, start):
+    """Called by the activation executor when the container of a service could
+    not be started. Deactivates the service, unless it was deactivated or
+    activated again since, and commits."""
+    srv_id = start.service_id
+    commit_seq = None
+    with self.LockServices([srv_id]) as locked_ids:
+      service = self.GetService(srv_id, no_raise=True)
+      if (service is not None and service.IsActive() and
+          self._activation_executor.IsLatestStart(start)):
+        logging.warn("Deactivating %s, its container did not start.",
+                     str(srv_id))
+        try:
+          with self.DeferContainerStops():
+            service.DeactivateSelf(force=True)
+        except errors.ServiceManagerError as e:
+          logging.error("Cannot roll back the activation of %s: %s",
+                        str(srv_id), str(e))
+        commit_seq = self.WriteToDisk(locked_ids)
+    if commit_seq is not None:
+      self.WaitForCommit(commit_seq)
+
+
+  def CancelContainerStart(self, service_id):
+    """Called by a service before it stops its container, so that a planned
+    start does not happen after the stop."""
+    self._activation_executor.Cancel(service_id)
+
+
+  @contextlib.contextmanager
+  def DeferContainerStops(self, stop_timeout=None, deadline=None):
+    """The containers deactivated on this thread within this context are not
+    stopped right away, but all together when the context exits, dependents
+    before their dependencies and all those at the same depth in parallel.
+    Each has stop_timeout seconds to stop before it is killed, and all of them
+    deadline seconds (flag defaults if None). Raises errors.InternalError on
+    exit if some could not be stopped. Nested contexts share the outermost
+    plan."""
+    if getattr(self._thread_plans, "deactivation", None) is not None:
+      yield
+      return
+    plan = deactivation_planner.DeactivationPlan(
+        self._dependency_graph, stop_timeout, deadline)
+    self._thread_plans.deactivation = plan
+    try:
+      yield
+    finally:
+      self._thread_plans.deactivation = None
+      failures = self._deactivation_planner.Run(plan)
+    if failures:
+      raise errors.InternalError(
+          "Cannot stop the containers of {}: {}".format(
+              ", ".join(str(x) for x, _ in failures), failures[0][1]))
+
+
+  def StopContainer(self, service_id, stop_fn):
+    """Called by a service to stop its container by calling stop_fn with the
+    timeout in seconds before it is killed. Within DeferContainerStops, this
+    is only planned."""
+    plan = getattr(self._thread_plans, "deactivation", None)
+    if plan is not None:
+      plan.AddStop(service_id, stop_fn)
+    else:
+      stop_fn(FLAGS.deactivation_stop_timeout_secs)
+
+
+  def DrainNamespace(self, namespace_prefix=(), timeout=None,
+                     stop_timeout=None, deadline=None):
+    """Deactivate every active service in namespace_prefix (all services if
+    empty), except those with disable_deactivate, and commit. The requests
+    sent to them are released first, those still requested are then
+    deactivated anyway. The containers are stopped as in DeferContainerStops.
+    Returns the ids of the deactivated services. Raises
+    errors.DeadlineExceededError if the services are not available in timeout
+    seconds."""
+    targets = self.QueryServices(
+        namespace_prefix, statuses=set([ServiceStatePb.STATUS_ACTIVE]))
+    # The requesters are changed too when their requests are released.
+    lock_ids = [x.service_id for x in targets]
+    for target in targets:
+      lock_ids.extend(x.service_id for x in target.requested_by_others)
+
+    deactivated_ids = []
+    error = None
+    with self.LockServices(lock_ids, timeout) as locked_ids:
+      try:
+        with self.DeferContainerStops(stop_timeout, deadline):
+          waves = self._dependency_graph.GetWaves(
+              [x.service_id for x in targets], dependents_first=True)
+          for srv_id in [x for wave in waves for x in wave]:
+            service = self.GetService(srv_id, no_raise=True)
+            if (service is None or not service.IsActive() or
+                service.GetStateProto().options.disable_deactivate):
+              continue
+            for request_id in service.GetRequestedByOthers():
+              if request_id.service_id not in locked_ids:
+                continue
+              try:
+                self.ReleaseService(request_id)
+              except errors.ServiceManagerError as e:
+                logging.warn("Cannot release %s while draining: %s",
+                             str(request_id), str(e))
+            try:
+              if service.IsActive():
+                service.DeactivateSelf(force=True)
+            except errors.ServiceManagerError as e:
+              logging.error("Cannot deactivate %s: %s", str(srv_id), str(e))
+              error = error or e
+      except errors.ServiceManagerError as e:
+        error = error or e
+      # Including those deactivated by the release of their requests.
+      for target in targets:
+        service = self.GetService(target.service_id, no_raise=True)
+        if service is not None and not service.IsActive():
+          deactivated_ids.append(target.service_id)
+      commit_seq = self.WriteToDisk(locked_ids)
+    self.WaitForCommit(commit_seq)
+    if error is not None:
+      raise error
+    return deactivated_ids
+
+
+  def WriteToDisk(self, service_ids=None):
+    """Enqueue the changed services to be written to the disk. Returns a
+    sequence number for WaitForCommit. Only the changes to service_ids (all
+    services if None) are written, the caller must hold their locks (see
+    LockServices), so that their states are stable.
+
+    The snapshot (see GetSnapshot and QueryServices) is updated right away,
+    so it can show changes that are not committed yet, and are lost if the
+    commit fails and the server dies before a retry. The watchers only get
+    the events of the changes once they are committed."""
+    with self._lock:
+      if service_ids is None:
+        removed_ids = set(self._removed_service_ids)
+        changed_ids = set(self._changed_service_ids)
+      else:
+        removed_ids = self._removed_service_ids & service_ids
+        changed_ids = self._changed_service_ids & service_ids
+      self._removed_service_ids -= removed_ids
+      self._changed_service_ids -= changed_ids
+      # A service that was removed and then added again is only in
+      # _changed_service_ids. A service could have been marked as changed
+      # before it was added (or after it was removed), skip those.
+      removed_ids = set(x for x in removed_ids
+                        if x not in self._managed_services)
+      changed_services = [self._managed_services[x] for x in changed_ids
+                          if x in self._managed_services]
+
+    changes = dict((x, None) for x in removed_ids)
+    for service in changed_services:
+      changes[service.GetServiceId()] = service.ToProto()
+
+    if not changes:
+      return self._state_committer.Enqueue(changes)
+    with self._snapshot_lock:
+      snapshot_change = _SnapshotChange(
+          self._snapshot,
+          self._snapshot.Update(
+              changes, dict((x.GetServiceId(), x) for x in changed_services)),
+          list(changes.keys()))
+      self._snapshot = snapshot_change.new_snapshot
+      self._index.Update(self._snapshot, changes.keys())
+      with self._publish_lock:
+        self._unpublished_changes.append(snapshot_change)
+    return self._state_committer.Enqueue(
+        changes, functools.partial(self._PublishCommitted, snapshot_change))
+
+
+  def _PublishCommitted(self, snapshot_change):
+    """Called once the changes of a _SnapshotChange are committed. The
+    commits can be enqueued in another order than the snapshots were made,
+    the events are published in the order of the snapshots."""
+    with self._publish_lock:
+      snapshot_change.committed = True
+      while (self._unpublished_changes
+             and self._unpublished_changes[0].committed):
+        change = self._unpublished_changes.popleft()
+        self._event_hub.PublishChanges(
+            change.old_snapshot, change.new_snapshot, change.service_ids)
+
+
+  def GetSnapshot(self):
+    """Returns the current state_snapshot.StateSnapshot, without waiting for
+    the operations in progress."""
+    return self._snapshot
+
+
+  def QueryServices(self, namespace_prefix=(), statuses=(), types=(),
+                    run_modes=(), has_requesters=None):
+    """Returns the state_snapshot.ServiceSnapshot of the services matching all
+    the given filters (see ServiceIndex.Query), sorted by id."""
+    with self._snapshot_lock:
+      snapshot = self._snapshot
+      srv_ids = self._index.Query(namespace_prefix, statuses, types, run_modes,
+                                  has_requesters)
+    srv_ids.sort(key=lambda x: (x.namespace, x.name))
+    return [snapshot.GetService(x) for x in srv_ids]
+
+
+  def GetServiceSnapshot(self, service_id):
+    """Returns the state_snapshot.ServiceSnapshot of a service."""
+    result = self._snapshot.GetService(service_id)
+    if result is None:
+      raise errors.ServiceNotFoundError(
+          "Service {} not found in ServiceManager".format(service_id))
+    return result
+
+
+  def GetEventHub(self):
+    """Returns the service_events.ServiceEventHub of the services."""
+    return self._event_hub
+
 
-    for managed_file in self._GetAllManagedFiles():
-      logging.info("Loading %s", managed_file)
-      with open(managed_file, "r") as fp:
-        pbtxt = fp.read()
-      pb = service_state_pb2.ServiceState()
-      google.protobuf.text_format.Merge(pbtxt, pb)
-      srv = self._ServiceFromPb(pb)
-      self._managed_services[srv.GetServiceId()] = srv
-
-
-  def WriteToDisk(self):
-    """Write all the services to the disk."""
-    # First, dump all the services we have.
-    files_to_keep = []
-    for service in self._managed_services.values():
-      pb = service.ToProto()
-      file_path = self._ServiceIdToFilePath(service.GetServiceId())
-      pb_txt = google.protobuf.text_format.MessageToString(pb)
-      dir_path = os.path.dirname(file_path)
-      if not os.path.isdir(dir_path):
-        os.makedirs(os.path.dirname(file_path))
-      with open(file_path, "w") as fp:
-        fp.write(pb_txt)
-      files_to_keep.append(os.path.abspath(file_path))
-
-    # Then, we scan all the files in self._base_path with
-    # self._service_state_extension. We will append ".removed" to the
-    # filename. If ".removed" already exist, we overwrite that file.
-    files_with_correct_extension = [
-        x for x in self._GetAllManagedFiles()
-        if x.endswith(self._service_state_extension)]
-    files_to_remove = [x for x in files_with_correct_extension
-                       if x not in files_to_keep]
-    for file_to_remove in files_to_remove:
-      new_file_path = file_to_remove + self._remove_extension
-      if os.path.isfile(new_file_path):
-        os.remove(new_file_path)
-      os.rename(file_to_remove, new_file_path)
+  def WaitForCommit(self, commit_seq, timeout=None):
+    """Wait until the changes enqueued by WriteToDisk are on the disk. Does not
+    need to hold the lock of the RPC handler. Raises errors.StateCommitError
+    if they could not be committed, or errors.DeadlineExceededError if they
+    are not committed in timeout seconds (waits forever if None)."""
+    self._state_committer.WaitForCommit(commit_seq, timeout)
+
+
+  def CloseStorage(self):
+    self._state_committer.Stop()
+    self._storage.Close()
 
 
   def AddService(self, service):
-    """Add a service to the manager."""
+    """Add a service to the manager. Raises errors.DependencyCycleError if its
+    dependencies would form a cycle."""
     srv_id = service.GetServiceId()
-    if srv_id in self._managed_services:
-      raise errors.ServiceAlreadyExistError(
-          "Service {} already exist in ServiceManager".format(str(srv_id)))
-    else:
+    with self._lock:
+      if srv_id in self._managed_services:
+        raise errors.ServiceAlreadyExistError(
+            "Service {} already exist in ServiceManager".format(str(srv_id)))
+      self._dependency_graph.SetDependencies(
+          srv_id, dependency_graph.GetStaticDependencies(
+              service.GetStateProto().options))
       self._managed_services[srv_id] = service
-      service.SetManager(self)
+      self._removed_service_ids.discard(srv_id)
+      self._changed_service_ids.add(srv_id)
+    service.SetManager(self)
+
+
+  def CheckDependencies(self, options):
+    """Raises errors.DependencyCycleError if a service with these
+    service_options_pb2.ServiceOptions would be part of a dependency cycle."""
+    self._dependency_graph.CheckDependencies(
+        ServiceId.FromProto(options.id),
+        dependency_graph.GetStaticDependencies(options))
+
+
+  def UpdateDependencies(self, service_id, options, check=True):
+    """Take the dependencies of a service from its new
+    service_options_pb2.ServiceOptions. Raises errors.DependencyCycleError
+    (and changes nothing) if they would form a cycle, unless check is
+    False."""
+    self._dependency_graph.SetDependencies(
+        service_id, dependency_graph.GetStaticDependencies(options), check)
 
 
   def GetService(self, service_id, no_raise=False):
     """Get a service from the manager."""
-    if service_id in self._managed_services:
-      return self._managed_services[service_id]
-    else:
-      if no_raise:
-        return None
-      else:
-        raise errors.ServiceNotFoundError(
-            "Service {} not found in ServiceManager".format(service_id))
+    with self._lock:
+      service = self._managed_services.get(service_id)
+    if service is None and not no_raise:
+      raise errors.ServiceNotFoundError(
+          "Service {} not found in ServiceManager".format(service_id))
+    return service
 
 
   def RemoveService(self, service_id):
     """Remove a service from the manager."""
-
-    if service_id in self._managed_services:
-      self._managed_services[service_id].SetManager(None)
-      self._managed_services.pop(service_id)
-    else:
+    with self._lock:
+      service = self._managed_services.pop(service_id, None)
+      if service is not None:
+        self._changed_service_ids.discard(service_id)
+        self._removed_service_ids.add(service_id)
+        self._dependency_graph.RemoveService(service_id)
+        self._requests_by_requester.pop(service_id, None)
+    if service is None:
       raise errors.ServiceNotFoundError(
           "Service {} not found in ServiceManager".format(service_id))
+    service.SetManager(None)
+
+
+  def IndexRequest(self, service_request):
+    """Called by services when they send a ServiceRequest."""
+    request_id = service_request.request_id
+    with self._lock:
+      requests = self._requests_by_requester.setdefault(
+          request_id.service_id, collections.OrderedDict())
+      requests.pop(request_id, None)
+      requests[request_id] = tuple(service_request.requested_services)
+
+
+  def UnindexRequest(self, service_request_id):
+    """Called by services when they release a ServiceRequest."""
+    with self._lock:
+      requests = self._requests_by_requester.get(service_request_id.service_id)
+      if requests is not None:
+        requests.pop(service_request_id, None)
+        if not requests:
+          del self._requests_by_requester[service_request_id.service_id]
+
+
+  def UnindexRequester(self, requester_id):
+    """Called by services when they forget all the requests they sent."""
+    with self._lock:
+      self._requests_by_requester.pop(requester_id, None)
+
+
+  def GetRequestsByRequester(self, requester_id):
+    """Returns the ServiceRequestIds of the requests requester_id sent and did
+    not release yet, in the order they were sent."""
+    with self._lock:
+      return list(self._requests_by_requester.get(requester_id, ()))
+
+
+  def GetServicesPinnedBy(self, requester_id):
+    """Returns the set of ServiceIds requester_id requests directly, which
+    stay active at least as long as these requests are not released."""
+    with self._lock:
+      requests = self._requests_by_requester.get(requester_id, {})
+      return set(x for srv_ids in requests.values() for x in srv_ids)
+
+
+  def ReleaseAllByRequester(self, requester_id, timeout=None,
+                            stop_timeout=None, deadline=None):
+    """Release every request requester_id sent, e.g. once it died, and commit.
+    The requests it maintains itself while active (see
+    GetSelfMaintainedRequestIds) are kept, they are released once it is
+    deactivated. The services no longer requested are deactivated, their
+    containers are stopped as in DeferContainerStops. Returns the released
+    ServiceRequestIds. Raises errors.DeadlineExceededError if the services are
+    not available in timeout seconds."""
+    requester = self.GetService(requester_id)
+    self_maintained_ids = set(requester.GetSelfMaintainedRequestIds())
+    lock_ids = [requester_id]
+    lock_ids.extend(self.GetServicesPinnedBy(requester_id))
+
+    released_ids = []
+    error = None
+    with self.LockServices(lock_ids, timeout) as locked_ids:
+      try:
+        with self.DeferContainerStops(stop_timeout, deadline):
+          # Under the locks, nothing can be sent or released in between.
+          for request_id in self.GetRequestsByRequester(requester_id):
+            if request_id in self_maintained_ids:
+              continue
+            try:
+              self.ReleaseService(request_id)
+              released_ids.append(request_id)
+            except errors.ServiceManagerError as e:
+              logging.error("Cannot release %s: %s", str(request_id), str(e))
+              error = error or e
+      except errors.ServiceManagerError as e:
+        error = error or e
+      commit_seq = self.WriteToDisk(locked_ids)
+    self.WaitForCommit(commit_seq)
+    if error is not None:
+      raise error
+    return released_ids
 
 
   def RequestService(self, service_request):
@@ -206,13 +713,19 @@ class ServiceManager(object):
 
 
   def GetAllManagedServiceIds(self):
-    return self._managed_services.keys()
+    with self._lock:
+      return list(self._managed_services.keys())
+
+
+  def GetAllServices(self):
+    with self._lock:
+      return list(self._managed_services.values())
 
 
   def CollectAllServiceCpuUsage(self):
     result = 0
-    for service in self._managed_services.values():
-      cpu_usage = service.GetCpuUsage()
+    for service_snapshot in self._snapshot.GetAllServices():
+      cpu_usage = service_snapshot.service.GetCpuUsage()
       if cpu_usage is not None:
         result += cpu_usage
     return result
@@ -220,8 +733,8 @@ class ServiceManager(object):
 
   def CollectAllServiceMemoryUsage(self):
     result = 0
-    for service in self._managed_services.values():
-      memory_usage = service.GetMemoryUsage()
+    for service_snapshot in self._snapshot.GetAllServices():
+      memory_usage = service_snapshot.service.GetMemoryUsage()
       if memory_usage is not None:
         result += memory_usage
     return result
@@ -233,7 +746,7 @@ class ServiceManager(object):
 
     while not self._quit_docker_refresh_thread:
       last_start_time = time.time()
-      all_docker_services = [x for x in self._managed_services.values()
+      all_docker_services = [x for x in self.GetAllServices()
                              if isinstance(x, docker_service.DockerService)]
       pending_futures = []
       for service in all_docker_services:
@@ -247,6 +760,12 @@ class ServiceManager(object):
 
       logging.info("Refershed docker stats.")
 
+      if self._event_hub.HasResourceThresholds():
+        for service in all_docker_services:
+          self._event_hub.PublishResourceUsage(
+              service.GetServiceId(), service.GetCpuUsage(),
+              service.GetMemoryUsage())
+
       while (not self._quit_docker_refresh_thread) and (time.time() <
              last_start_time + FLAGS.minimal_time_secs_between_refresh_stats):
         time.sleep(0.25)
@@ -259,6 +778,63 @@ class ServiceManager(object):
     self._docker_refresh_thread.start()
 
 
+  def ReconcileDockerContainers(self):
+    """Bind all the (non-simulated) docker services from a single listing of
+    the containers, and report those whose container does not match the
+    persisted status. The containers no service uses are only logged. Returns
+    a list of docker_service.ContainerDrift."""
+    all_docker_services = [x for x in self.GetAllServices()
+                           if isinstance(x, docker_service.DockerService)
+                           and not x.IsInSimulation()]
+    containers = docker_py.GetGlobalDockerClient().ListContainers(
+        FLAGS.docker_container_name_prefix)
+    containers_by_id = dict((x.GetId(), x) for x in containers)
+    containers_by_name = dict((x.GetName(), x) for x in containers)
+
+    all_drifts = []
+    bound_container_ids = set()
+    for service in all_docker_services:
+      with self._GetServiceLock(service.GetServiceId()):
+        drift = service.ReconcileDockerContainer(
+            containers_by_id, containers_by_name)
+        bound_container_ids.add(
+            service.GetStateProto().docker_service_state.docker_container_id)
+      if drift is not None:
+        logging.warn(
+            "Container drift: %s is %s, but its container is %s.",
+            str(drift.service_id),
+            service_state_pb2.ServiceState.ServiceStatus.Name(
+                drift.service_status),
+            drift.container_status or "missing")
+        all_drifts.append(drift)
+    orphan_names = sorted(x.GetName() for x in containers
+                          if x.GetId() not in bound_container_ids)
+    if orphan_names:
+      logging.warn("Containers not used by any service: %s.",
+                   ", ".join(orphan_names))
+    logging.info("Reconciled %d docker services with %d containers, "
+                 "%d drifted.", len(all_docker_services), len(containers),
+                 len(all_drifts))
+    return all_drifts
+
+
+  def DockerBindThread(self):
+    try:
+      self.ReconcileDockerContainers()
+    except Exception as e:
+      # Not fatal, containers will be bound when they are used.
+      logging.error("Cannot reconcile docker containers: %s", str(e))
+
+
+  def StartDockerBindThread(self):
+    """Bind the containers of all docker services in the background, so that
+    the first RPC touching them does not wait for the docker daemon."""
+    assert self._docker_bind_thread is None
+    self._docker_bind_thread = threading.Thread(target=self.DockerBindThread)
+    self._docker_bind_thread.daemon = True
+    self._docker_bind_thread.start()
+
+
   def StopDockerRefreshThread(self):
     # TODO(shengye): Race condition! Use a lock to protect
     # self._docker_refresh_thread
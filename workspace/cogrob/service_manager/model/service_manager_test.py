@@ -0,0 +1,430 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import docker_py
+from cogrob.service_manager.model import docker_service
+from cogrob.service_manager.model import fake_docker_py
+from cogrob.service_manager.model import group_service
+from cogrob.service_manager.model import service_events
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_manager
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.proto import service_event_pb2
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.proto import service_state_pb2
+from cogrob.service_manager.util import errors
+import shutil
+import tempfile
+import threading
+import time
+
+FLAGS = flags.FLAGS
+ServiceId = service_id.ServiceId
+ServiceStatePb = service_state_pb2.ServiceState
+_OPERATOR_ID = ServiceId(["__builtin"], "__operator")
+
+
+def _Id(name):
+  return ServiceId(["robot"], name)
+
+
+def _BrokenStart(self, *args, **kwargs):
+  if "broken" in self.GetId():
+    raise RuntimeError("Cannot start {}".format(self.GetId()))
+
+
+class _ListedContainer(fake_docker_py.FakeDockerContainer):
+
+  def __init__(self, container_id, name, status):
+    super(_ListedContainer, self).__init__(container_id)
+    self._name = name
+    self._status = status
+
+
+  def GetName(self):
+    return self._name
+
+
+  def GetStatus(self):
+    return self._status
+
+
+class _ListingDockerClient(fake_docker_py.FakeDockerClient):
+  # Stands for the docker daemon of the services not in simulation.
+
+  def __init__(self):
+    self.containers = []
+
+
+  def ListContainers(self, name_prefix):
+    return [x for x in self.containers if x.GetName().startswith(name_prefix)]
+
+
+class ServiceManagerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ServiceManagerTest, self).setUp()
+    self._dir = tempfile.mkdtemp()
+    FLAGS.service_manager_storage_base_path = self._dir
+    self._manager = service_manager.ServiceManager()
+    self._manager.CreateMetaOperatorService()
+    self._manager.WaitForCommit(self._manager.WriteToDisk())
+    self._original_start = fake_docker_py.FakeDockerContainer.Start
+    fake_docker_py.FakeDockerContainer.Start = _BrokenStart
+
+
+  def tearDown(self):
+    fake_docker_py.FakeDockerContainer.Start = self._original_start
+    self._manager.CloseStorage()
+    shutil.rmtree(self._dir)
+    super(ServiceManagerTest, self).tearDown()
+
+
+  def _AddDockerService(self, name, dependencies=(), wait_for_prober=False,
+                       run_mode=service_options_pb2.RUN_MODE_SIMULATION):
+    options = service_options_pb2.ServiceOptions()
+    options.id.CopyFrom(_Id(name).ToProto())
+    options.type = service_options_pb2.SERVICE_TYPE_DOCKER
+    options.run_mode = run_mode
+    options.docker_service_options.container_options.image = "ubuntu"
+    if wait_for_prober:
+      options.ready_detection_method.wait_for_prober = True
+    for dependency in dependencies:
+      options.implied_dependencies.extend([_Id(dependency).ToProto()])
+    with self._manager.LockServices([_Id(name)]) as locked_ids:
+      self._manager.AddService(
+          docker_service.DockerService.CreateFromServiceOptionsPb(
+              options, self._manager))
+      self._manager.WaitForCommit(self._manager.WriteToDisk(locked_ids))
+
+
+  def _AddGroupService(self, name, grouped_names, dependencies=()):
+    options = service_options_pb2.ServiceOptions()
+    options.id.CopyFrom(_Id(name).ToProto())
+    options.type = service_options_pb2.SERVICE_TYPE_GROUP
+    options.group_service_options.grouped_services.extend(
+        [_Id(x).ToProto() for x in grouped_names])
+    for dependency in dependencies:
+      options.implied_dependencies.extend([_Id(dependency).ToProto()])
+    with self._manager.LockServices([_Id(name)]) as locked_ids:
+      self._manager.AddService(
+          group_service.GroupService.CreateFromServiceOptionsPb(
+              options, self._manager))
+      self._manager.WaitForCommit(self._manager.WriteToDisk(locked_ids))
+
+
+  def _Request(self, uuid, names, requester_id=_OPERATOR_ID):
+    request = service_request.ServiceRequest(
+        service_request.ServiceRequestId(requester_id, uuid),
+        [_Id(x) for x in names])
+    with self._manager.LockServices(
+        [requester_id] + list(request.requested_services)) as locked_ids:
+      with self._manager.PlanActivation():
+        actions = self._manager.RequestService(request)
+      commit_seq = self._manager.WriteToDisk(locked_ids)
+    self._manager.WaitForCommit(commit_seq)
+    return delayed_action.AllOf(actions)
+
+
+  def _GetStatus(self, name):
+    return self._manager.GetServiceSnapshot(_Id(name)).status
+
+
+  def _WaitForStatus(self, name, status, timeout=10):
+    deadline = time.time() + timeout
+    while self._GetStatus(name) != status and time.time() < deadline:
+      time.sleep(0.01)
+    return self._GetStatus(name)
+
+
+  def _HoldLocks(self, service_ids, function=None):
+    """Locks service_ids on another thread, calls function under the locks,
+    and releases them once the returned event is set."""
+    locked = threading.Event()
+    release = threading.Event()
+    def _Hold():
+      with self._manager.LockServices(service_ids):
+        locked.set()
+        release.wait(10)
+        if function is not None:
+          function()
+    thread = threading.Thread(target=_Hold)
+    thread.start()
+    self.assertTrue(locked.wait(10))
+    self.addCleanup(thread.join)
+    self.addCleanup(release.set)
+    return release
+
+
+  def testLockServicesInOrder(self):
+    self._AddDockerService("c")
+    self._AddDockerService("a", ["c"])
+    self._AddDockerService("b")
+    acquired_ids = []
+    get_service_lock = self._manager._GetServiceLock
+    def _GetServiceLock(srv_id):
+      acquired_ids.append(srv_id.name)
+      return get_service_lock(srv_id)
+    self._manager._GetServiceLock = _GetServiceLock
+    with self._manager.LockServices([_Id("b"), _Id("a")]) as locked_ids:
+      self.assertEqual(set(_Id(x) for x in ["a", "b", "c"]), locked_ids)
+    self.assertEqual(["a", "b", "c"], acquired_ids)
+
+
+  def testLockServicesRetriesWhenAffectedServicesGrow(self):
+    self._AddDockerService("a")
+    self._AddDockerService("c")
+    options = service_options_pb2.ServiceOptions()
+    options.implied_dependencies.extend([_Id("c").ToProto()])
+    # a depends on c once the holder releases it, after this thread computed
+    # the services to lock.
+    release = self._HoldLocks(
+        [_Id("a")], lambda: self._manager.UpdateDependencies(_Id("a"), options))
+    threading.Timer(0.05, release.set).start()
+    with self._manager.LockServices([_Id("a")]) as locked_ids:
+      self.assertEqual(set([_Id("a"), _Id("c")]), locked_ids)
+
+
+  def testLockServicesTimeout(self):
+    self._AddDockerService("a")
+    release = self._HoldLocks([_Id("a")])
+    with self.assertRaises(errors.DeadlineExceededError):
+      with self._manager.LockServices([_Id("a")], timeout=0.05):
+        pass
+    # Without a deadline, gRPC reports a huge time remaining.
+    threading.Timer(0.05, release.set).start()
+    with self._manager.LockServices(
+        [_Id("a")], timeout=9.2e18 - time.time()) as locked_ids:
+      self.assertEqual(set([_Id("a")]), locked_ids)
+
+
+  def _RecordCommits(self):
+    """Returns the list the ids of the services of every commit are appended
+    to from now on, with None for a removed service."""
+    commits = []
+    storage = self._manager._storage
+    original_commit = storage.Commit
+    def _Commit(changes):
+      if changes:
+        commits.append(dict(
+            (x.name, None if pb is None else pb.status)
+            for x, pb in changes.items()))
+      original_commit(changes)
+    storage.Commit = _Commit
+    return commits
+
+
+  def testWriteToDiskOnlyWritesChangedServices(self):
+    for name in ["a", "b", "c"]:
+      self._AddDockerService(name)
+    commits = self._RecordCommits()
+    self._manager.WaitForCommit(self._manager.WriteToDisk())
+    self.assertEqual([], commits)
+
+    self.assertTrue(self._Request("r1", ["a"]).Wait(10))
+    self.assertEqual([{"__operator": ServiceStatePb.STATUS_ACTIVE,
+                       "a": ServiceStatePb.STATUS_ACTIVE}], commits)
+
+    # Only the changes to the given services are written.
+    del commits[:]
+    self._manager.MarkServiceChanged(_Id("b"))
+    self._manager.WaitForCommit(self._manager.WriteToDisk(set([_Id("c")])))
+    self.assertEqual([], commits)
+    self._manager.WaitForCommit(self._manager.WriteToDisk(set([_Id("b")])))
+    self.assertEqual([{"b": ServiceStatePb.STATUS_STOPPED}], commits)
+
+    del commits[:]
+    with self._manager.LockServices([_Id("c")]) as locked_ids:
+      self._manager.RemoveService(_Id("c"))
+      self._manager.WaitForCommit(self._manager.WriteToDisk(locked_ids))
+    self.assertEqual([{"c": None}], commits)
+
+
+  def testEventsPublishedAfterCommit(self):
+    self._AddDockerService("a")
+    subscription = self._manager.GetEventHub().Subscribe(
+        service_events.EventFilter())
+    self.addCleanup(subscription.Close)
+    release = threading.Event()
+    storage = self._manager._storage
+    original_commit = storage.Commit
+    def _Commit(changes):
+      release.wait(10)
+      original_commit(changes)
+    storage.Commit = _Commit
+    self.addCleanup(release.set)
+
+    with self._manager.LockServices([_Id("a")]) as locked_ids:
+      self._manager.RemoveService(_Id("a"))
+      commit_seq = self._manager.WriteToDisk(locked_ids)
+    # Read uncommitted from the snapshot, but not told to the watchers.
+    self.assertIsNone(self._manager.GetSnapshot().GetService(_Id("a")))
+    self.assertIsNone(subscription.Get(0.05))
+    release.set()
+    self._manager.WaitForCommit(commit_seq)
+    event = subscription.Get(0)
+    self.assertEqual(service_event_pb2.ServiceEvent.EVENT_SERVICE_REMOVED,
+                     event.type)
+    self.assertEqual(_Id("a").ToProto(), event.id)
+
+
+  def testFailedStartIsRolledBack(self):
+    self._AddDockerService("broken")
+    self._AddDockerService("app", ["broken"])
+    action = self._Request("r1", ["app"])
+    with self.assertRaises(errors.InternalError):
+      action.Wait(10)
+    # The dependent is not started either, both are stopped and committed.
+    for name in ["broken", "app"]:
+      self.assertEqual(
+          ServiceStatePb.STATUS_STOPPED,
+          self._WaitForStatus(name, ServiceStatePb.STATUS_STOPPED))
+
+
+  def testStartedServiceStaysActive(self):
+    self._AddDockerService("app")
+    self.assertTrue(self._Request("r1", ["app"]).Wait(10))
+    time.sleep(0.1)
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, self._GetStatus("app"))
+
+
+  def _WaitForHeartbeatAction(self, name):
+    deadline = time.time() + 10
+    while (_Id(name) not in delayed_action._heartbeat_actions and
+           time.time() < deadline):
+      time.sleep(0.01)
+    self.assertIn(_Id(name), delayed_action._heartbeat_actions)
+
+
+  def testReadyOnHeartbeat(self):
+    self._AddDockerService("app", wait_for_prober=True)
+    action = self._Request("r1", ["app"])
+    self._WaitForHeartbeatAction("app")
+    self.assertFalse(action.Wait(0.05))
+    self.assertEqual(1, delayed_action.NotifyServiceHeartbeat(_Id("app")))
+    self.assertTrue(action.Wait(10))
+
+
+  def testDeactivationFailsHeartbeatWait(self):
+    self._AddDockerService("app", wait_for_prober=True)
+    action = self._Request("r1", ["app"])
+    self._WaitForHeartbeatAction("app")
+    self._manager.ReleaseAllByRequester(_OPERATOR_ID)
+    with self.assertRaises(errors.InternalError):
+      action.Wait(10)
+    self.assertNotIn(_Id("app"), delayed_action._heartbeat_actions)
+
+
+  def testReleaseAllByRequesterKeepsSelfMaintainedRequests(self):
+    self._AddDockerService("lib")
+    self._AddDockerService("app", ["lib"])
+    self._AddDockerService("extra")
+    self.assertTrue(self._Request("r1", ["app"]).Wait(10))
+    self.assertTrue(self._Request("r2", ["extra"], _Id("app")).Wait(10))
+
+    released_ids = self._manager.ReleaseAllByRequester(_Id("app"))
+    self.assertEqual(["r2"], [x.request_uuid for x in released_ids])
+    self.assertEqual(ServiceStatePb.STATUS_STOPPED, self._GetStatus("extra"))
+    # app is still requested, so is its implied dependency.
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, self._GetStatus("app"))
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, self._GetStatus("lib"))
+    self.assertEqual([], self._manager.ReleaseAllByRequester(_Id("app")))
+
+    released_ids = self._manager.ReleaseAllByRequester(_OPERATOR_ID)
+    self.assertEqual(["r1"], [x.request_uuid for x in released_ids])
+    self.assertEqual(ServiceStatePb.STATUS_STOPPED, self._GetStatus("app"))
+    self.assertEqual(ServiceStatePb.STATUS_STOPPED, self._GetStatus("lib"))
+
+
+  def testReleaseAllByRequesterKeepsGroupRequests(self):
+    for name in ["a", "lib", "extra"]:
+      self._AddDockerService(name)
+    self._AddGroupService("grp", ["a"], ["lib"])
+    self.assertTrue(self._Request("r1", ["grp"]).Wait(10))
+    self.assertTrue(self._Request("r2", ["extra"], _Id("grp")).Wait(10))
+    for name in ["grp", "a", "lib"]:
+      self.assertEqual(ServiceStatePb.STATUS_ACTIVE, self._GetStatus(name))
+
+    released_ids = self._manager.ReleaseAllByRequester(_Id("grp"))
+    self.assertEqual(["r2"], [x.request_uuid for x in released_ids])
+    self.assertEqual(ServiceStatePb.STATUS_STOPPED, self._GetStatus("extra"))
+    # Both the group request and the implied request are kept.
+    for name in ["grp", "a", "lib"]:
+      self.assertEqual(ServiceStatePb.STATUS_ACTIVE, self._GetStatus(name))
+
+    self._manager.ReleaseAllByRequester(_OPERATOR_ID)
+    for name in ["grp", "a", "lib"]:
+      self.assertEqual(ServiceStatePb.STATUS_STOPPED, self._GetStatus(name))
+
+
+  def testReconcileDockerContainers(self):
+    client = _ListingDockerClient()
+    self.addCleanup(delattr, docker_py.GetGlobalDockerClient, "_inst")
+    docker_py.GetGlobalDockerClient._inst = client
+    for name in ["matched", "renamed", "drifted", "missing"]:
+      self._AddDockerService(
+          name, run_mode=service_options_pb2.RUN_MODE_ACTUAL)
+    self._AddDockerService("simulated")
+    prefix = FLAGS.docker_container_name_prefix
+    client.containers = [
+        _ListedContainer("fake_" + prefix + "robot_matched",
+                         prefix + "robot_matched", "exited"),
+        # Recreated outside of the service manager, found by its name.
+        _ListedContainer("new_id", prefix + "robot_renamed", "exited"),
+        _ListedContainer("fake_" + prefix + "robot_drifted",
+                         prefix + "robot_drifted", "running"),
+        _ListedContainer("orphan_id", prefix + "robot_orphan", "running"),
+        _ListedContainer("other_id", "not_managed", "running"),
+    ]
+
+    drifts = self._manager.ReconcileDockerContainers()
+    self.assertEqual(
+        [docker_service.ContainerDrift(
+            _Id("drifted"), ServiceStatePb.STATUS_STOPPED, "running"),
+         docker_service.ContainerDrift(
+            _Id("missing"), ServiceStatePb.STATUS_STOPPED, None)],
+        sorted(drifts, key=lambda x: x.service_id.name))
+    # The services are bound to the listed containers, without another call
+    # to the docker daemon.
+    for name, container in [("matched", client.containers[0]),
+                            ("renamed", client.containers[1]),
+                            ("drifted", client.containers[2])]:
+      service = self._manager.GetService(_Id(name))
+      self.assertIs(container, service._GetDockerContainer())
+    renamed_state = self._manager.GetService(_Id("renamed")).GetStateProto()
+    self.assertEqual(
+        "new_id", renamed_state.docker_service_state.docker_container_id)
+    # Only the changed id is written.
+    commits = self._RecordCommits()
+    self._manager.WaitForCommit(self._manager.WriteToDisk())
+    self.assertEqual([{"renamed": ServiceStatePb.STATUS_STOPPED}], commits)
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -26,7 +26,14 @@
 
 from cogrob.service_manager.model import service_id
 from cogrob.service_manager.proto import service_request_pb2
-import collections
+
+try:
+  _STRING_TYPES = (basestring,)
+  from collections import Iterable as _Iterable
+except NameError:
+  # Python 3, used by the grpc.aio server.
+  _STRING_TYPES = (str,)
+  from collections.abc import Iterable as _Iterable
 
 
 class ServiceRequestId(object):
@@ -43,7 +50,7 @@ class ServiceRequestId(object):
   def __init__(self, srv_id, request_uuid):
     assert isinstance(srv_id, service_id.ServiceId), (
         "srv_id must be a ServiceId")
-    assert isinstance(request_uuid, basestring), (
+    assert isinstance(request_uuid, _STRING_TYPES), (
         "request_uuid must be a string")
     self._service_id = srv_id
     self._request_uuid = request_uuid
@@ -101,7 +108,7 @@ class ServiceRequest(object):
   def __init__(self, request_id, requested_services):
     assert isinstance(request_id, ServiceRequestId), (
         "request_id must be a ServiceRequestId")
-    assert isinstance(requested_services, collections.Iterable), (
+    assert isinstance(requested_services, _Iterable), (
         "requested_services must be iterable.")
     for requested_service_id in requested_services:
       assert isinstance(requested_service_id, service_id.ServiceId), (
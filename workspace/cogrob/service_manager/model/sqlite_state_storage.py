@@ -0,0 +1,129 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from cogrob.service_manager.model import state_storage
+from cogrob.service_manager.proto import service_state_pb2
+import os
+import os.path
+import sqlite3
+import threading
+
+# The primary key also serves as the index for namespace prefix lookups.
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS service_states (
+         namespace TEXT NOT NULL,
+         name TEXT NOT NULL,
+         type INTEGER NOT NULL,
+         status INTEGER NOT NULL,
+         state BLOB NOT NULL,
+         PRIMARY KEY (namespace, name))""",
+    """CREATE INDEX IF NOT EXISTS service_states_type
+         ON service_states (type)""",
+    """CREATE INDEX IF NOT EXISTS service_states_status
+         ON service_states (status)""",
+]
+
+
+def _NamespaceToKey(namespace):
+  # The trailing "/" makes a namespace prefix match on key boundaries, e.g.
+  # "robot/" matches "robot/perception/" but not "robotics/".
+  return "".join(x + "/" for x in namespace)
+
+
+class SqliteStateStorage(state_storage.StateStorageInterface):
+  # Stores serialized ServiceState in a single SQLite database (WAL mode), with
+  # namespace, name, type and status as indexed columns. A commit is one
+  # transaction of upserts and deletes.
+
+  def __init__(self, db_path):
+    self._db_path = db_path
+    self._connection = None
+    # The connection is used from the commit thread and the loading thread.
+    self._lock = threading.Lock()
+
+
+  def _GetConnection(self):
+    if self._connection is None:
+      db_dir = os.path.dirname(self._db_path)
+      if db_dir and not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+      self._connection = sqlite3.connect(
+          self._db_path, check_same_thread=False, isolation_level=None)
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      # Sync the WAL on every commit, like the journal backend.
+      self._connection.execute("PRAGMA synchronous=FULL")
+      for statement in _SCHEMA:
+        self._connection.execute(statement)
+    return self._connection
+
+
+  def LoadAll(self):
+    with self._lock:
+      rows = self._GetConnection().execute(
+          "SELECT state FROM service_states").fetchall()
+    result = []
+    for row in rows:
+      pb = service_state_pb2.ServiceState()
+      pb.ParseFromString(bytes(row[0]))
+      result.append(pb)
+    return result
+
+
+  def Commit(self, changes):
+    if not changes:
+      return
+    upserts = []
+    deletes = []
+    for srv_id, pb in changes.items():
+      namespace_key = _NamespaceToKey(srv_id.namespace)
+      if pb is None:
+        deletes.append((namespace_key, srv_id.name))
+      else:
+        upserts.append((namespace_key, srv_id.name, pb.type, pb.status,
+                        sqlite3.Binary(pb.SerializeToString())))
+
+    with self._lock:
+      connection = self._GetConnection()
+      connection.execute("BEGIN")
+      try:
+        connection.executemany(
+            "DELETE FROM service_states WHERE namespace = ? AND name = ?",
+            deletes)
+        connection.executemany(
+            "INSERT OR REPLACE INTO service_states "
+            "(namespace, name, type, status, state) VALUES (?, ?, ?, ?, ?)",
+            upserts)
+        connection.execute("COMMIT")
+      except:
+        connection.execute("ROLLBACK")
+        raise
+
+
+  def Close(self):
+    with self._lock:
+      if self._connection is not None:
+        self._connection.close()
+        self._connection = None
@@ -0,0 +1,146 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import sqlite_state_storage
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.proto import service_state_pb2
+import os
+import shutil
+import sqlite3
+import tempfile
+
+ServiceId = service_id.ServiceId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+def _MakeServiceState(srv_id, status=ServiceStatePb.STATUS_STOPPED):
+  pb = ServiceStatePb()
+  pb.id.CopyFrom(srv_id.ToProto())
+  pb.type = service_options_pb2.SERVICE_TYPE_DOCKER
+  pb.status = status
+  return pb
+
+
+def _Statuses(service_states):
+  return dict((ServiceId.FromProto(pb.id), pb.status)
+              for pb in service_states)
+
+
+class SqliteStateStorageTest(absltest.TestCase):
+
+  def setUp(self):
+    super(SqliteStateStorageTest, self).setUp()
+    self._dir = tempfile.mkdtemp()
+    # The directory is created on the first use.
+    self._db_path = os.path.join(self._dir, "db", "service_state.sqlite")
+    self._storage = sqlite_state_storage.SqliteStateStorage(self._db_path)
+
+
+  def tearDown(self):
+    self._storage.Close()
+    shutil.rmtree(self._dir)
+    super(SqliteStateStorageTest, self).tearDown()
+
+
+  def _Query(self, sql, args=()):
+    connection = sqlite3.connect(self._db_path)
+    try:
+      return connection.execute(sql, args).fetchall()
+    finally:
+      connection.close()
+
+
+  def testUpsertAndRemove(self):
+    a_id = ServiceId(["robot"], "a")
+    b_id = ServiceId(["robot"], "b")
+    self.assertEqual([], self._storage.LoadAll())
+    self._storage.Commit({a_id: _MakeServiceState(a_id),
+                          b_id: _MakeServiceState(b_id)})
+    self._storage.Commit(
+        {a_id: _MakeServiceState(a_id, ServiceStatePb.STATUS_ACTIVE),
+         b_id: None})
+    # Removing a service that is not stored is not an error.
+    self._storage.Commit({ServiceId(["robot"], "c"): None})
+    self._storage.Commit({})
+    self.assertEqual({a_id: ServiceStatePb.STATUS_ACTIVE},
+                     _Statuses(self._storage.LoadAll()))
+    self.assertEqual(
+        [("robot/", "a", service_options_pb2.SERVICE_TYPE_DOCKER,
+          ServiceStatePb.STATUS_ACTIVE)],
+        self._Query("SELECT namespace, name, type, status "
+                    "FROM service_states"))
+
+
+  def testLoadAllRoundTrip(self):
+    pb = _MakeServiceState(ServiceId(["robot", "arm"], "a"),
+                           ServiceStatePb.STATUS_ACTIVE)
+    pb.options.docker_service_options.container_options.image = "ubuntu"
+    pb.requested_by_others.add().request_uuid = "uuid"
+    self._storage.Commit({ServiceId.FromProto(pb.id): pb})
+    self._storage.Close()
+
+    storage = sqlite_state_storage.SqliteStateStorage(self._db_path)
+    self.assertEqual([pb], storage.LoadAll())
+    storage.Close()
+
+
+  def testNamespaceAndStatusIndexes(self):
+    srv_ids = [ServiceId(["robot"], "a"),
+               ServiceId(["robot", "perception"], "b"),
+               ServiceId(["robotics"], "c")]
+    self._storage.Commit(dict(
+        (x, _MakeServiceState(x, ServiceStatePb.STATUS_ACTIVE))
+        for x in srv_ids[:2]))
+    self._storage.Commit({srv_ids[2]: _MakeServiceState(srv_ids[2])})
+
+    # A namespace prefix matches on the boundaries of the namespace.
+    prefix = sqlite_state_storage._NamespaceToKey(["robot"])
+    self.assertEqual(
+        ["a", "b"],
+        [x for x, in self._Query(
+            "SELECT name FROM service_states WHERE namespace >= ? AND "
+            "namespace < ? ORDER BY name", (prefix, prefix[:-1] + "0"))])
+    self.assertEqual(
+        ["c"],
+        [x for x, in self._Query(
+            "SELECT name FROM service_states WHERE status = ?",
+            (ServiceStatePb.STATUS_STOPPED,))])
+
+    # The lookups use the indexes instead of scanning the table.
+    plan = self._Query(
+        "EXPLAIN QUERY PLAN SELECT name FROM service_states WHERE "
+        "namespace >= ? AND namespace < ?", (prefix, prefix[:-1] + "0"))
+    self.assertIn("INDEX", " ".join(str(x[-1]) for x in plan))
+    plan = self._Query(
+        "EXPLAIN QUERY PLAN SELECT name FROM service_states WHERE status = ?",
+        (ServiceStatePb.STATUS_STOPPED,))
+    self.assertIn("service_states_status", " ".join(str(x[-1]) for x in plan))
+
+
+if __name__ == "__main__":
+  absltest.main()
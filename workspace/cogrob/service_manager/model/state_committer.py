@@ -0,0 +1,193 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.util import errors
+from cogrob.service_manager.util import rpc_deadline
+import collections
+import threading
+import time
+
+flags.DEFINE_enum(
+    "state_commit_mode", "group", ["sync", "group", "async"],
+    "How state changes are committed to the storage. sync: every RPC commits "
+    "its own changes. group: a background thread commits the changes of "
+    "concurrent RPCs together, each RPC waits for the commit covering its "
+    "changes. async: like group, but RPCs do not wait for the commit.")
+flags.DEFINE_float(
+    "state_group_commit_max_delay_secs", 0.01,
+    "In group mode, how long the commit thread waits for more changes before "
+    "committing a batch.")
+flags.DEFINE_float(
+    "state_commit_retry_delay_secs", 1.0,
+    "How long to wait before retrying a failed background commit.")
+FLAGS = flags.FLAGS
+
+
+class StateCommitter(object):
+  # Batches changes (dict from ServiceId to ServiceState or None, see
+  # StateStorageInterface.Commit) and commits them to a storage. Enqueue returns
+  # a sequence number, a commit covers all the changes enqueued before it.
+
+  def __init__(self, storage, mode=None, max_delay_secs=None):
+    self._storage = storage
+    self._mode = mode if mode is not None else FLAGS.state_commit_mode
+    self._max_delay_secs = (
+        max_delay_secs if max_delay_secs is not None
+        else FLAGS.state_group_commit_max_delay_secs)
+
+    self._cond = threading.Condition()
+    self._pending_changes = {}
+    self._enqueued_seq = 0
+    self._committed_seq = 0
+    # The error of the last failed commit and the sequence number it covered.
+    # The changes are put back and retried, in the meantime WaitForCommit
+    # raises the error to those waiting for them.
+    self._commit_error = None
+    self._failed_seq = 0
+    # (seq, callback) of the on_commit of Enqueue, in the order of seq.
+    self._on_commit = collections.deque()
+    self._stop_commit_thread = False
+    self._commit_thread = None
+
+    # Serializes calls to self._storage.Commit.
+    self._commit_lock = threading.Lock()
+
+
+  def Enqueue(self, changes, on_commit=None):
+    """Enqueue changes, returns a sequence number for WaitForCommit. on_commit
+    is called once the changes are committed, before WaitForCommit returns,
+    from the committing thread and in the order of Enqueue."""
+    with self._cond:
+      self._pending_changes.update(changes)
+      self._enqueued_seq += 1
+      seq = self._enqueued_seq
+      if on_commit is not None:
+        self._on_commit.append((seq, on_commit))
+      if self._mode != "sync":
+        self._StartCommitThreadLocked()
+        self._cond.notify_all()
+
+    if self._mode == "sync":
+      self._CommitPending()
+    return seq
+
+
+  def WaitForCommit(self, seq, timeout=None):
+    """Block until the changes enqueued with seq are committed. Returns
+    immediately in async mode. Raises errors.StateCommitError if the commit
+    covering them failed, or errors.DeadlineExceededError if they are not
+    committed in timeout seconds (waits forever if None, or if longer than
+    rpc_deadline.NormalizeTimeout allows)."""
+    if self._mode == "async":
+      return
+    timeout = rpc_deadline.NormalizeTimeout(timeout)
+    deadline = None if timeout is None else time.time() + timeout
+    with self._cond:
+      while self._committed_seq < seq:
+        if self._failed_seq >= seq:
+          raise errors.StateCommitError(
+              "Cannot commit the service states, will retry: {}".format(
+                  str(self._commit_error)))
+        if deadline is None:
+          self._cond.wait()
+          continue
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise errors.DeadlineExceededError(
+              "Service states not committed in {} seconds.".format(timeout))
+        self._cond.wait(remaining)
+
+
+  def _CommitPending(self):
+    with self._commit_lock:
+      with self._cond:
+        changes = self._pending_changes
+        seq = self._enqueued_seq
+        self._pending_changes = {}
+      if changes:
+        try:
+          self._storage.Commit(changes)
+        except Exception as e:
+          # Put the changes back, newer changes take precedence.
+          with self._cond:
+            changes.update(self._pending_changes)
+            self._pending_changes = changes
+            self._commit_error = e
+            self._failed_seq = max(self._failed_seq, seq)
+            self._cond.notify_all()
+          raise
+      callbacks = []
+      with self._cond:
+        while self._on_commit and self._on_commit[0][0] <= seq:
+          callbacks.append(self._on_commit.popleft()[1])
+      # Still holding _commit_lock, so that they are called in order.
+      for callback in callbacks:
+        callback()
+      with self._cond:
+        self._committed_seq = max(self._committed_seq, seq)
+        self._cond.notify_all()
+
+
+  def _CommitThread(self):
+    while True:
+      with self._cond:
+        while (self._committed_seq >= self._enqueued_seq
+               and not self._stop_commit_thread):
+          self._cond.wait()
+        if self._stop_commit_thread:
+          return
+
+      if self._mode == "group" and self._max_delay_secs > 0:
+        # Let more RPCs join this commit.
+        time.sleep(self._max_delay_secs)
+
+      try:
+        self._CommitPending()
+      except Exception as e:
+        logging.error("Failed to commit service states: %s", str(e))
+        time.sleep(FLAGS.state_commit_retry_delay_secs)
+
+
+  def _StartCommitThreadLocked(self):
+    if self._commit_thread is None:
+      self._stop_commit_thread = False
+      self._commit_thread = threading.Thread(target=self._CommitThread)
+      self._commit_thread.daemon = True
+      self._commit_thread.start()
+
+
+  def Stop(self):
+    """Stop the commit thread, then commit everything still pending."""
+    with self._cond:
+      commit_thread = self._commit_thread
+      self._commit_thread = None
+      self._stop_commit_thread = True
+      self._cond.notify_all()
+    if commit_thread is not None:
+      commit_thread.join()
+    self._CommitPending()
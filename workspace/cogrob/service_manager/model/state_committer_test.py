@@ -0,0 +1,204 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.model import state_committer
+from cogrob.service_manager.model import state_storage
+from cogrob.service_manager.util import errors
+import threading
+import time
+
+FLAGS = flags.FLAGS
+
+
+class FakeStateStorage(state_storage.StateStorageInterface):
+
+  def __init__(self, num_failures=0):
+    self.commits = []
+    self.num_failures = num_failures
+    self.lock = threading.Lock()
+
+
+  def Commit(self, changes):
+    with self.lock:
+      if self.num_failures > 0:
+        self.num_failures -= 1
+        raise IOError("Disk full.")
+      self.commits.append(dict(changes))
+
+
+class BlockingStateStorage(FakeStateStorage):
+  # Commits once release is set.
+
+  def __init__(self):
+    super(BlockingStateStorage, self).__init__()
+    self.release = threading.Event()
+
+
+  def Commit(self, changes):
+    self.release.wait(10)
+    super(BlockingStateStorage, self).Commit(changes)
+
+
+class StateCommitterTest(absltest.TestCase):
+
+  def setUp(self):
+    super(StateCommitterTest, self).setUp()
+    FLAGS.state_commit_retry_delay_secs = 0.01
+
+
+  def testSyncCommitsOnEnqueue(self):
+    storage = FakeStateStorage()
+    committer = state_committer.StateCommitter(storage, mode="sync")
+    seq = committer.Enqueue({"a": 1})
+    self.assertEqual([{"a": 1}], storage.commits)
+    committer.WaitForCommit(seq)
+    committer.Stop()
+
+
+  def testGroupCommitsInBackground(self):
+    storage = FakeStateStorage()
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0)
+    committer.Enqueue({"a": 1})
+    seq = committer.Enqueue({"a": 2, "b": 3})
+    committer.WaitForCommit(seq, timeout=10)
+    committer.Stop()
+    merged = {}
+    for changes in storage.commits:
+      merged.update(changes)
+    self.assertEqual({"a": 2, "b": 3}, merged)
+
+
+  def testAsyncDoesNotWait(self):
+    storage = FakeStateStorage(num_failures=1000)
+    committer = state_committer.StateCommitter(storage, mode="async")
+    committer.WaitForCommit(committer.Enqueue({"a": 1}), timeout=0)
+    storage.num_failures = 0
+    committer.Stop()
+    self.assertEqual([{"a": 1}], storage.commits)
+
+
+  def testGroupFailureIsRaisedToWaiters(self):
+    storage = FakeStateStorage(num_failures=1000)
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0)
+    seq = committer.Enqueue({"a": 1})
+    with self.assertRaises(errors.StateCommitError):
+      committer.WaitForCommit(seq, timeout=10)
+
+    # The changes were kept and are committed once the storage recovers.
+    with storage.lock:
+      storage.num_failures = 0
+    seq = committer.Enqueue({"b": 2})
+    committer.WaitForCommit(seq, timeout=10)
+    committer.Stop()
+    merged = {}
+    for changes in storage.commits:
+      merged.update(changes)
+    self.assertEqual({"a": 1, "b": 2}, merged)
+
+
+  def testOnCommit(self):
+    storage = BlockingStateStorage()
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0)
+    committed = []
+    committer.Enqueue({"a": 1}, lambda: committed.append(1))
+    seq = committer.Enqueue({"b": 2}, lambda: committed.append(2))
+    time.sleep(0.05)
+    self.assertEqual([], committed)
+    storage.release.set()
+    committer.WaitForCommit(seq, timeout=10)
+    self.assertEqual([1, 2], committed)
+    committer.Stop()
+
+
+  def testOnCommitWaitsForRetry(self):
+    storage = FakeStateStorage(num_failures=1000)
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0)
+    committed = []
+    seq = committer.Enqueue({"a": 1}, lambda: committed.append(1))
+    with self.assertRaises(errors.StateCommitError):
+      committer.WaitForCommit(seq, timeout=10)
+    self.assertEqual([], committed)
+    with storage.lock:
+      storage.num_failures = 0
+    committer.Stop()
+    self.assertEqual([1], committed)
+
+
+  def testWaitForCommitTimesOut(self):
+    storage = FakeStateStorage()
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0.5)
+    seq = committer.Enqueue({"a": 1})
+    with self.assertRaises(errors.DeadlineExceededError):
+      committer.WaitForCommit(seq, timeout=0.05)
+    committer.Stop()
+    self.assertEqual([{"a": 1}], storage.commits)
+
+
+  def testHugeTimeoutWaitsForCommit(self):
+    storage = BlockingStateStorage()
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0)
+    seq = committer.Enqueue({"a": 1})
+    errors_raised = []
+    def _Wait():
+      try:
+        # What gRPC reports as time remaining without a deadline.
+        committer.WaitForCommit(seq, timeout=9.2e18 - time.time())
+      except Exception as e:
+        errors_raised.append(e)
+    waiter = threading.Thread(target=_Wait)
+    waiter.start()
+    time.sleep(0.05)
+    self.assertTrue(waiter.is_alive())
+    storage.release.set()
+    waiter.join(10)
+    self.assertFalse(waiter.is_alive())
+    self.assertEqual([], errors_raised)
+    committer.WaitForCommit(seq, timeout=float("inf"))
+    committer.Stop()
+
+
+  def testTimeout(self):
+    storage = BlockingStateStorage()
+    committer = state_committer.StateCommitter(
+        storage, mode="group", max_delay_secs=0)
+    seq = committer.Enqueue({"a": 1})
+    with self.assertRaises(errors.DeadlineExceededError):
+      committer.WaitForCommit(seq, timeout=0.01)
+    storage.release.set()
+    committer.WaitForCommit(seq, timeout=10)
+    committer.Stop()
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,99 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_request
+import collections
+
+ServiceId = service_id.ServiceId
+ServiceRequestId = service_request.ServiceRequestId
+
+# The state of one service in a StateSnapshot. service is the live service
+# object, for the queries (e.g. resource usage) that are not answered from the
+# state. options is a protobuf message, it must not be modified.
+ServiceSnapshot = collections.namedtuple("ServiceSnapshot", [
+    "service_id", "status", "options", "requests_by_self",
+    "requested_by_others", "serialized_state", "service"])
+
+
+def CreateServiceSnapshot(service_state_pb, service):
+  """Create a ServiceSnapshot from a service_state_pb2.ServiceState that is
+  not used anywhere else."""
+  return ServiceSnapshot(
+      service_id=ServiceId.FromProto(service_state_pb.id),
+      status=service_state_pb.status,
+      options=service_state_pb.options,
+      requests_by_self=frozenset(
+          ServiceRequestId.FromProto(x.request_id)
+          for x in service_state_pb.requests_by_self),
+      requested_by_others=frozenset(
+          ServiceRequestId.FromProto(x)
+          for x in service_state_pb.requested_by_others),
+      serialized_state=service_state_pb.SerializeToString(),
+      service=service)
+
+
+class StateSnapshot(object):
+  # An immutable view of all the services at one point in time. Readers get
+  # the current snapshot from the ServiceManager without any lock, writers
+  # publish a new one with Update (copy-on-write).
+
+  def __init__(self, services=None, revision=0):
+    # services is a dict from ServiceId to ServiceSnapshot, owned by self.
+    self._services = services if services is not None else {}
+    self._revision = revision
+
+
+  def GetRevision(self):
+    """Incremented by every Update."""
+    return self._revision
+
+
+  def GetService(self, service_id):
+    """Returns the ServiceSnapshot of a service, or None."""
+    return self._services.get(service_id)
+
+
+  def GetAllServiceIds(self):
+    return self._services.keys()
+
+
+  def GetAllServices(self):
+    return self._services.values()
+
+
+  def Update(self, changes, services):
+    """Returns a new StateSnapshot with changes applied. changes is a dict from
+    ServiceId to service_state_pb2.ServiceState (None for a removed service),
+    like StateStorageInterface.Commit, services a dict from ServiceId to the
+    service objects."""
+    new_services = dict(self._services)
+    for srv_id, pb in changes.items():
+      if pb is None:
+        new_services.pop(srv_id, None)
+      else:
+        new_services[srv_id] = CreateServiceSnapshot(pb, services[srv_id])
+    return StateSnapshot(new_services, self._revision + 1)
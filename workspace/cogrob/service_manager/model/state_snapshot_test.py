@@ -0,0 +1,90 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.model import state_snapshot
+from cogrob.service_manager.proto import service_state_pb2
+
+ServiceId = service_id.ServiceId
+ServiceRequestId = service_request.ServiceRequestId
+ServiceStatePb = service_state_pb2.ServiceState
+
+
+def _MakeServiceState(srv_id, status=ServiceStatePb.STATUS_STOPPED):
+  pb = ServiceStatePb()
+  pb.id.CopyFrom(srv_id.ToProto())
+  pb.status = status
+  return pb
+
+
+class StateSnapshotTest(absltest.TestCase):
+
+  def testCreateServiceSnapshot(self):
+    srv_id = ServiceId(["robot"], "camera")
+    requester_id = ServiceId(["robot"], "driver")
+    pb = _MakeServiceState(srv_id, ServiceStatePb.STATUS_ACTIVE)
+    pb.requested_by_others.add().CopyFrom(
+        ServiceRequestId(requester_id, "uuid").ToProto())
+    service = object()
+    snapshot = state_snapshot.CreateServiceSnapshot(pb, service)
+    self.assertEqual(srv_id, snapshot.service_id)
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE, snapshot.status)
+    self.assertEqual(frozenset(), snapshot.requests_by_self)
+    self.assertEqual(frozenset([ServiceRequestId(requester_id, "uuid")]),
+                     snapshot.requested_by_others)
+    self.assertEqual(pb.SerializeToString(), snapshot.serialized_state)
+    self.assertIs(service, snapshot.service)
+
+
+  def testUpdateIsCopyOnWrite(self):
+    srv_a = ServiceId(["robot"], "a")
+    srv_b = ServiceId(["robot"], "b")
+    services = {srv_a: object(), srv_b: object()}
+    empty = state_snapshot.StateSnapshot()
+    first = empty.Update(
+        {srv_a: _MakeServiceState(srv_a), srv_b: _MakeServiceState(srv_b)},
+        services)
+    second = first.Update(
+        {srv_a: _MakeServiceState(srv_a, ServiceStatePb.STATUS_ACTIVE),
+         srv_b: None}, services)
+
+    self.assertEqual(0, empty.GetRevision())
+    self.assertEqual(1, first.GetRevision())
+    self.assertEqual(2, second.GetRevision())
+    self.assertEqual([], list(empty.GetAllServiceIds()))
+    self.assertEqual(set([srv_a, srv_b]), set(first.GetAllServiceIds()))
+    self.assertEqual(ServiceStatePb.STATUS_STOPPED,
+                     first.GetService(srv_a).status)
+    self.assertEqual([srv_a], list(second.GetAllServiceIds()))
+    self.assertEqual(ServiceStatePb.STATUS_ACTIVE,
+                     second.GetService(srv_a).status)
+    self.assertIsNone(second.GetService(srv_b))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,55 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+class StateStorageInterface(object):
+  # Interface of a persistent storage of service_state_pb2.ServiceState. The
+  # ServiceManager loads all the states once at startup, then commits the
+  # changed ones.
+
+  def LoadAll(self):
+    """Returns a list of all stored service_state_pb2.ServiceState."""
+    raise NotImplementedError(
+        "LoadAll in StateStorageInterface not implemented in {}",
+        str(type(self)))
+
+
+  def Adopt(self, service_states):
+    """Take over service_states, the current content of the storage as loaded
+    by another process, instead of calling LoadAll."""
+    pass
+
+
+  def Commit(self, changes):
+    """Persist changes, a dict from ServiceId to service_state_pb2.ServiceState.
+    A value of None means that service was removed."""
+    raise NotImplementedError(
+        "Commit in StateStorageInterface not implemented in {}",
+        str(type(self)))
+
+
+  def Close(self):
+    """Release the resources held by the storage."""
+    pass
@@ -0,0 +1,202 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.util import rpc_deadline
+import contextlib
+import threading
+import time
+
+flags.DEFINE_integer(
+    "admission_mutation_max_in_flight", 8,
+    "Maximal number of RPCs changing the services (create, request, release, "
+    "etc.) running at the same time.")
+flags.DEFINE_integer(
+    "admission_mutation_max_queued", 8,
+    "Maximal number of mutation RPCs waiting for a slot, more are rejected "
+    "with RESOURCE_EXHAUSTED.")
+flags.DEFINE_integer(
+    "admission_wait_max_in_flight", 8,
+    "Maximal number of RPCs waiting for an operation at the same time.")
+flags.DEFINE_float(
+    "admission_max_queue_secs", 5,
+    "Reject a queued RPC that did not get a slot in this time.")
+FLAGS = flags.FLAGS
+
+LaneStatsPb = service_manager_rpc_pb2.LaneStats
+
+# Reads are served from the state snapshot and never wait for a slot, so they
+# are not queued behind Docker mutations.
+LANE_READ = "read"
+LANE_MUTATION = "mutation"
+LANE_WAIT = "wait"
+
+# Weight of the latest RPC in the moving average of the service time.
+_SERVICE_TIME_DECAY = 0.1
+
+
+class AdmissionRejectedError(Exception):
+
+  def __init__(self, lane, retry_after_secs):
+    super(AdmissionRejectedError, self).__init__(
+        "Too many {} RPCs, retry after {:.3f}s.".format(
+            lane, retry_after_secs))
+    self._retry_after_secs = retry_after_secs
+
+
+  def GetRetryAfterSecs(self):
+    return self._retry_after_secs
+
+
+class _Lane(object):
+  # A bounded number of slots, and a bounded queue of RPCs waiting for one.
+  # max_in_flight of None is unbounded.
+
+  def __init__(self, name, max_in_flight, max_queued):
+    self._name = name
+    self._max_in_flight = max_in_flight
+    self._max_queued = max_queued
+    self._cv = threading.Condition()
+    self._in_flight = 0
+    self._queued = 0
+    self._num_admitted = 0
+    self._num_rejected = 0
+    self._total_queue_secs = 0.0
+    self._max_queue_secs = 0.0
+    self._mean_service_secs = 0.0
+
+
+  def _HasSlot(self):
+    return self._max_in_flight is None or self._in_flight < self._max_in_flight
+
+
+  def _RetryAfterSecs(self):
+    # Must hold self._cv. The time to serve what is queued already.
+    return max(0.001, self._mean_service_secs * (self._queued + 1)
+                      / max(1, self._max_in_flight or 1))
+
+
+  def _Reject(self):
+    # Must hold self._cv.
+    self._num_rejected += 1
+    raise AdmissionRejectedError(self._name, self._RetryAfterSecs())
+
+
+  def Acquire(self, timeout):
+    """Take a slot, waiting at most timeout seconds in the queue (forever if
+    None). Raises AdmissionRejectedError."""
+    start_time = time.time()
+    with self._cv:
+      if not self._HasSlot():
+        if self._queued >= self._max_queued:
+          self._Reject()
+        self._queued += 1
+        try:
+          deadline = None if timeout is None else start_time + timeout
+          while not self._HasSlot():
+            if deadline is None:
+              self._cv.wait()
+              continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+              self._Reject()
+            self._cv.wait(remaining)
+        finally:
+          self._queued -= 1
+      self._in_flight += 1
+      self._num_admitted += 1
+      queue_secs = time.time() - start_time
+      self._total_queue_secs += queue_secs
+      self._max_queue_secs = max(self._max_queue_secs, queue_secs)
+    return time.time()
+
+
+  def Release(self, admit_time):
+    with self._cv:
+      self._in_flight -= 1
+      self._mean_service_secs += _SERVICE_TIME_DECAY * (
+          time.time() - admit_time - self._mean_service_secs)
+      self._cv.notify()
+
+
+  def ToProto(self):
+    with self._cv:
+      return LaneStatsPb(
+          lane=self._name,
+          in_flight=self._in_flight,
+          queued=self._queued,
+          max_in_flight=self._max_in_flight or 0,
+          max_queued=self._max_queued,
+          num_admitted=self._num_admitted,
+          num_rejected=self._num_rejected,
+          mean_queue_wait_ms=(self._total_queue_secs * 1000
+                              / max(1, self._num_admitted)),
+          max_queue_wait_ms=self._max_queue_secs * 1000,
+          mean_service_ms=self._mean_service_secs * 1000)
+
+
+class AdmissionController(object):
+  # Limits the RPCs of each lane. An RPC waiting in a queue holds a gRPC
+  # worker thread, the limits of the lanes bound how many threads the slow
+  # RPCs can hold, the rest is left for the reads.
+
+  def __init__(self):
+    self._lanes = {
+        LANE_READ: _Lane(LANE_READ, None, 0),
+        LANE_MUTATION: _Lane(LANE_MUTATION,
+                             FLAGS.admission_mutation_max_in_flight,
+                             FLAGS.admission_mutation_max_queued),
+        LANE_WAIT: _Lane(LANE_WAIT, FLAGS.admission_wait_max_in_flight, 0),
+    }
+
+
+  def GetMaxBlockedThreads(self):
+    """The number of worker threads the bounded lanes can hold at most."""
+    return (FLAGS.admission_mutation_max_in_flight
+            + FLAGS.admission_mutation_max_queued
+            + FLAGS.admission_wait_max_in_flight)
+
+
+  @contextlib.contextmanager
+  def Admit(self, lane, timeout=None):
+    """Runs the body in a slot of lane, waiting at most timeout seconds (and
+    --admission_max_queue_secs) for it. Raises AdmissionRejectedError."""
+    queue_secs = rpc_deadline.NormalizeTimeout(FLAGS.admission_max_queue_secs)
+    timeout = rpc_deadline.NormalizeTimeout(timeout)
+    if timeout is not None:
+      queue_secs = timeout if queue_secs is None else min(queue_secs, timeout)
+    admit_time = self._lanes[lane].Acquire(queue_secs)
+    try:
+      yield
+    finally:
+      self._lanes[lane].Release(admit_time)
+
+
+  def GetLaneStats(self):
+    """Returns a list of service_manager_rpc_pb2.LaneStats."""
+    return [self._lanes[x].ToProto()
+            for x in (LANE_READ, LANE_MUTATION, LANE_WAIT)]
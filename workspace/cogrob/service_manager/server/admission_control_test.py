@@ -0,0 +1,146 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.server import admission_control
+import threading
+import time
+
+FLAGS = flags.FLAGS
+
+
+class AdmissionControlTest(absltest.TestCase):
+
+  def setUp(self):
+    super(AdmissionControlTest, self).setUp()
+    FLAGS.admission_mutation_max_in_flight = 1
+    FLAGS.admission_mutation_max_queued = 1
+    FLAGS.admission_wait_max_in_flight = 1
+    FLAGS.admission_max_queue_secs = 10
+    self._controller = admission_control.AdmissionController()
+
+
+  def _GetStats(self, lane):
+    for stats in self._controller.GetLaneStats():
+      if stats.lane == lane:
+        return stats
+
+
+  def _HoldSlot(self, lane):
+    """Takes a slot of lane on another thread, until the returned event is
+    set."""
+    admitted = threading.Event()
+    release = threading.Event()
+    def _Hold():
+      with self._controller.Admit(lane):
+        admitted.set()
+        release.wait(10)
+    thread = threading.Thread(target=_Hold)
+    thread.start()
+    self.assertTrue(admitted.wait(10))
+    self.addCleanup(thread.join)
+    self.addCleanup(release.set)
+    return release
+
+
+  def testReadsAreNotLimited(self):
+    with self._controller.Admit(admission_control.LANE_READ):
+      with self._controller.Admit(admission_control.LANE_READ):
+        self.assertEqual(
+            2, self._GetStats(admission_control.LANE_READ).in_flight)
+    self.assertEqual(0, self._GetStats(admission_control.LANE_READ).in_flight)
+
+
+  def testQueuesThenRejects(self):
+    release = self._HoldSlot(admission_control.LANE_MUTATION)
+    queued_admitted = threading.Event()
+    def _Queue():
+      with self._controller.Admit(admission_control.LANE_MUTATION):
+        queued_admitted.set()
+    thread = threading.Thread(target=_Queue)
+    thread.start()
+    while self._GetStats(admission_control.LANE_MUTATION).queued < 1:
+      time.sleep(0.001)
+
+    # The queue is full.
+    with self.assertRaises(admission_control.AdmissionRejectedError) as cm:
+      with self._controller.Admit(admission_control.LANE_MUTATION):
+        pass
+    self.assertGreater(cm.exception.GetRetryAfterSecs(), 0)
+    # Reads are not queued behind the mutations.
+    with self._controller.Admit(admission_control.LANE_READ):
+      pass
+
+    release.set()
+    self.assertTrue(queued_admitted.wait(10))
+    thread.join()
+    stats = self._GetStats(admission_control.LANE_MUTATION)
+    self.assertEqual(2, stats.num_admitted)
+    self.assertEqual(1, stats.num_rejected)
+
+
+  def testQueueTimeout(self):
+    self._HoldSlot(admission_control.LANE_MUTATION)
+    start_time = time.time()
+    with self.assertRaises(admission_control.AdmissionRejectedError):
+      with self._controller.Admit(admission_control.LANE_MUTATION, 0.05):
+        pass
+    self.assertGreaterEqual(time.time() - start_time, 0.05)
+    self.assertEqual(0, self._GetStats(admission_control.LANE_MUTATION).queued)
+
+
+  def testHugeTimeoutQueues(self):
+    # Without a deadline, gRPC reports a huge time remaining.
+    FLAGS.admission_max_queue_secs = 1e20
+    release = self._HoldSlot(admission_control.LANE_MUTATION)
+    threading.Timer(0.05, release.set).start()
+    with self._controller.Admit(
+        admission_control.LANE_MUTATION, 9.2e18 - time.time()):
+      pass
+    self.assertEqual(
+        2, self._GetStats(admission_control.LANE_MUTATION).num_admitted)
+
+
+  def testWaitLaneDoesNotQueue(self):
+    self._HoldSlot(admission_control.LANE_WAIT)
+    with self.assertRaises(admission_control.AdmissionRejectedError):
+      with self._controller.Admit(admission_control.LANE_WAIT):
+        pass
+
+
+  def testReleasesSlotOnError(self):
+    with self.assertRaises(ValueError):
+      with self._controller.Admit(admission_control.LANE_MUTATION):
+        raise ValueError()
+    with self._controller.Admit(admission_control.LANE_MUTATION, 0):
+      pass
+    self.assertEqual(
+        0, self._GetStats(admission_control.LANE_MUTATION).in_flight)
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,349 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# A service manager server built on grpc.aio (Python 3). It serves the same
+# ServiceManager model as service_manager_server_main, but an RPC that waits
+# (for services to be ready, for an operation, for events) is a coroutine
+# instead of a thread, so thousands of them can be in flight. The blocking
+# Docker and storage work still runs on threads, in a bounded executor.
+#
+# The RPCs are admitted as by the threaded server (see admission_control).
+# This server does not take part in a state handoff yet, it refuses to start
+# with the handoff flags.
+
+from absl import app
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import service_events
+from cogrob.service_manager.model import service_manager
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.proto import result_code_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
+from cogrob.service_manager.server import admission_control
+from cogrob.service_manager.server import service_manager_servicer
+from cogrob.service_manager.server import state_handoff  # For its flags.
+from cogrob.service_manager.util import errors
+from cogrob.service_manager.util import psutil_helper
+from cogrob.service_manager.util import rpc_deadline
+import asyncio
+import concurrent.futures
+import grpc
+import math
+import sys
+import time
+
+flags.DEFINE_integer(
+    "aio_blocking_num_threads", 16,
+    "Number of threads running the blocking part of the RPCs (Docker, "
+    "storage) for the grpc.aio server.")
+FLAGS = flags.FLAGS
+
+# These RPCs have no waiting part, they run on the executor as they are.
+_BLOCKING_RPCS = [
+    "CreateService", "QueryService", "UpdateService", "RemoveService",
+    "ListServices", "ReleaseService", "GetOperation", "BatchCreateServices",
+    "BatchReleaseServices", "DrainNamespace", "StopAllServices",
+    "ReleaseAllByRequester", "GetServerStats", "QueryServiceResourceUsage",
+    "QueryTotalResourceUsage", "ServiceHeartbeat",
+]
+
+
+class _AbortError(Exception):
+  # Raised by _ExecutorContext.abort, the RPC is then aborted on the event
+  # loop.
+
+  def __init__(self, code, details):
+    super(_AbortError, self).__init__(details)
+    self.code = code
+    self.details = details
+
+
+class _ExecutorContext(object):
+  # The part of grpc.ServicerContext used by the blocking handlers, which do
+  # not run on the event loop.
+
+  def __init__(self, time_remaining):
+    self._deadline = (None if time_remaining is None
+                      else time.time() + time_remaining)
+    self._trailing_metadata = ()
+
+
+  def time_remaining(self):
+    if self._deadline is None:
+      return None
+    return max(0, self._deadline - time.time())
+
+
+  def is_active(self):
+    return True
+
+
+  def add_callback(self, callback):
+    # The aio server cancels the coroutine of the RPC instead.
+    del callback
+    return True
+
+
+  def set_trailing_metadata(self, trailing_metadata):
+    self._trailing_metadata = tuple(trailing_metadata)
+
+
+  def GetTrailingMetadata(self):
+    return self._trailing_metadata
+
+
+  def abort(self, code, details):
+    raise _AbortError(code, details)
+
+
+async def _WaitFuture(future, timeout):
+  """Wait for a concurrent.futures.Future, at most timeout seconds (forever if
+  None). Returns False on timeout, raises the error of the future."""
+  try:
+    await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                           timeout)
+  except asyncio.TimeoutError:
+    return False
+  return True
+
+
+class AioServiceManagerServicer(
+    service_manager_rpc_pb2_grpc.ServiceManagerServicer):
+
+  def __init__(self, servicer, service_manager, executor,
+               admission_controller=None):
+    # servicer is a service_manager_servicer.ServiceManagerServicer, it does
+    # the work of the RPCs, and admits the blocking ones.
+    self._servicer = servicer
+    self._service_manager = service_manager
+    self._executor = executor
+    self._admission_controller = admission_controller
+    for rpc_name in _BLOCKING_RPCS:
+      setattr(self, rpc_name, self._CreateBlockingHandler(rpc_name))
+
+
+  async def _RunBlocking(self, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        self._executor, function, *args)
+
+
+  async def _RunBlockingHandler(self, handler, request, context):
+    """Runs a handler of the threaded servicer on the executor, with an
+    _ExecutorContext, and aborts the RPC if the handler aborted it."""
+    executor_context = _ExecutorContext(
+        rpc_deadline.GetTimeRemaining(context))
+    try:
+      return await self._RunBlocking(handler, request, executor_context)
+    except _AbortError as e:
+      await context.abort(
+          e.code, e.details,
+          trailing_metadata=executor_context.GetTrailingMetadata())
+
+
+  def _RunInLane(self, lane, timeout, function, *args):
+    with self._admission_controller.Admit(lane, timeout):
+      return function(*args)
+
+
+  async def _RunAdmitted(self, context, function, *args):
+    """Runs the blocking part of a waiting RPC on the executor, in a slot of
+    the mutation lane. Waiting for the services does not hold a thread here,
+    so it is not admitted."""
+    if self._admission_controller is None:
+      return await self._RunBlocking(function, *args)
+    try:
+      return await self._RunBlocking(
+          self._RunInLane, admission_control.LANE_MUTATION,
+          rpc_deadline.GetTimeRemaining(context), function, *args)
+    except admission_control.AdmissionRejectedError as e:
+      await context.abort(
+          grpc.StatusCode.RESOURCE_EXHAUSTED, str(e),
+          trailing_metadata=(("retry-after-ms", str(int(math.ceil(
+              e.GetRetryAfterSecs() * 1000)))),))
+
+
+  def _CreateBlockingHandler(self, rpc_name):
+    handler = getattr(self._servicer, rpc_name)
+    async def Handler(request, context):
+      return await self._RunBlockingHandler(handler, request, context)
+    return Handler
+
+
+  async def RequestService(self, request, context):
+    if request.return_operation or not request.wait_for_ready:
+      return await self._RunBlockingHandler(
+          self._servicer.RequestService, request, context)
+
+    response = service_manager_rpc_pb2.RequestServiceResponse()
+    srv_request = service_request.ServiceRequest.FromProto(request.request)
+    try:
+      delayed_actions = await self._RunAdmitted(
+          context, self._servicer.RunServiceRequest, srv_request,
+          rpc_deadline.GetTimeRemaining(context))
+      if not await _WaitFuture(
+          delayed_action.AllOf(delayed_actions).GetFuture(),
+          rpc_deadline.GetTimeRemaining(context)):
+        raise errors.DeadlineExceededError(
+            "Services requested, but not ready before the deadline.")
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  async def BatchRequestServices(self, request, context):
+    try:
+      response, all_delayed_actions = await self._RunAdmitted(
+          context, self._servicer.RunBatchRequest, request,
+          rpc_deadline.GetTimeRemaining(context))
+    except errors.DeadlineExceededError as e:
+      await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+    except errors.StateCommitError as e:
+      await context.abort(grpc.StatusCode.INTERNAL, str(e))
+    try:
+      if request.wait_for_ready:
+        if not await _WaitFuture(
+            delayed_action.AllOf(all_delayed_actions).GetFuture(),
+            rpc_deadline.GetTimeRemaining(context)):
+          raise errors.DeadlineExceededError(
+              "Services requested, but not ready before the deadline.")
+      else:
+        response.delayed_actions.extend([
+            leaf.ToProto() for action in all_delayed_actions
+            for leaf in action.GetLeafActions()])
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  async def WaitOperation(self, request, context):
+    response = service_manager_rpc_pb2.WaitOperationResponse()
+    timeout = rpc_deadline.GetTimeRemaining(context)
+    if request.timeout_secs > 0:
+      timeout = (request.timeout_secs if timeout is None
+                 else min(timeout, request.timeout_secs))
+    operations = self._servicer.GetOperationManager()
+    try:
+      done = await _WaitFuture(
+          operations.GetDoneFuture(request.operation_id), timeout)
+      # The operation is reported either way, so that its progress is known.
+      response.operation.CopyFrom(
+          operations.GetOperation(request.operation_id))
+      if not done:
+        raise errors.DeadlineExceededError(
+            "Operation {} is not done yet.".format(request.operation_id))
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  async def WatchServices(self, request, context):
+    subscription = self._service_manager.GetEventHub().Subscribe(
+        service_events.EventFilter.FromProto(request), request.from_revision)
+    if subscription is None:
+      await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                          "Too many watchers, try again later.")
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscription.SetWakeup(lambda: loop.call_soon_threadsafe(wakeup.set))
+    try:
+      while True:
+        event = subscription.Get(timeout=0)
+        if event is not None:
+          yield event
+        elif subscription.IsClosed():
+          break
+        else:
+          await wakeup.wait()
+          wakeup.clear()
+    finally:
+      subscription.Close()
+
+
+async def _Serve(servicer):
+  server = grpc.aio.server()
+  service_manager_rpc_pb2_grpc.add_ServiceManagerServicer_to_server(
+      servicer, server)
+  if not server.add_insecure_port(FLAGS.service_manager_server_address):
+    raise IOError(
+        "Cannot listen on {}".format(FLAGS.service_manager_server_address))
+  await server.start()
+  logging.info("Server started.")
+  try:
+    await server.wait_for_termination()
+  finally:
+    await server.stop(0)
+
+
+def main(argv):
+  FLAGS.verbosity = logging.INFO
+  FLAGS(argv)
+  if FLAGS.handoff_socket_path or FLAGS.handoff_from_running_server:
+    raise app.UsageError(
+        "The grpc.aio server does not support the state handoff, unset "
+        "--handoff_socket_path and --handoff_from_running_server.")
+
+  psutil_with_cache = psutil_helper.PsUtilHelperWithCache()
+  psutil_with_cache.StartLoopingThread()
+
+  manager = service_manager.ServiceManager()
+  manager.LoadFromDisk()
+  manager.CreateMetaOperatorService()
+  manager.StartDockerBindThread()
+  manager.StartDockerRefreshThread()
+  manager.WaitForCommit(manager.WriteToDisk())
+
+  admission_controller = admission_control.AdmissionController()
+  servicer = service_manager_servicer.ServiceManagerServicer(
+      manager, psutil_with_cache, admission_controller,
+      max_workers=FLAGS.aio_blocking_num_threads)
+  executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=FLAGS.aio_blocking_num_threads)
+  try:
+    asyncio.run(_Serve(AioServiceManagerServicer(
+        servicer, manager, executor, admission_controller)))
+  except KeyboardInterrupt:
+    logging.error("The main thread in being killed.")
+    if FLAGS.stop_all_services_on_exit:
+      logging.info("Stopping all services.")
+      try:
+        manager.DrainNamespace()
+      except errors.ServiceManagerError as e:
+        logging.error("Cannot stop all services: %s", str(e))
+  executor.shutdown()
+  psutil_with_cache.StopLoopingThread()
+  manager.StopDockerRefreshThread()
+  manager.CloseStorage()
+
+
+if __name__ == "__main__":
+  main(sys.argv)
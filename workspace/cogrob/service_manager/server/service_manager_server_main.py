@@ -23,209 +23,42 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
-
 from absl import flags
 from absl import logging
 from concurrent import futures
-from cogrob.service_manager.model import meta_service
-from cogrob.service_manager.model import docker_service
-from cogrob.service_manager.model import group_service
-from cogrob.service_manager.model import service_id
 from cogrob.service_manager.model import service_manager
-from cogrob.service_manager.model import service_request
-from cogrob.service_manager.proto import result_code_pb2
-from cogrob.service_manager.proto import service_manager_rpc_pb2
 from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
-from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.server import admission_control
+from cogrob.service_manager.server import service_manager_servicer
+from cogrob.service_manager.server import state_handoff
 from cogrob.service_manager.util import errors
 from cogrob.service_manager.util import psutil_helper
 import grpc
 import sys
 import time
-import threading
-
 
+flags.DEFINE_integer(
+    "grpc_max_workers", 32,
+    "Number of gRPC worker threads. Every in-flight RPC (including the queued "
+    "ones and WatchServices streams) holds one.")
+flags.DEFINE_integer(
+    "grpc_maximum_concurrent_rpcs", 0,
+    "gRPC rejects the RPCs beyond this with RESOURCE_EXHAUSTED, before they "
+    "get a thread. 0 for no limit.")
+flags.DEFINE_float(
+    "handoff_drain_secs", 30,
+    "After handing the state off, time to let the in-flight RPCs finish before "
+    "the old server exits.")
 FLAGS = flags.FLAGS
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
-ServiceId = service_id.ServiceId
-
-
-class ServiceManagerServicer(
-    service_manager_rpc_pb2_grpc.ServiceManagerServicer):
-
-  def __init__(self, service_manager, psutil_with_cache):
-    self._service_manager = service_manager
-    self._psutil_with_cache = psutil_with_cache
-    self._lock = threading.Lock()
-
 
-  def CreateService(self, request, context):
-    with self._lock:
-      srv_id = ServiceId.FromProto(request.options.id)
-      logging.info("Received create request: %s", str(srv_id))
-
-      options = request.options
-      response = service_manager_rpc_pb2.CreateServiceResponse()
-      try:
-        if self._service_manager.GetService(srv_id, no_raise=True) is not None:
-          raise errors.ServiceAlreadyExistError(
-              "Service {} already exist in ServiceManager".format(srv_id))
-
-        if options.type == service_options_pb2.SERVICE_TYPE_DOCKER:
-          service = docker_service.DockerService.CreateFromServiceOptionsPb(
-              options, self._service_manager)
-        elif options.type == service_options_pb2.SERVICE_TYPE_DOCKER:
-          service = group_service.GroupService.CreateFromServiceOptionsPb(
-              options, self._service_manager)
-        elif options.type == service_options_pb2.SERVICE_TYPE_META:
-          service = meta_service.MetaService.CreateFromServiceOptionsPb(
-              options, self._service_manager)
-        else:
-          raise errors.ServiceTypeNotSupportedError()
-        self._service_manager.AddService(service)
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      self._service_manager.WriteToDisk()
-      return response
-
-
-  def QueryService(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.QueryServiceResponse()
-      try:
-        srv_id = ServiceId.FromProto(request.id)
-        logging.info("Received query request: %s", str(srv_id))
-        service = self._service_manager.GetService(srv_id)
-        response.service_status.CopyFrom(service.ToProto())
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      self._service_manager.WriteToDisk()
-      return response
-
-
-  def UpdateService(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.UpdateServiceResponse()
-      try:
-        service = self._service_manager.GetService(
-            ServiceId.FromProto(request.options.id))
-        service.Update(request.options)
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      self._service_manager.WriteToDisk()
-      return response
-
-
-  def RemoveService(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.RemoveServiceResponse()
-      try:
-        srv_id = ServiceId.FromProto(request.id)
-        logging.info("Received remove request: %s", str(srv_id))
-        service = self._service_manager.GetService(srv_id)
-        logging.info("Found service: %s", str(srv_id))
-        service.Remove()
-        logging.info("Removed service: %s", str(srv_id))
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      self._service_manager.WriteToDisk()
-      return response
-
-
-  def RequestService(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.RequestServiceResponse()
-      try:
-        delayed_actions = self._service_manager.RequestService(
-            service_request.ServiceRequest.FromProto(request.request))
-        assert delayed_actions is not None
-        if request.wait_for_ready:
-          for delayed_action in delayed_actions:
-            delayed_action.Wait()
-        else:
-          response.delayed_actions.extend(
-              map(lambda x: x.ToProto(), delayed_actions))
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      self._service_manager.WriteToDisk()
-      return response
-
-
-  def ListServices(self, request, context):
-    with self._lock:
-      del request
-      response = service_manager_rpc_pb2.ListServicesResponse()
-      response.services.extend([
-          x.ToProto() for x in self._service_manager.GetAllManagedServiceIds()])
-      return response
-
-
-  def ReleaseService(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.ReleaseServiceResponse()
-      try:
-        self._service_manager.ReleaseService(
-            service_request.ServiceRequestId.FromProto(request.request_id))
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      self._service_manager.WriteToDisk()
-      return response
-
-
-  def QueryServiceResourceUsage(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.QueryServiceResourceUsageResponse()
-      try:
-        srv_id = ServiceId.FromProto(request.id)
-        logging.info("Received query resource request: %s", str(srv_id))
-        service = self._service_manager.GetService(srv_id)
-        cpu_usage = service.GetCpuUsage()
-        memory_usage = service.GetMemoryUsage()
-        if cpu_usage is not None:
-          response.cpu_usage = cpu_usage
-        if memory_usage is not None:
-          response.memory_usage = memory_usage
-        response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      return response
-
-
-  def QueryTotalResourceUsage(self, request, context):
-    with self._lock:
-      response = service_manager_rpc_pb2.QueryTotalResourceUsageResponse()
-      try:
-        if request.collect_method == (
-            service_manager_rpc_pb2.QueryTotalResourceUsageRequest
-            .COLLECT_METHOD_SUM_INDIVIDUAL):
-          response.cpu_usage = self._service_manager.CollectAllServiceCpuUsage()
-          response.memory_usage = (
-              self._service_manager.CollectAllServiceMemoryUsage())
-          response.result = result_code_pb2.RESULT_OK
-        elif request.collect_method == (
-            service_manager_rpc_pb2.QueryTotalResourceUsageRequest
-            .COLLECT_METHOD_PSUTIL):
-          response.cpu_usage = self._psutil_with_cache.GetCpuUsage()
-          response.memory_usage = self._psutil_with_cache.GetMemoryUsage()
-          response.result = result_code_pb2.RESULT_OK
-      except errors.ServiceManagerError as e:
-        response.result = e.GetResultCode()
-        response.error_message = str(e)
-      return response
 
+def _AddInsecurePortWithRetry(server, address):
+  deadline = time.time() + FLAGS.handoff_timeout_secs
+  while not server.add_insecure_port(address):
+    if time.time() > deadline:
+      raise IOError("Cannot listen on {}".format(address))
+    time.sleep(0.01)
 
 
 def main(argv):
@@ -236,24 +69,105 @@ def main(argv):
   psutil_with_cache.StartLoopingThread()
 
   manager = service_manager.ServiceManager()
-  manager.LoadFromDisk()
-  manager.CreateMetaOperatorService()
+  incoming_handoff = None
+  snapshot = None
+  if FLAGS.handoff_from_running_server and FLAGS.handoff_socket_path:
+    incoming_handoff = state_handoff.IncomingHandoff(FLAGS.handoff_socket_path)
+    snapshot = incoming_handoff.ReceiveSnapshot()
+  if snapshot is not None:
+    # The containers are already bound by id in the snapshot, do not list them
+    # again.
+    manager.RestoreFromSnapshot(snapshot)
+    manager.CreateMetaOperatorService()
+  else:
+    manager.LoadFromDisk()
+    manager.CreateMetaOperatorService()
+    # Containers are bound lazily, start serving without waiting for this.
+    manager.StartDockerBindThread()
   manager.StartDockerRefreshThread()
-
-  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+  # The readers only see the snapshot, publish the operator service if it was
+  # just created.
+  manager.WaitForCommit(manager.WriteToDisk())
+
+  admission_controller = admission_control.AdmissionController()
+  if (admission_controller.GetMaxBlockedThreads() + FLAGS.watch_max_watchers
+      >= FLAGS.grpc_max_workers):
+    logging.warn("Mutations, waits and watchers can hold all the %d worker "
+                 "threads, reads may be queued behind them.",
+                 FLAGS.grpc_max_workers)
+  servicer = service_manager_servicer.ServiceManagerServicer(
+      manager, psutil_with_cache, admission_controller,
+      max_workers=FLAGS.grpc_max_workers)
+
+  # During a handoff the old server forwards its RPCs to this one, on an
+  # address of its own.
+  forward_server = None
+  forward_address = None
+  if FLAGS.handoff_socket_path:
+    forward_server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=FLAGS.grpc_max_workers))
+    service_manager_rpc_pb2_grpc.add_ServiceManagerServicer_to_server(
+        servicer, forward_server)
+    forward_address = state_handoff.PrepareForwardAddress(
+        FLAGS.handoff_socket_path)
+    if not forward_server.add_insecure_port(forward_address):
+      raise IOError("Cannot listen on {}".format(forward_address))
+    forward_server.start()
+  if snapshot is not None:
+    incoming_handoff.StartForwarding(forward_address)
+
+  # With SO_REUSEPORT, a new server can listen on the same address while the
+  # old one is still serving, so the port never goes dark during a handoff.
+  server = grpc.server(
+      futures.ThreadPoolExecutor(max_workers=FLAGS.grpc_max_workers),
+      options=[("grpc.so_reuseport", 1)],
+      maximum_concurrent_rpcs=FLAGS.grpc_maximum_concurrent_rpcs or None)
   service_manager_rpc_pb2_grpc.add_ServiceManagerServicer_to_server(
-    ServiceManagerServicer(manager, psutil_with_cache), server)
-  server.add_insecure_port("[::]:7016")
+    servicer, server)
+  if snapshot is not None:
+    if not server.add_insecure_port(FLAGS.service_manager_server_address):
+      # No SO_REUSEPORT, the old server has to release the address first.
+      logging.warn("Cannot share %s with the old server, waiting for it.",
+                   FLAGS.service_manager_server_address)
+      incoming_handoff.Complete()
+      _AddInsecurePortWithRetry(server, FLAGS.service_manager_server_address)
+    else:
+      incoming_handoff.Complete()
+  elif not server.add_insecure_port(FLAGS.service_manager_server_address):
+    raise IOError(
+        "Cannot listen on {}".format(FLAGS.service_manager_server_address))
   server.start()
   logging.info("Server started.")
+
+  handoff_listener = None
+  if FLAGS.handoff_socket_path:
+    handoff_listener = state_handoff.HandoffListener(
+        FLAGS.handoff_socket_path, servicer)
+    handoff_listener.Start()
+
   try:
     while True:
-      time.sleep(_ONE_DAY_IN_SECONDS)
+      if handoff_listener is not None:
+        if handoff_listener.WaitForHandoff(_ONE_DAY_IN_SECONDS):
+          break
+      else:
+        time.sleep(_ONE_DAY_IN_SECONDS)
+    logging.info("State handed off, draining.")
+    server.stop(FLAGS.handoff_drain_secs).wait()
   except:
     logging.error("The main thread in being killed.")
     server.stop(0)
-    psutil_with_cache.StopLoopingThread()
-    manager.StopDockerRefreshThread()
+    if FLAGS.stop_all_services_on_exit:
+      logging.info("Stopping all services.")
+      try:
+        manager.DrainNamespace()
+      except errors.ServiceManagerError as e:
+        logging.error("Cannot stop all services: %s", str(e))
+  if forward_server is not None:
+    forward_server.stop(0)
+  psutil_with_cache.StopLoopingThread()
+  manager.StopDockerRefreshThread()
+  manager.CloseStorage()
 
 
 if __name__ == "__main__":
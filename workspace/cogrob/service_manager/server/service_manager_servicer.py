@@ -0,0 +1,896 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.model import delayed_action
+from cogrob.service_manager.model import dependency_graph
+from cogrob.service_manager.model import meta_service
+from cogrob.service_manager.model import docker_service
+from cogrob.service_manager.model import group_service
+from cogrob.service_manager.model import operation_manager
+from cogrob.service_manager.model import service_events
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.proto import result_code_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.proto import service_state_pb2
+from cogrob.service_manager.server import admission_control
+from cogrob.service_manager.util import errors
+from cogrob.service_manager.util import rpc_deadline
+from cogrob.service_manager.util import rw_lock
+import base64
+import collections
+import contextlib
+import functools
+import grpc
+import math
+
+# Shared by service_manager_server_main and service_manager_aio_server_main.
+flags.DEFINE_string(
+    "service_manager_server_address", "[::]:7016",
+    "Address the gRPC server listens on.")
+flags.DEFINE_bool(
+    "stop_all_services_on_exit", False,
+    "Deactivate all the services (see StopAllServices) when the server is "
+    "taken down, instead of leaving their containers running. Not done when "
+    "the state is handed off to a new server.")
+FLAGS = flags.FLAGS
+ServiceId = service_id.ServiceId
+
+
+def _ForwardAfterHandoff(handler):
+  """Runs an RPC handler under the handoff gate. Once the state was handed off
+  to a new server, forwards the RPC to it instead."""
+  @functools.wraps(handler)
+  def Wrapper(self, request, context):
+    with self._handoff_gate.ReadLocked():
+      if self._forward_stub is not None:
+        return getattr(self._forward_stub, handler.__name__)(
+            request, timeout=rpc_deadline.GetTimeRemaining(context))
+      return handler(self, request, context)
+  return Wrapper
+
+
+def _RunBeforeDeadline(handler, servicer, request, context):
+  remaining = rpc_deadline.GetTimeRemaining(context)
+  if not context.is_active() or (remaining is not None and remaining <= 0):
+    raise errors.DeadlineExceededError("RPC expired before it started.")
+  return handler(servicer, request, context)
+
+
+def _Admit(lane):
+  """Runs an RPC handler in a slot of an admission_control lane. Rejects it
+  with RESOURCE_EXHAUSTED and a retry-after-ms trailing metadata if the lane
+  is full. The handler is skipped if the RPC expired or was cancelled while
+  it was queued, fails with DEADLINE_EXCEEDED if it times out waiting for the
+  services or the commit of its changes, and with INTERNAL if they cannot be
+  committed."""
+  def Decorator(handler):
+    @functools.wraps(handler)
+    def Wrapper(self, request, context):
+      try:
+        if self._admission_controller is None:
+          return _RunBeforeDeadline(handler, self, request, context)
+        with self._admission_controller.Admit(
+            lane, rpc_deadline.GetTimeRemaining(context)):
+          return _RunBeforeDeadline(handler, self, request, context)
+      except admission_control.AdmissionRejectedError as e:
+        context.set_trailing_metadata([(
+            "retry-after-ms",
+            str(int(math.ceil(e.GetRetryAfterSecs() * 1000))))])
+        context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+      except errors.DeadlineExceededError as e:
+        context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+      except errors.StateCommitError as e:
+        context.abort(grpc.StatusCode.INTERNAL, str(e))
+    return Wrapper
+  return Decorator
+
+
+def _GetStopDeadline(request, context):
+  """Returns the deadline_secs of a request stopping containers, no later than
+  the deadline of the RPC."""
+  deadline = request.deadline_secs or None
+  remaining = rpc_deadline.GetTimeRemaining(context)
+  if remaining is not None:
+    # Leave the containers the time to stop before the RPC deadline.
+    deadline = min(deadline or FLAGS.deactivation_deadline_secs, remaining)
+  return deadline
+
+
+def _EncodePageToken(srv_id):
+  return base64.urlsafe_b64encode(str(srv_id).encode("utf-8")).decode("ascii")
+
+
+def _DecodePageToken(page_token):
+  """Returns the sort key of the last service of the previous page."""
+  try:
+    id_str = base64.urlsafe_b64decode(page_token.encode("ascii"))
+    srv_id = service_id.ServiceId.FromString(id_str.decode("utf-8"))
+  except (TypeError, ValueError, errors.InvalidServiceIdError):
+    raise errors.InvalidServiceIdError(
+        "{} is not a valid page token.".format(page_token))
+  return (srv_id.namespace, srv_id.name)
+
+
+def _OrderByDependency(item_ids, dependencies):
+  """Returns the indices of the items of a batch, every item after those of
+  the services it depends on. item_ids[i] is the ServiceId of item i,
+  dependencies a dict from a ServiceId to those it depends on. The items of
+  one service keep the order of the request, those in dependency cycles come
+  last."""
+  graph = dependency_graph.DependencyGraph()
+  for srv_id, dep_ids in dependencies.items():
+    graph.SetDependencies(srv_id, set(dep_ids) - set([srv_id]), check=False)
+  indices = collections.OrderedDict()
+  for index, srv_id in enumerate(item_ids):
+    indices.setdefault(srv_id, []).append(index)
+  result = []
+  for srv_id in graph.GetTopologicalOrder():
+    result += indices.pop(srv_id, [])
+  # The services without dependencies in the batch.
+  for remaining in indices.values():
+    result += remaining
+  return result
+
+
+def _OrderByRequester(requester_ids, all_activated_ids):
+  """The order of _OrderByDependency for a batch of requests: a request comes
+  after those activating its requester. all_activated_ids[i] is the set of
+  services request i activates."""
+  requester_set = set(requester_ids)
+  dependencies = {}
+  for requester_id, activated_ids in zip(requester_ids, all_activated_ids):
+    for activated_id in activated_ids & requester_set:
+      dependencies.setdefault(activated_id, set()).add(requester_id)
+  return _OrderByDependency(requester_ids, dependencies)
+
+
+def _FillBatchResponse(response, results):
+  """Fill a batch response from a list of (result_code, error_message). The
+  overall result is the first failure, items aborted by it are not counted."""
+  num_failed = 0
+  for result_code, error_message in results:
+    response.results.add(result=result_code, error_message=error_message)
+    if result_code not in (result_code_pb2.RESULT_OK,
+                           result_code_pb2.RESULT_ABORTED):
+      if num_failed == 0:
+        response.result = result_code
+        response.error_message = error_message
+      num_failed += 1
+  if num_failed == 0:
+    response.result = result_code_pb2.RESULT_OK
+  elif num_failed > 1:
+    response.error_message = "{} of {} items failed, first: {}".format(
+        num_failed, len(results), response.error_message)
+
+
+class ServiceManagerServicer(
+    service_manager_rpc_pb2_grpc.ServiceManagerServicer):
+
+  def __init__(self, service_manager, psutil_with_cache,
+               admission_controller=None, max_workers=0):
+    self._service_manager = service_manager
+    self._psutil_with_cache = psutil_with_cache
+    # Reported by GetServerStats, the number of threads serving the RPCs.
+    self._max_workers = max_workers
+    # Without admission control, the RPCs are only limited by the threads.
+    self._admission_controller = admission_controller
+    self._operation_manager = operation_manager.OperationManager()
+
+    # Held shared by every RPC, and exclusively during a state handoff so that
+    # the state does not change while it is being sent.
+    self._handoff_gate = rw_lock.ReadWriteLock()
+    self._forward_stub = None
+
+
+  @contextlib.contextmanager
+  def _OutsideHandoffGate(self):
+    """Within a handler of _ForwardAfterHandoff, lets it wait (e.g. for the
+    services to be ready) without holding _handoff_gate, so that a handoff
+    does not wait for it. Nothing in this context may change the state."""
+    self._handoff_gate.ReleaseRead()
+    try:
+      yield
+    finally:
+      self._handoff_gate.AcquireRead()
+
+
+  def BeginHandoff(self):
+    """Waits for the in-flight RPCs, blocks the new ones and returns the
+    state, all of it committed to the storage. The RPCs waiting outside the
+    handoff gate are not waited for."""
+    self._handoff_gate.AcquireWrite()
+    # Background operations change the state too. The ones that are done are
+    # not handed off, clients waiting for them get RESULT_OPERATION_NOT_FOUND.
+    self._operation_manager.WaitForUnfinishedOperations()
+    self._service_manager.WaitForCommit(self._service_manager.WriteToDisk())
+    return self._service_manager.ExportSnapshot()
+
+
+  def CompleteHandoff(self, forward_address):
+    channel = grpc.insecure_channel(forward_address)
+    self._forward_stub = service_manager_rpc_pb2_grpc.ServiceManagerStub(
+        channel)
+    self._handoff_gate.ReleaseWrite()
+    # The new server publishes the events from now on, watchers reconnect.
+    self._service_manager.GetEventHub().CloseAll()
+
+
+  def AbortHandoff(self):
+    self._handoff_gate.ReleaseWrite()
+
+
+  def _CreateService(self, options):
+    """Create a service and add it to the manager. Must hold its lock."""
+    srv_id = ServiceId.FromProto(options.id)
+    if self._service_manager.GetService(srv_id, no_raise=True) is not None:
+      raise errors.ServiceAlreadyExistError(
+          "Service {} already exist in ServiceManager".format(srv_id))
+    # Before any container is created for it.
+    self._service_manager.CheckDependencies(options)
+
+    if options.type == service_options_pb2.SERVICE_TYPE_DOCKER:
+      service = docker_service.DockerService.CreateFromServiceOptionsPb(
+          options, self._service_manager)
+    elif options.type == service_options_pb2.SERVICE_TYPE_GROUP:
+      service = group_service.GroupService.CreateFromServiceOptionsPb(
+          options, self._service_manager)
+    elif options.type == service_options_pb2.SERVICE_TYPE_META:
+      service = meta_service.MetaService.CreateFromServiceOptionsPb(
+          options, self._service_manager)
+    else:
+      raise errors.ServiceTypeNotSupportedError()
+    self._service_manager.AddService(service)
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def CreateService(self, request, context):
+    srv_id = ServiceId.FromProto(request.options.id)
+    logging.info("Received create request: %s", str(srv_id))
+
+    response = service_manager_rpc_pb2.CreateServiceResponse()
+    with self._service_manager.LockServices(
+        [srv_id], rpc_deadline.GetTimeRemaining(context)) as locked_ids:
+      try:
+        self._CreateService(request.options)
+        response.result = result_code_pb2.RESULT_OK
+      except errors.ServiceManagerError as e:
+        response.result = e.GetResultCode()
+        response.error_message = str(e)
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(
+        commit_seq, rpc_deadline.GetTimeRemaining(context))
+    return response
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def BatchCreateServices(self, request, context):
+    all_options = [x.options for x in request.items]
+    srv_ids = [ServiceId.FromProto(x.id) for x in all_options]
+    logging.info("Received batch create request: %s",
+                 ", ".join(map(str, srv_ids)))
+    all_implied_dependencies = [
+        set(ServiceId.FromProto(x) for x in options.implied_dependencies)
+        for options in all_options]
+    dependencies = {}
+    for srv_id, implied_dependencies in zip(srv_ids, all_implied_dependencies):
+      dependencies.setdefault(srv_id, set()).update(implied_dependencies)
+    order = _OrderByDependency(srv_ids, dependencies)
+
+    response = service_manager_rpc_pb2.BatchCreateServicesResponse()
+    results = [(result_code_pb2.RESULT_ABORTED, "")] * len(srv_ids)
+    with self._service_manager.LockServices(
+        srv_ids, rpc_deadline.GetTimeRemaining(context)) as locked_ids:
+      created = []
+      failed = False
+      for index in order:
+        try:
+          self._CreateService(all_options[index])
+          results[index] = (result_code_pb2.RESULT_OK, "")
+          created.append(index)
+        except errors.ServiceManagerError as e:
+          results[index] = (e.GetResultCode(), str(e))
+          failed = True
+          if request.all_or_nothing:
+            break
+
+      if failed and request.all_or_nothing:
+        for index in reversed(created):
+          try:
+            self._service_manager.GetService(srv_ids[index]).Remove()
+          except errors.ServiceManagerError as e:
+            logging.error("Cannot roll back the creation of %s: %s",
+                          str(srv_ids[index]), str(e))
+          results[index] = (result_code_pb2.RESULT_ABORTED, "")
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(
+        commit_seq, rpc_deadline.GetTimeRemaining(context))
+    _FillBatchResponse(response, results)
+    return response
+
+
+  @_Admit(admission_control.LANE_READ)
+  @_ForwardAfterHandoff
+  def QueryService(self, request, context):
+    response = service_manager_rpc_pb2.QueryServiceResponse()
+    try:
+      srv_id = ServiceId.FromProto(request.id)
+      logging.info("Received query request: %s", str(srv_id))
+      # The state is already serialized in the snapshot.
+      response.service_status.MergeFromString(
+          self._service_manager.GetServiceSnapshot(srv_id).serialized_state)
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def UpdateService(self, request, context):
+    srv_id = ServiceId.FromProto(request.options.id)
+    response = service_manager_rpc_pb2.UpdateServiceResponse()
+    # The service is activated again with its new dependencies, they are
+    # changed too.
+    lock_ids = [srv_id]
+    lock_ids.extend(dependency_graph.GetStaticDependencies(request.options))
+    with self._service_manager.LockServices(
+        lock_ids, rpc_deadline.GetTimeRemaining(context)) as locked_ids:
+      try:
+        service = self._service_manager.GetService(srv_id)
+        self._service_manager.UpdateDependencies(srv_id, request.options)
+        try:
+          with self._service_manager.PlanActivation():
+            service.Update(request.options)
+        finally:
+          # The update could have failed before taking the new options.
+          self._service_manager.UpdateDependencies(
+              srv_id, service.GetStateProto().options, check=False)
+        response.result = result_code_pb2.RESULT_OK
+      except errors.ServiceManagerError as e:
+        response.result = e.GetResultCode()
+        response.error_message = str(e)
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(
+        commit_seq, rpc_deadline.GetTimeRemaining(context))
+    return response
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def RemoveService(self, request, context):
+    srv_id = ServiceId.FromProto(request.id)
+    logging.info("Received remove request: %s", str(srv_id))
+    response = service_manager_rpc_pb2.RemoveServiceResponse()
+    with self._service_manager.LockServices(
+        [srv_id], rpc_deadline.GetTimeRemaining(context)) as locked_ids:
+      try:
+        service = self._service_manager.GetService(srv_id)
+        logging.info("Found service: %s", str(srv_id))
+        service.Remove()
+        logging.info("Removed service: %s", str(srv_id))
+        response.result = result_code_pb2.RESULT_OK
+      except errors.ServiceManagerError as e:
+        response.result = e.GetResultCode()
+        response.error_message = str(e)
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(
+        commit_seq, rpc_deadline.GetTimeRemaining(context))
+    return response
+
+
+  def GetOperationManager(self):
+    return self._operation_manager
+
+
+  def RunServiceRequest(self, srv_request, timeout=None):
+    """Request the services and commit the changes. Returns the delayed
+    actions, raises errors.ServiceManagerError (DeadlineExceededError if the
+    services are not available in timeout seconds). Also used by the grpc.aio
+    server, which waits for the delayed actions on its event loop."""
+    deadline = rpc_deadline.RpcDeadline(timeout)
+    error = None
+    delayed_actions = []
+    with self._service_manager.LockServices(
+        [srv_request.request_id.service_id] +
+        list(srv_request.requested_services), timeout) as locked_ids:
+      # Waiting for the locks may have used up the deadline, nothing to commit
+      # yet.
+      deadline.Check()
+      try:
+        with self._service_manager.PlanActivation():
+          delayed_actions = self._service_manager.RequestService(srv_request)
+        assert delayed_actions is not None
+      except errors.ServiceManagerError as e:
+        error = e
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(commit_seq, deadline.TimeRemaining())
+    if error is not None:
+      raise error
+    return delayed_actions
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def RequestService(self, request, context):
+    response = service_manager_rpc_pb2.RequestServiceResponse()
+    srv_request = service_request.ServiceRequest.FromProto(request.request)
+    if request.return_operation:
+      response.operation_id = self._operation_manager.Submit(
+          functools.partial(self.RunServiceRequest, srv_request),
+          request.wait_for_ready)
+      response.result = result_code_pb2.RESULT_OK
+      return response
+
+    deadline = rpc_deadline.RpcDeadline.FromContext(context)
+    try:
+      delayed_actions = self.RunServiceRequest(
+          srv_request, deadline.TimeRemaining())
+      # The containers are being started by the activation executor, waiting
+      # for them to be ready does not need to block the other RPCs. Stops
+      # waiting if the client goes away.
+      if request.wait_for_ready:
+        with self._OutsideHandoffGate():
+          ready = deadline.WaitFuture(
+              delayed_action.AllOf(delayed_actions).GetFuture())
+        if not ready:
+          raise errors.DeadlineExceededError(
+              "Services requested, but not ready before the deadline.")
+      else:
+        response.delayed_actions.extend([
+            leaf.ToProto() for action in delayed_actions
+            for leaf in action.GetLeafActions()])
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  def RunBatchRequest(self, request, timeout=None):
+    """Apply a BatchRequestServicesRequest and commit the changes, without
+    waiting for the services to be ready. Returns the response and the delayed
+    actions. Raises errors.DeadlineExceededError if the services are not
+    available in timeout seconds. Once the deadline is over, the remaining
+    requests are not applied, as if the first of them failed with
+    RESULT_DEADLINE_EXCEEDED."""
+    deadline = rpc_deadline.RpcDeadline(timeout)
+    srv_requests = [service_request.ServiceRequest.FromProto(x)
+                    for x in request.requests]
+    logging.info("Received batch request of %d requests.", len(srv_requests))
+
+    # A request must come after the ones activating its requester.
+    all_activated_ids = [
+        self._service_manager.GetAffectedServiceIds(x.requested_services)
+        for x in srv_requests]
+    order = _OrderByRequester(
+        [x.request_id.service_id for x in srv_requests], all_activated_ids)
+
+    response = service_manager_rpc_pb2.BatchRequestServicesResponse()
+    results = [(result_code_pb2.RESULT_ABORTED, "")] * len(srv_requests)
+    all_delayed_actions = []
+    lock_ids = []
+    for srv_request in srv_requests:
+      lock_ids.append(srv_request.request_id.service_id)
+      lock_ids += srv_request.requested_services
+    with self._service_manager.LockServices(lock_ids, timeout) as locked_ids:
+      deadline.Check()
+      with self._service_manager.PlanActivation():
+        applied = []
+        failed = False
+        for index in order:
+          try:
+            deadline.Check()
+          except errors.DeadlineExceededError as e:
+            results[index] = (e.GetResultCode(), str(e))
+            failed = True
+            break
+          try:
+            all_delayed_actions += self._service_manager.RequestService(
+                srv_requests[index])
+            results[index] = (result_code_pb2.RESULT_OK, "")
+            applied.append(index)
+          except errors.ServiceManagerError as e:
+            results[index] = (e.GetResultCode(), str(e))
+            failed = True
+            if request.all_or_nothing:
+              break
+
+        if failed and request.all_or_nothing:
+          all_delayed_actions = []
+          try:
+            with self._service_manager.DeferContainerStops():
+              for index in reversed(applied):
+                try:
+                  self._service_manager.ReleaseService(
+                      srv_requests[index].request_id)
+                except errors.ServiceManagerError as e:
+                  logging.error("Cannot roll back request %s: %s",
+                                str(srv_requests[index].request_id), str(e))
+                results[index] = (result_code_pb2.RESULT_ABORTED, "")
+          except errors.ServiceManagerError as e:
+            # The results stand, only stopping some containers failed.
+            logging.error("%s", str(e))
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(commit_seq, deadline.TimeRemaining())
+    _FillBatchResponse(response, results)
+    return response, all_delayed_actions
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def BatchRequestServices(self, request, context):
+    deadline = rpc_deadline.RpcDeadline.FromContext(context)
+    response, all_delayed_actions = self.RunBatchRequest(
+        request, deadline.TimeRemaining())
+    try:
+      if request.wait_for_ready:
+        with self._OutsideHandoffGate():
+          ready = deadline.WaitFuture(
+              delayed_action.AllOf(all_delayed_actions).GetFuture())
+        if not ready:
+          raise errors.DeadlineExceededError(
+              "Services requested, but not ready before the deadline.")
+      else:
+        response.delayed_actions.extend([
+            leaf.ToProto() for action in all_delayed_actions
+            for leaf in action.GetLeafActions()])
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def BatchReleaseServices(self, request, context):
+    request_ids = [service_request.ServiceRequestId.FromProto(x)
+                   for x in request.request_ids]
+    logging.info("Received batch release of %d requests.", len(request_ids))
+
+    response = service_manager_rpc_pb2.BatchReleaseServicesResponse()
+    results = [(result_code_pb2.RESULT_ABORTED, "")] * len(request_ids)
+    with self._service_manager.LockServices(
+        [x.service_id for x in request_ids],
+        rpc_deadline.GetTimeRemaining(context)) as locked_ids:
+      # The requests being released, to order them and to roll back.
+      srv_requests = []
+      for request_id in request_ids:
+        requester = self._service_manager.GetService(
+            request_id.service_id, no_raise=True)
+        srv_requests.append(requester.GetRequestBySelf(request_id)
+                            if requester is not None else None)
+      all_activated_ids = [
+          self._service_manager.GetAffectedServiceIds(x.requested_services)
+          if x is not None else set() for x in srv_requests]
+      # A request must be released before the ones deactivating its
+      # requester, the reverse order of BatchRequestServices.
+      order = list(reversed(_OrderByRequester(
+          [x.service_id for x in request_ids], all_activated_ids)))
+
+      released = []
+      failed = False
+      try:
+        with self._service_manager.DeferContainerStops():
+          for index in order:
+            try:
+              self._service_manager.ReleaseService(request_ids[index])
+              results[index] = (result_code_pb2.RESULT_OK, "")
+              released.append(index)
+            except errors.ServiceManagerError as e:
+              results[index] = (e.GetResultCode(), str(e))
+              failed = True
+              if request.all_or_nothing:
+                break
+      except errors.ServiceManagerError as e:
+        # The results stand, only stopping some containers failed.
+        logging.error("%s", str(e))
+
+      if failed and request.all_or_nothing:
+        with self._service_manager.PlanActivation():
+          for index in reversed(released):
+            try:
+              self._service_manager.RequestService(srv_requests[index])
+            except errors.ServiceManagerError as e:
+              logging.error("Cannot roll back the release of %s: %s",
+                            str(request_ids[index]), str(e))
+            results[index] = (result_code_pb2.RESULT_ABORTED, "")
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(
+        commit_seq, rpc_deadline.GetTimeRemaining(context))
+    _FillBatchResponse(response, results)
+    return response
+
+
+  def _DrainNamespace(self, namespace_prefix, request, response, context):
+    try:
+      deactivated_ids = self._service_manager.DrainNamespace(
+          namespace_prefix, rpc_deadline.GetTimeRemaining(context),
+          request.stop_timeout_secs or None,
+          _GetStopDeadline(request, context))
+      response.deactivated_services.extend(
+          [x.ToProto() for x in deactivated_ids])
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def DrainNamespace(self, request, context):
+    logging.info("Received drain request: %s", "/".join(request.namespace))
+    return self._DrainNamespace(
+        request.namespace, request,
+        service_manager_rpc_pb2.DrainNamespaceResponse(), context)
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def StopAllServices(self, request, context):
+    logging.info("Received stop all services request.")
+    return self._DrainNamespace(
+        (), request, service_manager_rpc_pb2.StopAllServicesResponse(),
+        context)
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def ReleaseAllByRequester(self, request, context):
+    requester_id = ServiceId.FromProto(request.requester)
+    logging.info("Received release all by requester: %s", str(requester_id))
+    response = service_manager_rpc_pb2.ReleaseAllByRequesterResponse()
+    try:
+      released_ids = self._service_manager.ReleaseAllByRequester(
+          requester_id, rpc_deadline.GetTimeRemaining(context),
+          request.stop_timeout_secs or None,
+          _GetStopDeadline(request, context))
+      response.released_requests.extend([x.ToProto() for x in released_ids])
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_READ)
+  @_ForwardAfterHandoff
+  def ServiceHeartbeat(self, request, context):
+    response = service_manager_rpc_pb2.ServiceHeartbeatResponse()
+    try:
+      srv_id = ServiceId.FromProto(request.id)
+      self._service_manager.GetService(srv_id)
+      num_actions = delayed_action.NotifyServiceHeartbeat(srv_id)
+      logging.info("Received heartbeat of %s, met %d delayed actions.",
+                   str(srv_id), num_actions)
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_READ)
+  @_ForwardAfterHandoff
+  def GetOperation(self, request, context):
+    response = service_manager_rpc_pb2.GetOperationResponse()
+    try:
+      response.operation.CopyFrom(
+          self._operation_manager.GetOperation(request.operation_id))
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_WAIT)
+  @_ForwardAfterHandoff
+  def WaitOperation(self, request, context):
+    response = service_manager_rpc_pb2.WaitOperationResponse()
+    deadline = rpc_deadline.RpcDeadline.FromContext(
+        context, request.timeout_secs if request.timeout_secs > 0 else None)
+    try:
+      done_future = self._operation_manager.GetDoneFuture(request.operation_id)
+      with self._OutsideHandoffGate():
+        done = deadline.WaitFuture(done_future)
+      # The operation is reported either way, so that its progress is known.
+      response.operation.CopyFrom(
+          self._operation_manager.GetOperation(request.operation_id))
+      if not done:
+        raise errors.DeadlineExceededError(
+            "Operation {} is not done yet.".format(request.operation_id))
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_READ)
+  @_ForwardAfterHandoff
+  def ListServices(self, request, context):
+    del context
+    response = service_manager_rpc_pb2.ListServicesResponse()
+    ListServicesRequest = service_manager_rpc_pb2.ListServicesRequest
+    has_requesters = {
+        ListServicesRequest.HAS_REQUESTERS: True,
+        ListServicesRequest.NO_REQUESTERS: False,
+    }.get(request.requester_filter)
+    try:
+      unknown_fields = [
+          x for x in request.state_fields
+          if x not in service_state_pb2.ServiceState.DESCRIPTOR.fields_by_name]
+      if unknown_fields:
+        raise errors.ServiceManagerError(
+            "Unknown ServiceState fields: {}.".format(
+                ", ".join(unknown_fields)),
+            result_code_pb2.RESULT_SERVICE_INVALID_OPTIONS)
+      page_after = None
+      if request.page_token:
+        page_after = _DecodePageToken(request.page_token)
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+      return response
+
+    matches = self._service_manager.QueryServices(
+        namespace_prefix=request.namespace_prefix,
+        statuses=set(request.statuses), types=set(request.types),
+        run_modes=set(request.run_modes), has_requesters=has_requesters)
+    if page_after is not None:
+      # matches are sorted by (namespace, name), so are the pages.
+      matches = [
+          x for x in matches
+          if (x.service_id.namespace, x.service_id.name) > page_after]
+    if request.page_size and len(matches) > request.page_size:
+      matches = matches[:request.page_size]
+      response.next_page_token = _EncodePageToken(matches[-1].service_id)
+
+    for srv_snapshot in matches:
+      response.services.extend([srv_snapshot.service_id.ToProto()])
+      if request.include_state:
+        state_pb = response.service_states.add()
+        state_pb.ParseFromString(srv_snapshot.serialized_state)
+        if request.state_fields:
+          for field in state_pb.DESCRIPTOR.fields:
+            if field.name not in request.state_fields:
+              state_pb.ClearField(field.name)
+    response.result = result_code_pb2.RESULT_OK
+    return response
+
+
+  @_Admit(admission_control.LANE_MUTATION)
+  @_ForwardAfterHandoff
+  def ReleaseService(self, request, context):
+    response = service_manager_rpc_pb2.ReleaseServiceResponse()
+    request_id = service_request.ServiceRequestId.FromProto(request.request_id)
+    with self._service_manager.LockServices(
+        [request_id.service_id],
+        rpc_deadline.GetTimeRemaining(context)) as locked_ids:
+      try:
+        with self._service_manager.DeferContainerStops():
+          self._service_manager.ReleaseService(request_id)
+        response.result = result_code_pb2.RESULT_OK
+      except errors.ServiceManagerError as e:
+        response.result = e.GetResultCode()
+        response.error_message = str(e)
+      commit_seq = self._service_manager.WriteToDisk(locked_ids)
+    self._service_manager.WaitForCommit(
+        commit_seq, rpc_deadline.GetTimeRemaining(context))
+    return response
+
+
+  def WatchServices(self, request, context):
+    # A stream lasts until the client cancels it, so unlike the unary RPCs it
+    # does not hold _handoff_gate. After a handoff, it is ended with
+    # UNAVAILABLE and the client resumes from the last revision it got.
+    if self._forward_stub is not None:
+      for event in self._forward_stub.WatchServices(request):
+        yield event
+      return
+
+    subscription = self._service_manager.GetEventHub().Subscribe(
+        service_events.EventFilter.FromProto(request), request.from_revision)
+    if subscription is None:
+      context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                    "Too many watchers, try again later.")
+    context.add_callback(subscription.Close)
+    try:
+      while True:
+        event = subscription.Get()
+        if event is None:
+          break
+        yield event
+    finally:
+      subscription.Close()
+    if context.is_active():
+      context.abort(grpc.StatusCode.UNAVAILABLE,
+                    "Server is restarting, resume from the last revision.")
+
+
+  def GetServerStats(self, request, context):
+    # Not forwarded after a handoff, nor admitted: it reports this server.
+    del request
+    response = service_manager_rpc_pb2.GetServerStatsResponse()
+    if self._admission_controller is not None:
+      response.lanes.extend(self._admission_controller.GetLaneStats())
+    response.max_workers = self._max_workers
+    response.result = result_code_pb2.RESULT_OK
+    return response
+
+
+  @_Admit(admission_control.LANE_READ)
+  @_ForwardAfterHandoff
+  def QueryServiceResourceUsage(self, request, context):
+    response = service_manager_rpc_pb2.QueryServiceResourceUsageResponse()
+    try:
+      srv_id = ServiceId.FromProto(request.id)
+      logging.info("Received query resource request: %s", str(srv_id))
+      service = self._service_manager.GetServiceSnapshot(srv_id).service
+      cpu_usage = service.GetCpuUsage()
+      memory_usage = service.GetMemoryUsage()
+      if cpu_usage is not None:
+        response.cpu_usage = cpu_usage
+      if memory_usage is not None:
+        response.memory_usage = memory_usage
+      response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
+
+
+  @_Admit(admission_control.LANE_READ)
+  @_ForwardAfterHandoff
+  def QueryTotalResourceUsage(self, request, context):
+    response = service_manager_rpc_pb2.QueryTotalResourceUsageResponse()
+    try:
+      if request.collect_method == (
+          service_manager_rpc_pb2.QueryTotalResourceUsageRequest
+          .COLLECT_METHOD_SUM_INDIVIDUAL):
+        response.cpu_usage = self._service_manager.CollectAllServiceCpuUsage()
+        response.memory_usage = (
+            self._service_manager.CollectAllServiceMemoryUsage())
+        response.result = result_code_pb2.RESULT_OK
+      elif request.collect_method == (
+          service_manager_rpc_pb2.QueryTotalResourceUsageRequest
+          .COLLECT_METHOD_PSUTIL):
+        response.cpu_usage = self._psutil_with_cache.GetCpuUsage()
+        response.memory_usage = self._psutil_with_cache.GetMemoryUsage()
+        response.result = result_code_pb2.RESULT_OK
+    except errors.ServiceManagerError as e:
+      response.result = e.GetResultCode()
+      response.error_message = str(e)
+    return response
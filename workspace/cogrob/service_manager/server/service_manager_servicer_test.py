@@ -0,0 +1,389 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from concurrent import futures
+from cogrob.service_manager.model import service_id
+from cogrob.service_manager.model import service_manager
+from cogrob.service_manager.model import service_request
+from cogrob.service_manager.proto import result_code_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2
+from cogrob.service_manager.proto import service_manager_rpc_pb2_grpc
+from cogrob.service_manager.proto import service_options_pb2
+from cogrob.service_manager.proto import service_state_pb2
+from cogrob.service_manager.server import admission_control
+from cogrob.service_manager.server import service_manager_servicer
+from cogrob.service_manager.util import errors
+import grpc
+import shutil
+import tempfile
+import time
+
+FLAGS = flags.FLAGS
+ServiceId = service_id.ServiceId
+_OPERATOR_ID = ServiceId(["__builtin"], "__operator")
+
+
+def _Id(name):
+  return ServiceId(["robot"], name)
+
+
+def _MakeOptions(name, dependencies=(), wait_for_prober=False):
+  options = service_options_pb2.ServiceOptions()
+  options.id.CopyFrom(_Id(name).ToProto())
+  options.type = service_options_pb2.SERVICE_TYPE_DOCKER
+  options.run_mode = service_options_pb2.RUN_MODE_SIMULATION
+  options.docker_service_options.container_options.image = "ubuntu"
+  for dependency in dependencies:
+    options.implied_dependencies.extend([_Id(dependency).ToProto()])
+  if wait_for_prober:
+    options.ready_detection_method.wait_for_prober = True
+  return options
+
+
+def _MakeRequest(uuid, names):
+  return service_request.ServiceRequest(
+      service_request.ServiceRequestId(_OPERATOR_ID, uuid),
+      [_Id(x) for x in names]).ToProto()
+
+
+class OrderByDependencyTest(absltest.TestCase):
+
+  def testDependenciesFirst(self):
+    # app -> lib -> base, the dependencies of tool are outside of the batch.
+    item_ids = [_Id("app"), _Id("tool"), _Id("lib"), _Id("base"), _Id("app")]
+    dependencies = {_Id("app"): [_Id("lib")], _Id("lib"): [_Id("base")],
+                    _Id("tool"): [_Id("other")]}
+    order = service_manager_servicer._OrderByDependency(item_ids, dependencies)
+    self.assertCountEqual(range(5), order)
+    position = dict((x, order.index(x)) for x in range(5))
+    self.assertLess(position[3], position[2])
+    self.assertLess(position[2], position[0])
+    # The items of one service keep their order.
+    self.assertLess(position[0], position[4])
+
+
+  def testCycles(self):
+    item_ids = [_Id("a"), _Id("b"), _Id("e"), _Id("d")]
+    dependencies = {_Id("a"): [_Id("b")], _Id("b"): [_Id("a")],
+                    _Id("d"): [_Id("d"), _Id("e")]}
+    self.assertEqual(
+        [2, 3, 0, 1],
+        service_manager_servicer._OrderByDependency(item_ids, dependencies))
+
+
+  def testOrderByRequester(self):
+    # Request 0 is sent by a, which request 1 activates.
+    order = service_manager_servicer._OrderByRequester(
+        [_Id("a"), _OPERATOR_ID], [set([_Id("b")]), set([_Id("a"), _Id("b")])])
+    self.assertEqual([1, 0], order)
+
+
+class ServiceManagerServicerTest(absltest.TestCase):
+  # Serves a ServiceManager of simulated services on a local port.
+
+  def setUp(self):
+    super(ServiceManagerServicerTest, self).setUp()
+    self._dir = tempfile.mkdtemp()
+    FLAGS.service_manager_storage_base_path = self._dir
+    self._manager = service_manager.ServiceManager()
+    self._manager.CreateMetaOperatorService()
+    self._manager.WaitForCommit(self._manager.WriteToDisk())
+    self._timeouts = self._RecordTimeouts()
+
+    self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    self._servicer = service_manager_servicer.ServiceManagerServicer(
+        self._manager, None, admission_control.AdmissionController())
+    service_manager_rpc_pb2_grpc.add_ServiceManagerServicer_to_server(
+        self._servicer, self._server)
+    port = self._server.add_insecure_port("localhost:0")
+    self._server.start()
+    self._channel = grpc.insecure_channel("localhost:{}".format(port))
+    self._stub = service_manager_rpc_pb2_grpc.ServiceManagerStub(
+        self._channel)
+
+
+  def tearDown(self):
+    self._channel.close()
+    self._server.stop(0)
+    self._manager.CloseStorage()
+    shutil.rmtree(self._dir)
+    super(ServiceManagerServicerTest, self).tearDown()
+
+
+  def _RecordTimeouts(self):
+    """Returns the list the timeouts the RPCs pass to LockServices and
+    WaitForCommit are appended to."""
+    timeouts = []
+    lock_services = self._manager.LockServices
+    wait_for_commit = self._manager.WaitForCommit
+    def _LockServices(service_ids, timeout=None):
+      timeouts.append(timeout)
+      return lock_services(service_ids, timeout)
+    def _WaitForCommit(commit_seq, timeout=None):
+      timeouts.append(timeout)
+      return wait_for_commit(commit_seq, timeout)
+    self._manager.LockServices = _LockServices
+    self._manager.WaitForCommit = _WaitForCommit
+    return timeouts
+
+
+  def _GetStatus(self, name):
+    return self._stub.QueryService(service_manager_rpc_pb2.QueryServiceRequest(
+        id=_Id(name).ToProto())).service_status.status
+
+
+  def _RunMutations(self, timeout=None):
+    response = self._stub.CreateService(
+        service_manager_rpc_pb2.CreateServiceRequest(
+            options=_MakeOptions("a")),
+        timeout=timeout)
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+    response = self._stub.RequestService(
+        service_manager_rpc_pb2.RequestServiceRequest(
+            request=_MakeRequest("r1", ["a"]), wait_for_ready=True),
+        timeout=timeout)
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+    response = self._stub.ReleaseService(
+        service_manager_rpc_pb2.ReleaseServiceRequest(
+            request_id=_MakeRequest("r1", []).request_id),
+        timeout=timeout)
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+
+
+  def testMutationsWithoutDeadline(self):
+    self._RunMutations()
+    self.assertNotEmpty(self._timeouts)
+    # No huge timeout reaches the waits of the threading module.
+    self.assertEqual([None] * len(self._timeouts), self._timeouts)
+
+
+  def testMutationsWithDeadline(self):
+    self._RunMutations(timeout=30)
+    self.assertNotEmpty(self._timeouts)
+    for timeout in self._timeouts:
+      self.assertBetween(timeout, 0, 31)
+
+
+  def testServiceHeartbeat(self):
+    response = self._stub.CreateService(
+        service_manager_rpc_pb2.CreateServiceRequest(
+            options=_MakeOptions("a", wait_for_prober=True)))
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+    future = self._stub.RequestService.future(
+        service_manager_rpc_pb2.RequestServiceRequest(
+            request=_MakeRequest("r1", ["a"]), wait_for_ready=True),
+        timeout=10)
+    # The service keeps sending heartbeats, the first ones can come before
+    # its container is started.
+    while not future.done():
+      response = self._stub.ServiceHeartbeat(
+          service_manager_rpc_pb2.ServiceHeartbeatRequest(
+              id=_Id("a").ToProto()))
+      self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+      time.sleep(0.01)
+    self.assertEqual(result_code_pb2.RESULT_OK, future.result().result)
+
+    response = self._stub.ServiceHeartbeat(
+        service_manager_rpc_pb2.ServiceHeartbeatRequest(
+            id=_Id("unknown").ToProto()))
+    self.assertEqual(
+        result_code_pb2.RESULT_SERVICE_NOT_FOUND, response.result)
+
+
+  def testCreateAndRequestGroup(self):
+    for name in ["a", "b"]:
+      response = self._stub.CreateService(
+          service_manager_rpc_pb2.CreateServiceRequest(
+              options=_MakeOptions(name)))
+      self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+    options = service_options_pb2.ServiceOptions()
+    options.id.CopyFrom(_Id("grp").ToProto())
+    options.type = service_options_pb2.SERVICE_TYPE_GROUP
+    options.group_service_options.grouped_services.extend(
+        [_Id("a").ToProto(), _Id("b").ToProto()])
+    response = self._stub.CreateService(
+        service_manager_rpc_pb2.CreateServiceRequest(options=options))
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+
+    response = self._stub.RequestService(
+        service_manager_rpc_pb2.RequestServiceRequest(
+            request=_MakeRequest("r1", ["grp"]), wait_for_ready=True))
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+    for name in ["grp", "a", "b"]:
+      self.assertEqual(service_state_pb2.ServiceState.STATUS_ACTIVE,
+                       self._GetStatus(name))
+
+
+  def _BatchCreate(self, names, all_or_nothing):
+    request = service_manager_rpc_pb2.BatchCreateServicesRequest(
+        all_or_nothing=all_or_nothing)
+    for name in names:
+      dependencies = ["lib"] if name == "app" else []
+      request.items.add().options.CopyFrom(_MakeOptions(name, dependencies))
+    return self._stub.BatchCreateServices(request)
+
+
+  def _HasService(self, name):
+    return self._manager.GetService(_Id(name), no_raise=True) is not None
+
+
+  def _ItemResults(self, response):
+    return [x.result for x in response.results]
+
+
+  def testBatchCreate(self):
+    # app is created after lib, which it depends on.
+    response = self._BatchCreate(["app", "lib"], True)
+    self.assertEqual(result_code_pb2.RESULT_OK, response.result)
+    self.assertEqual([result_code_pb2.RESULT_OK] * 2,
+                     self._ItemResults(response))
+
+    response = self._BatchCreate(["a", "lib", "b"], False)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_ALREADY_EXIST,
+                     response.result)
+    self.assertEqual([result_code_pb2.RESULT_OK,
+                      result_code_pb2.RESULT_SERVICE_ALREADY_EXIST,
+                      result_code_pb2.RESULT_OK], self._ItemResults(response))
+    self.assertTrue(self._HasService("a"))
+    self.assertTrue(self._HasService("b"))
+
+
+  def testBatchCreateAllOrNothing(self):
+    self._BatchCreate(["lib"], True)
+    response = self._BatchCreate(["a", "lib", "b"], True)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_ALREADY_EXIST,
+                     response.result)
+    results = self._ItemResults(response)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_ALREADY_EXIST, results[1])
+    # The others are rolled back, or not created at all.
+    self.assertEqual([result_code_pb2.RESULT_ABORTED] * 2,
+                     [results[0], results[2]])
+    self.assertFalse(self._HasService("a"))
+    self.assertFalse(self._HasService("b"))
+    self.assertTrue(self._HasService("lib"))
+
+
+  def _BatchRequest(self, requests, all_or_nothing):
+    return self._stub.BatchRequestServices(
+        service_manager_rpc_pb2.BatchRequestServicesRequest(
+            requests=[_MakeRequest(uuid, names) for uuid, names in requests],
+            all_or_nothing=all_or_nothing, wait_for_ready=True))
+
+
+  def testBatchRequest(self):
+    self._BatchCreate(["a", "b"], True)
+    response = self._BatchRequest(
+        [("r1", ["a"]), ("r2", ["missing"]), ("r3", ["b"])], False)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_NOT_FOUND, response.result)
+    self.assertEqual([result_code_pb2.RESULT_OK,
+                      result_code_pb2.RESULT_SERVICE_NOT_FOUND,
+                      result_code_pb2.RESULT_OK], self._ItemResults(response))
+    for name in ["a", "b"]:
+      self.assertEqual(service_state_pb2.ServiceState.STATUS_ACTIVE,
+                       self._GetStatus(name))
+
+
+  def testBatchRequestAllOrNothing(self):
+    self._BatchCreate(["a", "b"], True)
+    response = self._BatchRequest(
+        [("r1", ["a"]), ("r2", ["missing"]), ("r3", ["b"])], True)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_NOT_FOUND, response.result)
+    results = self._ItemResults(response)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_NOT_FOUND, results[1])
+    self.assertEqual([result_code_pb2.RESULT_ABORTED] * 2,
+                     [results[0], results[2]])
+    for name in ["a", "b"]:
+      self.assertEqual(service_state_pb2.ServiceState.STATUS_STOPPED,
+                       self._GetStatus(name))
+
+
+  def _BatchRelease(self, uuids, all_or_nothing):
+    return self._stub.BatchReleaseServices(
+        service_manager_rpc_pb2.BatchReleaseServicesRequest(
+            request_ids=[_MakeRequest(x, []).request_id for x in uuids],
+            all_or_nothing=all_or_nothing))
+
+
+  def _SlowDownLocks(self, delay):
+    lock_services = self._manager.LockServices
+    def _LockServices(service_ids, timeout=None):
+      time.sleep(delay)
+      return lock_services(service_ids, timeout)
+    self._manager.LockServices = _LockServices
+
+
+  def testRequestsNotAppliedPastDeadline(self):
+    self._BatchCreate(["a", "b"], True)
+    self._SlowDownLocks(0.2)
+    with self.assertRaises(errors.DeadlineExceededError):
+      self._servicer.RunServiceRequest(
+          service_request.ServiceRequest.FromProto(_MakeRequest("r1", ["a"])),
+          0.1)
+    with self.assertRaises(errors.DeadlineExceededError):
+      self._servicer.RunBatchRequest(
+          service_manager_rpc_pb2.BatchRequestServicesRequest(
+              requests=[_MakeRequest("r2", ["b"])]), 0.1)
+    for name in ["a", "b"]:
+      self.assertEqual(service_state_pb2.ServiceState.STATUS_STOPPED,
+                       self._GetStatus(name))
+
+
+  def testBatchRelease(self):
+    self._BatchCreate(["a", "b"], True)
+    self._BatchRequest([("r1", ["a"]), ("r2", ["b"])], True)
+    response = self._BatchRelease(["r1", "missing"], False)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_REQUEST_NOT_EXIST,
+                     response.result)
+    self.assertEqual([result_code_pb2.RESULT_OK,
+                      result_code_pb2.RESULT_SERVICE_REQUEST_NOT_EXIST],
+                     self._ItemResults(response))
+    self.assertEqual(service_state_pb2.ServiceState.STATUS_STOPPED,
+                     self._GetStatus("a"))
+    self.assertEqual(service_state_pb2.ServiceState.STATUS_ACTIVE,
+                     self._GetStatus("b"))
+
+
+  def testBatchReleaseAllOrNothing(self):
+    self._BatchCreate(["a", "b"], True)
+    self._BatchRequest([("r1", ["a"]), ("r2", ["b"])], True)
+    response = self._BatchRelease(["r1", "missing", "r2"], True)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_REQUEST_NOT_EXIST,
+                     response.result)
+    results = self._ItemResults(response)
+    self.assertEqual(result_code_pb2.RESULT_SERVICE_REQUEST_NOT_EXIST,
+                     results[1])
+    self.assertEqual([result_code_pb2.RESULT_ABORTED] * 2,
+                     [results[0], results[2]])
+    # The released requests are sent again.
+    for name in ["a", "b"]:
+      self.assertEqual(service_state_pb2.ServiceState.STATUS_ACTIVE,
+                       self._GetStatus(name))
+
+
+if __name__ == "__main__":
+  absltest.main()
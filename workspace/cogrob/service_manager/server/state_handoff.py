@@ -0,0 +1,241 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl import logging
+from cogrob.service_manager.proto import state_journal_pb2
+import errno
+import os
+import socket
+import struct
+import threading
+
+flags.DEFINE_string(
+    "handoff_socket_path", "",
+    "Unix socket on which a running server hands its state off to a new "
+    "server process, e.g. /run/rorg/handoff.sock. Only processes of the same "
+    "user can use it. Empty to disable handoff.")
+flags.DEFINE_bool(
+    "handoff_from_running_server", False,
+    "Take the state over from the server listening on --handoff_socket_path "
+    "instead of loading it from the disk. Falls back to the disk if no server "
+    "is listening.")
+flags.DEFINE_float(
+    "handoff_timeout_secs", 60,
+    "Give up a handoff if the other process does not answer in time.")
+FLAGS = flags.FLAGS
+
+StateSnapshot = state_journal_pb2.StateSnapshot
+
+# Every message on the handoff socket is bytes, prefixed by its length, a
+# little-endian uint32. The forward address is sent as UTF-8.
+_MESSAGE_HEADER = struct.Struct("<I")
+
+
+def _SendMessage(sock, payload):
+  sock.sendall(_MESSAGE_HEADER.pack(len(payload)) + payload)
+
+
+def _RecvExactly(sock, length):
+  chunks = []
+  while length > 0:
+    chunk = sock.recv(min(length, 1 << 20))
+    if not chunk:
+      raise IOError("Handoff socket closed by the other process.")
+    chunks.append(chunk)
+    length -= len(chunk)
+  return b"".join(chunks)
+
+
+def _RecvMessage(sock):
+  length, = _MESSAGE_HEADER.unpack(_RecvExactly(sock, _MESSAGE_HEADER.size))
+  return _RecvExactly(sock, length)
+
+
+def _CheckPeer(sock):
+  """Raises IOError unless the other end of a unix socket runs as the same
+  user. Where the peer credentials are not available, only the permissions of
+  the socket file protect it."""
+  so_peercred = getattr(socket, "SO_PEERCRED", None)
+  if so_peercred is None:
+    return
+  credentials = struct.Struct("3i")
+  _, uid, _ = credentials.unpack(
+      sock.getsockopt(socket.SOL_SOCKET, so_peercred, credentials.size))
+  if uid != os.getuid():
+    raise IOError("Handoff peer runs as uid {}, not {}.".format(
+        uid, os.getuid()))
+
+
+def _RemoveSocketFile(path):
+  try:
+    os.remove(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+
+def PrepareForwardAddress(socket_path):
+  """Returns the gRPC address on which a new server accepts the RPCs forwarded
+  by the old server while it drains. The socket file of the previous server is
+  removed, it does not use it anymore."""
+  forward_socket_path = socket_path + ".grpc"
+  _RemoveSocketFile(forward_socket_path)
+  return "unix:" + forward_socket_path
+
+
+class HandoffListener(object):
+  # Runs in the old server. Waits for a new server process to connect, then
+  # freezes the servicer, sends it the state and forwards all the RPCs to the
+  # new server once it is serving. The old server stops listening once the new
+  # one asks for it, either because it is listening on the same address too
+  # (SO_REUSEPORT), or because it needs the address to be released.
+  #
+  # The servicer must implement:
+  #   BeginHandoff() -> StateSnapshot, blocks new RPCs.
+  #   CompleteHandoff(forward_address), forwards the blocked and new RPCs.
+  #   AbortHandoff(), resumes serving the RPCs itself.
+
+  def __init__(self, socket_path, servicer):
+    self._socket_path = socket_path
+    self._servicer = servicer
+    self._listen_sock = None
+    self._thread = None
+    self._handed_off = threading.Event()
+
+
+  def Start(self):
+    assert self._thread is None
+    _RemoveSocketFile(self._socket_path)
+    self._listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The state is only handed to processes of the same user.
+    old_umask = os.umask(0o077)
+    try:
+      self._listen_sock.bind(self._socket_path)
+    finally:
+      os.umask(old_umask)
+    self._listen_sock.listen(1)
+    self._thread = threading.Thread(target=self._ListenThread)
+    self._thread.daemon = True
+    self._thread.start()
+    logging.info("Accepting state handoff on %s", self._socket_path)
+
+
+  def _ListenThread(self):
+    while not self._handed_off.is_set():
+      try:
+        conn, _ = self._listen_sock.accept()
+      except socket.error as e:
+        logging.error("Cannot accept state handoff: %s", str(e))
+        return
+      try:
+        conn.settimeout(FLAGS.handoff_timeout_secs)
+        _CheckPeer(conn)
+        self._HandleConnection(conn)
+      except IOError as e:
+        logging.error("Refused state handoff: %s", str(e))
+      finally:
+        conn.close()
+    # The new server listens on the same path from now on, do not remove it.
+    self._listen_sock.close()
+
+
+  def _HandleConnection(self, conn):
+    logging.info("A new server requested a state handoff.")
+    snapshot = self._servicer.BeginHandoff()
+    try:
+      _SendMessage(conn, snapshot.SerializeToString())
+      forward_address = _RecvMessage(conn).decode("utf-8")
+    except (socket.error, IOError, UnicodeDecodeError) as e:
+      logging.error("State handoff failed, resuming: %s", str(e))
+      self._servicer.AbortHandoff()
+      return
+    self._servicer.CompleteHandoff(forward_address)
+    logging.info("Handed %d services off, forwarding RPCs to %s",
+                 len(snapshot.services), forward_address)
+    try:
+      _RecvMessage(conn)
+    except (socket.error, IOError) as e:
+      # The new server owns the state now, it is too late to resume.
+      logging.error("New server did not confirm the handoff: %s", str(e))
+    self._handed_off.set()
+
+
+  def WaitForHandoff(self, timeout=None):
+    """Returns True once the state was handed off to a new server."""
+    return self._handed_off.wait(timeout)
+
+
+class IncomingHandoff(object):
+  # Runs in the new server. Receives the state from the old server, then tells
+  # it where to forward the RPCs once the new server is serving.
+
+  def __init__(self, socket_path):
+    self._socket_path = socket_path
+    self._sock = None
+
+
+  def ReceiveSnapshot(self):
+    """Returns the StateSnapshot of the old server, or None if no server is
+    listening on the handoff socket."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(FLAGS.handoff_timeout_secs)
+    try:
+      sock.connect(self._socket_path)
+    except socket.error as e:
+      logging.warn("No server to take the state over from at %s: %s",
+                   self._socket_path, str(e))
+      sock.close()
+      return None
+    try:
+      _CheckPeer(sock)
+    except IOError as e:
+      logging.error("Refused state handoff: %s", str(e))
+      sock.close()
+      return None
+    self._sock = sock
+    snapshot = StateSnapshot()
+    snapshot.ParseFromString(_RecvMessage(sock))
+    logging.info("Received %d services from the running server.",
+                 len(snapshot.services))
+    return snapshot
+
+
+  def StartForwarding(self, forward_address):
+    """Called once the new server is serving on forward_address, the old server
+    then forwards all its RPCs there."""
+    assert self._sock is not None
+    _SendMessage(self._sock, forward_address.encode("utf-8"))
+
+
+  def Complete(self):
+    """Tells the old server to stop listening and drain."""
+    assert self._sock is not None
+    try:
+      _SendMessage(self._sock, b"DONE")
+    finally:
+      self._sock.close()
+      self._sock = None
@@ -0,0 +1,121 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl import flags
+from absl.testing import absltest
+from cogrob.service_manager.proto import state_journal_pb2
+from cogrob.service_manager.server import state_handoff
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+FLAGS = flags.FLAGS
+
+
+class FakeServicer(object):
+
+  def __init__(self, snapshot):
+    self.snapshot = snapshot
+    self.forward_address = None
+    self.aborted = False
+    self.completed = threading.Event()
+
+
+  def BeginHandoff(self):
+    return self.snapshot
+
+
+  def CompleteHandoff(self, forward_address):
+    self.forward_address = forward_address
+    self.completed.set()
+
+
+  def AbortHandoff(self):
+    self.aborted = True
+
+
+class StateHandoffTest(absltest.TestCase):
+
+  def setUp(self):
+    super(StateHandoffTest, self).setUp()
+    FLAGS.handoff_timeout_secs = 10
+    self._dir = tempfile.mkdtemp()
+    self._socket_path = os.path.join(self._dir, "handoff.sock")
+
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+    super(StateHandoffTest, self).tearDown()
+
+
+  def testMessages(self):
+    sock_a, sock_b = socket.socketpair()
+    try:
+      payload = b"\x00\xffstate" * 100000
+      sender = threading.Thread(
+          target=state_handoff._SendMessage, args=(sock_a, payload))
+      sender.start()
+      self.assertEqual(payload, state_handoff._RecvMessage(sock_b))
+      sender.join()
+      state_handoff._SendMessage(sock_a, b"")
+      self.assertEqual(b"", state_handoff._RecvMessage(sock_b))
+      sock_a.close()
+      with self.assertRaises(IOError):
+        state_handoff._RecvMessage(sock_b)
+    finally:
+      sock_a.close()
+      sock_b.close()
+
+
+  def testHandoff(self):
+    snapshot = state_journal_pb2.StateSnapshot()
+    snapshot.event_revision = 42
+    snapshot.services.add().id.name = "camera"
+    servicer = FakeServicer(snapshot)
+    listener = state_handoff.HandoffListener(self._socket_path, servicer)
+    listener.Start()
+    self.assertEqual(0o700, os.stat(self._socket_path).st_mode & 0o777)
+
+    incoming = state_handoff.IncomingHandoff(self._socket_path)
+    self.assertEqual(snapshot, incoming.ReceiveSnapshot())
+    forward_address = state_handoff.PrepareForwardAddress(self._socket_path)
+    incoming.StartForwarding(forward_address)
+    self.assertTrue(servicer.completed.wait(10))
+    self.assertEqual(forward_address, servicer.forward_address)
+    incoming.Complete()
+    self.assertTrue(listener.WaitForHandoff(10))
+    self.assertFalse(servicer.aborted)
+
+
+  def testNoRunningServer(self):
+    incoming = state_handoff.IncomingHandoff(self._socket_path)
+    self.assertIsNone(incoming.ReceiveSnapshot())
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -357,7 +357,7 @@ def DockerOptionsPbToDict(pb):
         value = (port.host_interface_and_port.interface_address,
                  port.host_interface_and_port.port)
       elif port.HasField("multiple_host_ports"):
-        value = map(int, port.multiple_host_ports.ports)
+        value = list(map(int, port.multiple_host_ports.ports))
       result["ports"][key] = value
 
   if pb.HasField("privileged"):
@@ -82,3 +82,27 @@ class ServiceNotActiveError(ServiceManagerError):
   def __init__(self, message="Service not active."):
     super(ServiceNotActiveError, self).__init__(
         message, result_code_pb2.RESULT_SERVICE_NOT_ACTIVE)
+
+
+class OperationNotFoundError(ServiceManagerError):
+  def __init__(self, message="Operation not found."):
+    super(OperationNotFoundError, self).__init__(
+        message, result_code_pb2.RESULT_OPERATION_NOT_FOUND)
+
+
+class DeadlineExceededError(ServiceManagerError):
+  def __init__(self, message="Deadline exceeded."):
+    super(DeadlineExceededError, self).__init__(
+        message, result_code_pb2.RESULT_DEADLINE_EXCEEDED)
+
+
+class StateCommitError(ServiceManagerError):
+  def __init__(self, message="Cannot commit the service states."):
+    super(StateCommitError, self).__init__(
+        message, result_code_pb2.RESULT_INTERNAL)
+
+
+class DependencyCycleError(ServiceManagerError):
+  def __init__(self, message="Dependency cycle."):
+    super(DependencyCycleError, self).__init__(
+        message, result_code_pb2.RESULT_DEPENDENCY_CYCLE)
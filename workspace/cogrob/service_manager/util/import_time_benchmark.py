@@ -0,0 +1,116 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Measures the import time of the CLI tools and the server, and fails if any of
+# them exceeds its budget. Each module is imported in a fresh interpreter, the
+# startup time of the interpreter itself is subtracted. Runs as a py_test, so
+# that a regression fails the build.
+
+from __future__ import print_function
+
+from absl import flags
+import subprocess
+import sys
+import time
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    "import_time_benchmark_repeats", 5,
+    "Number of times to import every module, the fastest one counts.")
+flags.DEFINE_float(
+    "client_import_time_budget_secs", 0.5,
+    "Import time budget of every CLI tool.")
+flags.DEFINE_float(
+    "server_import_time_budget_secs", 1.0,
+    "Import time budget of service_manager_server_main.")
+
+_CLIENT_MODULES = [
+    "cogrob.service_manager.client.create",
+    "cogrob.service_manager.client.query",
+    "cogrob.service_manager.client.release",
+    "cogrob.service_manager.client.release_always_on",
+    "cogrob.service_manager.client.remove",
+    "cogrob.service_manager.client.request",
+    "cogrob.service_manager.client.request_always_on",
+    "cogrob.service_manager.client.sync_with_rorg_server",
+    "cogrob.service_manager.client.test_multiple_actions",
+]
+
+_SERVER_MODULES = [
+    "cogrob.service_manager.server.service_manager_server_main",
+]
+
+# Modules that must not be imported by merely importing a CLI tool or the
+# server.
+_LAZY_MODULES = ["checksumdir", "dateutil", "docker", "psutil"]
+
+
+def _TimeStatement(statement):
+  best_time = None
+  for _ in range(FLAGS.import_time_benchmark_repeats):
+    start_time = time.time()
+    subprocess.check_call([sys.executable, "-c", statement])
+    elapsed_time = time.time() - start_time
+    if best_time is None or elapsed_time < best_time:
+      best_time = elapsed_time
+  return best_time
+
+
+def _CheckLazyModules(module):
+  statement = (
+      "import sys; import {}; "
+      "sys.exit(','.join(x for x in {} if x in sys.modules))").format(
+          module, repr(_LAZY_MODULES))
+  process = subprocess.Popen([sys.executable, "-c", statement],
+                             stderr=subprocess.PIPE)
+  _, eagerly_imported = process.communicate()
+  return eagerly_imported.decode("utf-8").strip()
+
+
+def main(argv):
+  FLAGS(argv)
+
+  baseline_time = _TimeStatement("pass")
+  print("Interpreter startup: {:.3f}s".format(baseline_time))
+
+  all_ok = True
+  for modules, budget in (
+      (_CLIENT_MODULES, FLAGS.client_import_time_budget_secs),
+      (_SERVER_MODULES, FLAGS.server_import_time_budget_secs)):
+    for module in modules:
+      import_time = _TimeStatement("import " + module) - baseline_time
+      eagerly_imported = _CheckLazyModules(module)
+      ok = import_time <= budget and not eagerly_imported
+      all_ok = all_ok and ok
+      print("{} {:.3f}s (budget {:.3f}s) {}{}".format(
+          "OK  " if ok else "FAIL", import_time, budget, module,
+          " imports " + eagerly_imported if eagerly_imported else ""))
+
+  return 0 if all_ok else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
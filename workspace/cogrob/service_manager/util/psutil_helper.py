@@ -24,17 +24,21 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import psutil
 import threading
 import time
 
 
+# psutil is imported lazily, only the looping thread needs it.
+
+
 def _GetPsUtilCpuUsage(sample_interval=1.0):
+  import psutil
   cpu_percents = psutil.cpu_percent(interval=sample_interval, percpu=True)
   return sum(map(lambda x: x/100.0, cpu_percents))
 
 
 def _GetPsUtilMemoryUsage():
+  import psutil
   return psutil.virtual_memory().used
 
 
@@ -83,5 +87,5 @@ class PsUtilHelperWithCache(object):
 
 
 if __name__ == "__main__":
-  print "CPU Usage: {}".format(_GetPsUtilCpuUsage())
-  print "Memory Usage: {}".format(_GetPsUtilMemoryUsage())
+  print("CPU Usage: {}".format(_GetPsUtilCpuUsage()))
+  print("Memory Usage: {}".format(_GetPsUtilMemoryUsage()))
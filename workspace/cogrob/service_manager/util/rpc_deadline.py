@@ -0,0 +1,112 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from cogrob.service_manager.util import errors
+import concurrent.futures
+import threading
+import time
+
+# gRPC reports about 9.2e18 seconds remaining when the client set no deadline,
+# which overflows the waits of the threading module. Longer than this is no
+# deadline.
+_MAX_TIMEOUT_SECS = 24 * 60 * 60
+
+
+def NormalizeTimeout(timeout):
+  """Returns timeout in seconds, or None if it is no deadline: None, not
+  finite, or longer than a day."""
+  if timeout is None or not timeout <= _MAX_TIMEOUT_SECS:
+    return None
+  return timeout
+
+
+def GetTimeRemaining(context):
+  """Returns the time remaining of a grpc.ServicerContext in seconds, None if
+  the client set no deadline."""
+  return NormalizeTimeout(context.time_remaining())
+
+
+class RpcDeadline(object):
+  # The deadline of an RPC, and whether its client went away. Handlers pass
+  # it down to their waits, so that an abandoned RPC does not keep a thread.
+
+  def __init__(self, timeout=None):
+    timeout = NormalizeTimeout(timeout)
+    self._deadline = None if timeout is None else time.time() + timeout
+    # Resolved once the RPC is over, e.g. cancelled by the client.
+    self._terminated = concurrent.futures.Future()
+    self._lock = threading.Lock()
+
+
+  @staticmethod
+  def FromContext(context, max_timeout=None):
+    """Follows the deadline and the cancellation of a grpc.ServicerContext.
+    max_timeout shortens the deadline."""
+    timeout = GetTimeRemaining(context)
+    if max_timeout is not None:
+      timeout = max_timeout if timeout is None else min(timeout, max_timeout)
+    result = RpcDeadline(timeout)
+    if not context.add_callback(result.Terminate):
+      result.Terminate()
+    return result
+
+
+  def Terminate(self):
+    with self._lock:
+      if not self._terminated.done():
+        self._terminated.set_result(None)
+
+
+  def IsTerminated(self):
+    return self._terminated.done()
+
+
+  def TimeRemaining(self):
+    """Seconds left, None if there is no deadline."""
+    if self._deadline is None:
+      return None
+    return max(0, self._deadline - time.time())
+
+
+  def Check(self):
+    """Raises errors.DeadlineExceededError if there is no point in starting
+    more work for this RPC."""
+    if self.IsTerminated():
+      raise errors.DeadlineExceededError("RPC cancelled by the client.")
+    if self._deadline is not None and time.time() >= self._deadline:
+      raise errors.DeadlineExceededError()
+
+
+  def WaitFuture(self, future):
+    """Wait for a concurrent.futures.Future until the deadline, or until the
+    RPC is over. Returns True if the future is done, raises its error."""
+    concurrent.futures.wait([future, self._terminated],
+                            timeout=self.TimeRemaining(),
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+    if not future.done():
+      return False
+    future.result()
+    return True
@@ -0,0 +1,114 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.util import errors
+from cogrob.service_manager.util import rpc_deadline
+import concurrent.futures
+import time
+
+
+class _FakeContext(object):
+  # The part of grpc.ServicerContext used by RpcDeadline.
+
+  def __init__(self, time_remaining, active=True):
+    self._time_remaining = time_remaining
+    self._active = active
+    self.callbacks = []
+
+
+  def time_remaining(self):
+    return self._time_remaining
+
+
+  def add_callback(self, callback):
+    self.callbacks.append(callback)
+    return self._active
+
+
+class RpcDeadlineTest(absltest.TestCase):
+
+  def testNormalizeTimeout(self):
+    self.assertIsNone(rpc_deadline.NormalizeTimeout(None))
+    self.assertEqual(0, rpc_deadline.NormalizeTimeout(0))
+    self.assertEqual(3600, rpc_deadline.NormalizeTimeout(3600))
+    # What gRPC reports without a deadline.
+    self.assertIsNone(rpc_deadline.NormalizeTimeout(9.2e18 - time.time()))
+    self.assertIsNone(rpc_deadline.NormalizeTimeout(float("inf")))
+    self.assertIsNone(rpc_deadline.NormalizeTimeout(float("nan")))
+
+
+  def testFromContextWithoutDeadline(self):
+    context = _FakeContext(9.2e18 - time.time())
+    self.assertIsNone(rpc_deadline.GetTimeRemaining(context))
+    deadline = rpc_deadline.RpcDeadline.FromContext(context)
+    self.assertIsNone(deadline.TimeRemaining())
+    deadline = rpc_deadline.RpcDeadline.FromContext(context, max_timeout=5)
+    self.assertBetween(deadline.TimeRemaining(), 0, 5)
+
+
+  def testFromContextFollowsCancellation(self):
+    context = _FakeContext(10)
+    deadline = rpc_deadline.RpcDeadline.FromContext(context)
+    self.assertFalse(deadline.IsTerminated())
+    self.assertBetween(deadline.TimeRemaining(), 0, 10)
+    context.callbacks[0]()
+    self.assertTrue(deadline.IsTerminated())
+    # Already over.
+    deadline = rpc_deadline.RpcDeadline.FromContext(_FakeContext(10, False))
+    self.assertTrue(deadline.IsTerminated())
+
+
+  def testCheck(self):
+    rpc_deadline.RpcDeadline().Check()
+    rpc_deadline.RpcDeadline(10).Check()
+    with self.assertRaises(errors.DeadlineExceededError):
+      rpc_deadline.RpcDeadline(0).Check()
+    deadline = rpc_deadline.RpcDeadline()
+    deadline.Terminate()
+    with self.assertRaises(errors.DeadlineExceededError):
+      deadline.Check()
+
+
+  def testWaitFuture(self):
+    future = concurrent.futures.Future()
+    self.assertFalse(rpc_deadline.RpcDeadline(0.01).WaitFuture(future))
+    future.set_result(None)
+    self.assertTrue(rpc_deadline.RpcDeadline().WaitFuture(future))
+
+    failed = concurrent.futures.Future()
+    failed.set_exception(ValueError())
+    with self.assertRaises(ValueError):
+      rpc_deadline.RpcDeadline().WaitFuture(failed)
+
+    # Stops waiting once the RPC is over.
+    deadline = rpc_deadline.RpcDeadline()
+    deadline.Terminate()
+    self.assertFalse(deadline.WaitFuture(concurrent.futures.Future()))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,91 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import contextlib
+import threading
+
+
+class ReadWriteLock(object):
+  # A reader-writer lock. Any number of readers can hold it at the same time,
+  # a writer holds it exclusively. Waiting writers block new readers, so that
+  # writers are not starved.
+
+  def __init__(self):
+    self._cond = threading.Condition(threading.Lock())
+    self._num_readers = 0
+    self._num_waiting_writers = 0
+    self._has_writer = False
+
+
+  def AcquireRead(self):
+    with self._cond:
+      while self._has_writer or self._num_waiting_writers:
+        self._cond.wait()
+      self._num_readers += 1
+
+
+  def ReleaseRead(self):
+    with self._cond:
+      assert self._num_readers > 0
+      self._num_readers -= 1
+      if self._num_readers == 0:
+        self._cond.notify_all()
+
+
+  def AcquireWrite(self):
+    with self._cond:
+      self._num_waiting_writers += 1
+      try:
+        while self._has_writer or self._num_readers:
+          self._cond.wait()
+      finally:
+        self._num_waiting_writers -= 1
+      self._has_writer = True
+
+
+  def ReleaseWrite(self):
+    with self._cond:
+      assert self._has_writer
+      self._has_writer = False
+      self._cond.notify_all()
+
+
+  @contextlib.contextmanager
+  def ReadLocked(self):
+    self.AcquireRead()
+    try:
+      yield
+    finally:
+      self.ReleaseRead()
+
+
+  @contextlib.contextmanager
+  def WriteLocked(self):
+    self.AcquireWrite()
+    try:
+      yield
+    finally:
+      self.ReleaseWrite()
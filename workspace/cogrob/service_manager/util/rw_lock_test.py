@@ -0,0 +1,102 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.util import rw_lock
+import threading
+
+
+class ReadWriteLockTest(absltest.TestCase):
+
+  def _RunInThread(self, function):
+    """Runs function on another thread, returns an event set once it
+    returned."""
+    done = threading.Event()
+    def _Run():
+      function()
+      done.set()
+    thread = threading.Thread(target=_Run)
+    thread.start()
+    self.addCleanup(thread.join)
+    return done
+
+
+  def testReadersShareTheLock(self):
+    lock = rw_lock.ReadWriteLock()
+    with lock.ReadLocked():
+      self.assertTrue(self._RunInThread(lock.AcquireRead).wait(10))
+      lock.ReleaseRead()
+
+
+  def testWriterWaitsForReaders(self):
+    lock = rw_lock.ReadWriteLock()
+    lock.AcquireRead()
+    written = self._RunInThread(lock.AcquireWrite)
+    self.assertFalse(written.wait(0.05))
+    lock.ReleaseRead()
+    self.assertTrue(written.wait(10))
+    lock.ReleaseWrite()
+
+
+  def testReadersWaitForWriter(self):
+    lock = rw_lock.ReadWriteLock()
+    with lock.WriteLocked():
+      read = self._RunInThread(lock.AcquireRead)
+      self.assertFalse(read.wait(0.05))
+    self.assertTrue(read.wait(10))
+    lock.ReleaseRead()
+
+
+  def testWaitingWriterBlocksNewReaders(self):
+    lock = rw_lock.ReadWriteLock()
+    lock.AcquireRead()
+    written = self._RunInThread(lock.AcquireWrite)
+    self.assertFalse(written.wait(0.05))
+    # Not starved by the readers coming after it.
+    read = self._RunInThread(lock.AcquireRead)
+    self.assertFalse(read.wait(0.05))
+    lock.ReleaseRead()
+    self.assertTrue(written.wait(10))
+    self.assertFalse(read.is_set())
+    lock.ReleaseWrite()
+    self.assertTrue(read.wait(10))
+    lock.ReleaseRead()
+
+
+  def testReleaseOnError(self):
+    lock = rw_lock.ReadWriteLock()
+    with self.assertRaises(ValueError):
+      with lock.WriteLocked():
+        raise ValueError()
+    with self.assertRaises(ValueError):
+      with lock.ReadLocked():
+        raise ValueError()
+    with lock.WriteLocked():
+      pass
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from cogrob.service_manager.proto import service_state_pb2
+import struct
+
+# A binary .service_state file is the magic, a little-endian uint16 format
+# version, then a serialized ServiceState. Text files are plain pbtxt.
+_BINARY_MAGIC = b"RORGSTAT"
+_BINARY_HEADER = struct.Struct("<H")
+_BINARY_VERSION = 1
+
+FORMAT_TEXT = "text"
+FORMAT_BINARY = "binary"
+ALL_FORMATS = [FORMAT_TEXT, FORMAT_BINARY]
+
+
+def DetectFormat(data):
+  if data.startswith(_BINARY_MAGIC):
+    return FORMAT_BINARY
+  return FORMAT_TEXT
+
+
+def SerializeServiceState(pb, storage_format):
+  """Serialize a service_state_pb2.ServiceState to bytes in the given
+  format."""
+  if storage_format == FORMAT_BINARY:
+    return (_BINARY_MAGIC + _BINARY_HEADER.pack(_BINARY_VERSION)
+            + pb.SerializeToString())
+  elif storage_format == FORMAT_TEXT:
+    # text_format is slow to import, binary-only setups never need it.
+    import google.protobuf.text_format
+    # Non-ASCII characters are escaped, the text is always ASCII.
+    return google.protobuf.text_format.MessageToString(pb).encode("ascii")
+  else:
+    raise ValueError("Unknown service state format: {}".format(storage_format))
+
+
+def ParseServiceState(data):
+  """Parse a string in any format. Returns a service_state_pb2.ServiceState and
+  the format of data."""
+  pb = service_state_pb2.ServiceState()
+  storage_format = DetectFormat(data)
+  if storage_format == FORMAT_BINARY:
+    offset = len(_BINARY_MAGIC)
+    if len(data) < offset + _BINARY_HEADER.size:
+      raise ValueError("Truncated binary service state.")
+    version, = _BINARY_HEADER.unpack_from(data, offset)
+    if version != _BINARY_VERSION:
+      raise ValueError(
+          "Unsupported binary service state version: {}".format(version))
+    pb.ParseFromString(data[offset + _BINARY_HEADER.size:])
+  else:
+    import google.protobuf.text_format
+    google.protobuf.text_format.Merge(data, pb)
+  return pb, storage_format
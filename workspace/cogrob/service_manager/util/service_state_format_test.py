@@ -0,0 +1,77 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.proto import service_state_pb2
+from cogrob.service_manager.util import service_state_format
+
+
+def _MakeServiceState():
+  pb = service_state_pb2.ServiceState()
+  pb.id.namespace.extend(["robot", "perception"])
+  pb.id.name = "camera"
+  pb.status = service_state_pb2.ServiceState.STATUS_ACTIVE
+  return pb
+
+
+class ServiceStateFormatTest(absltest.TestCase):
+
+  def testRoundTrip(self):
+    pb = _MakeServiceState()
+    for storage_format in service_state_format.ALL_FORMATS:
+      data = service_state_format.SerializeServiceState(pb, storage_format)
+      self.assertIsInstance(data, bytes)
+      parsed, parsed_format = service_state_format.ParseServiceState(data)
+      self.assertEqual(storage_format, parsed_format)
+      self.assertEqual(pb, parsed)
+
+
+  def testDetectFormat(self):
+    pb = _MakeServiceState()
+    self.assertEqual(
+        service_state_format.FORMAT_BINARY,
+        service_state_format.DetectFormat(
+            service_state_format.SerializeServiceState(
+                pb, service_state_format.FORMAT_BINARY)))
+    self.assertEqual(
+        service_state_format.FORMAT_TEXT,
+        service_state_format.DetectFormat(b"status: STATUS_ACTIVE\n"))
+
+
+  def testTruncatedBinary(self):
+    data = service_state_format.SerializeServiceState(
+        _MakeServiceState(), service_state_format.FORMAT_BINARY)
+    with self.assertRaises(ValueError):
+      service_state_format.ParseServiceState(data[:9])
+
+
+  def testUnknownFormat(self):
+    with self.assertRaises(ValueError):
+      service_state_format.SerializeServiceState(_MakeServiceState(), "json")
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,81 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Inspect or convert .service_state files.
+#   service_state_tool dump FILE...
+#   service_state_tool convert --output_format=text|binary INPUT OUTPUT
+
+from __future__ import print_function
+
+from absl import flags
+from cogrob.service_manager.util import service_state_format
+import sys
+
+FLAGS = flags.FLAGS
+flags.DEFINE_enum(
+    "output_format", service_state_format.FORMAT_TEXT,
+    service_state_format.ALL_FORMATS, "Format of the converted file.")
+
+
+def _ReadFile(file_path):
+  with open(file_path, "rb") as fp:
+    return fp.read()
+
+
+def Dump(file_paths):
+  for file_path in file_paths:
+    pb, storage_format = service_state_format.ParseServiceState(
+        _ReadFile(file_path))
+    print("# {} ({})".format(file_path, storage_format))
+    # The text format is always ASCII.
+    print(service_state_format.SerializeServiceState(
+        pb, service_state_format.FORMAT_TEXT).decode("ascii"))
+
+
+def Convert(input_path, output_path):
+  pb, _ = service_state_format.ParseServiceState(_ReadFile(input_path))
+  with open(output_path, "wb") as fp:
+    fp.write(service_state_format.SerializeServiceState(
+        pb, FLAGS.output_format))
+
+
+def main(argv):
+  args = FLAGS(argv)[1:]
+  if len(args) >= 2 and args[0] == "dump":
+    Dump(args[1:])
+  elif len(args) == 3 and args[0] == "convert":
+    Convert(args[1], args[2])
+  else:
+    sys.stderr.write(
+        "Usage: {0} dump FILE...\n"
+        "       {0} convert --output_format=text|binary INPUT OUTPUT\n".format(
+            argv[0]))
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
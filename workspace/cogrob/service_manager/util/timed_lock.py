@@ -0,0 +1,70 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from cogrob.service_manager.util import rpc_deadline
+import threading
+import time
+
+
+class TimedLock(object):
+  # A non-reentrant lock whose Acquire can time out, which threading.Lock
+  # cannot do on Python 2.
+
+  def __init__(self):
+    self._cond = threading.Condition(threading.Lock())
+    self._locked = False
+
+
+  def Acquire(self, timeout=None):
+    """Returns False if the lock was not acquired in timeout seconds (waits
+    forever if None, or if longer than rpc_deadline.NormalizeTimeout
+    allows)."""
+    timeout = rpc_deadline.NormalizeTimeout(timeout)
+    with self._cond:
+      deadline = None if timeout is None else time.time() + timeout
+      while self._locked:
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+      self._locked = True
+      return True
+
+
+  def Release(self):
+    with self._cond:
+      assert self._locked
+      self._locked = False
+      self._cond.notify()
+
+
+  def __enter__(self):
+    self.Acquire()
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Release()
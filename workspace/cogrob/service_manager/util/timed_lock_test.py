@@ -0,0 +1,81 @@
+# Copyright (c) 2019, The Regents of the University of California
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of the University of California nor the
+#   names of its contributors may be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OF THE UNIVERSITY OF CALIFORNIA
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from absl.testing import absltest
+from cogrob.service_manager.util import timed_lock
+import threading
+import time
+
+
+class TimedLockTest(absltest.TestCase):
+
+  def _HoldInThread(self, lock):
+    """Acquires lock on another thread, which releases it once the returned
+    event is set."""
+    acquired = threading.Event()
+    release = threading.Event()
+    def _Hold():
+      with lock:
+        acquired.set()
+        release.wait(10)
+    thread = threading.Thread(target=_Hold)
+    thread.start()
+    self.assertTrue(acquired.wait(10))
+    self.addCleanup(thread.join)
+    self.addCleanup(release.set)
+    return release
+
+
+  def testAcquireAndRelease(self):
+    lock = timed_lock.TimedLock()
+    self.assertTrue(lock.Acquire())
+    self.assertFalse(lock.Acquire(0))
+    lock.Release()
+    with lock:
+      self.assertFalse(lock.Acquire(0))
+    self.assertTrue(lock.Acquire(0))
+    lock.Release()
+
+
+  def testTimesOut(self):
+    lock = timed_lock.TimedLock()
+    self._HoldInThread(lock)
+    start_time = time.time()
+    self.assertFalse(lock.Acquire(0.05))
+    self.assertGreaterEqual(time.time() - start_time, 0.05)
+
+
+  def testHugeTimeoutWaitsForRelease(self):
+    lock = timed_lock.TimedLock()
+    release = self._HoldInThread(lock)
+    threading.Timer(0.05, release.set).start()
+    # What gRPC reports as time remaining without a deadline.
+    self.assertTrue(lock.Acquire(9.2e18 - time.time()))
+    lock.Release()
+
+
+if __name__ == "__main__":
+  absltest.main()